@@ -179,6 +179,13 @@ class AlertResource(DojoResource):
                 self.wrap_view('dismiss'),
                 name="api_alert_dismiss"
             ),
+            url(
+                r"^(?P<resource_name>%s)/metrics%s$" % (
+                    self._meta.resource_name, trailing_slash()
+                ),
+                self.wrap_view('metrics'),
+                name="api_alert_metrics"
+            ),
         ]
 
     def get_list(self, request, **kwargs):
@@ -235,6 +242,11 @@ class AlertResource(DojoResource):
         )
         return response
 
+    def metrics(self, request, **kwargs):
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        return self.create_response(request, alertPlugins.get_metrics())
+
     def dismiss(self, request, **kwargs):
         if request.method != 'PUT':
             response = HttpMethodNotAllowed('PUT')
@@ -463,7 +475,8 @@ class DatasetResource(DojoResource):
         return bundle
 
     def obj_get_list(self, request=None, **kwargs):
-        dsargs = {'recursive': True}
+        # inherit_props lists every inherited property
+        dsargs = {'recursive': True, 'sources': True}
         if 'parent' in kwargs:
             dsargs['path'] = kwargs.get('parent').vol_name
         else:
@@ -472,7 +485,7 @@ class DatasetResource(DojoResource):
         return zfslist
 
     def obj_get(self, bundle, **kwargs):
-        dsargs = {}
+        dsargs = {'sources': True}
         if 'parent' in kwargs:
             dsargs['path'] = f'{kwargs["parent"].vol_name}/{kwargs["pk"]}'
         else:
@@ -555,7 +568,7 @@ class ZVolResource(DojoResource):
         self.is_authenticated(request)
         name = "{}/{}".format(kwargs.get('parent').vol_name, kwargs.get('pk'))
 
-        if not zfs.zfs_list(path=name):
+        if not any(zfs.iter_zfs_list(path=name, properties=[])):
             return HttpNotFound()
 
         deserialized = self._meta.serializer.deserialize(
@@ -2466,6 +2479,37 @@ class PluginsResourceMixin(NestedMixin):
         return bundle
 
 
+class SnapshotIndexResults(object):
+    """
+    Sequence of snapshots sliced by the paginator, only the requested range
+    is retrieved from the snapshot index.
+    """
+
+    def __init__(self, options, replications):
+        self.options = options
+        self.replications = replications
+        self.total = None
+
+    def _query(self, offset, limit):
+        self.total, snapshots = notifier().zfs_snapshot_query(
+            dict(self.options, offset=offset, limit=limit),
+            replications=self.replications,
+        )
+        return snapshots
+
+    def __len__(self):
+        if self.total is None:
+            self._query(0, 0)
+        return self.total
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.step is not None:
+            raise TypeError('Only slices are supported')
+        offset = item.start or 0
+        limit = None if item.stop is None else max(item.stop - offset, 0)
+        return self._query(offset, limit)
+
+
 class SnapshotResource(DojoResource):
 
     id = fields.CharField(attribute='fullname')
@@ -2478,6 +2522,18 @@ class SnapshotResource(DojoResource):
     parent_type = fields.CharField(attribute='parent_type')
     replication = fields.CharField(attribute='replication', null=True)
 
+    # API field -> zfs.snapshot_index field, for sorting
+    INDEX_FIELD_MAP = {
+        'name': 'snapshot',
+        'filesystem': 'dataset',
+        'fullname': 'name',
+        'refer': 'referenced',
+        'used': 'used',
+        'mostrecent': 'mostrecent',
+        'extra': 'mostrecent',
+        'parent_type': 'parent_type',
+    }
+
     class Meta:
         allowed_methods = ['delete', 'get', 'post']
         object_class = zfs.Snapshot
@@ -2569,30 +2625,19 @@ class SnapshotResource(DojoResource):
             if found is False:
                 repli[repl] = set(notifier().repl_remote_snapshots(repl))
 
-        snapshots = notifier().zfs_snapshot_list(replications=repli)
-
-        results = []
-        for snaps in list(snapshots.values()):
-            results.extend(snaps)
-        FIELD_MAP = {
-            'extra': 'mostrecent',
-        }
-
+        order_by = []
         for sfield in self._apply_sorting(request.GET):
             if sfield.startswith('-'):
                 field = sfield[1:]
-                reverse = True
+                prefix = '-'
             else:
                 field = sfield
-                reverse = False
-            field = FIELD_MAP.get(field, field)
-            apifield = self.fields.get(field)
-            default = ''
-            if apifield and isinstance(apifield, fields.IntegerField):
-                default = 0
-            results.sort(
-                key=lambda item: getattr(item, field) or default,
-                reverse=reverse)
+                prefix = ''
+            field = self.INDEX_FIELD_MAP.get(field)
+            if field:
+                order_by.append(prefix + field)
+
+        results = SnapshotIndexResults({'order_by': order_by}, repli)
 
         limit = self._meta.limit
         if 'HTTP_X_RANGE' in request.META:
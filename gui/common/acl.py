@@ -23,13 +23,20 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 #####################################################################
+import ctypes
+import errno
 import grp
 import logging
 import os
 import pwd
 import re
 import stat
+import tempfile
+import threading
+import time
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pipes import quote
 from subprocess import Popen, PIPE
 
@@ -47,6 +54,19 @@ ACL_FLAGS_OS_WINDOWS = 0x0002
 ACL_FLAGS_TYPE_POSIX = 0x0100
 ACL_FLAGS_TYPE_NFSV4 = 0x0200
 
+#
+# acl_type_t, see sys/acl.h
+#
+ACL_TYPE_ACCESS = 0x00000002
+ACL_TYPE_DEFAULT = 0x00000003
+ACL_TYPE_NFS4 = 0x00000004
+
+#
+# Recursive apply: paths handed to a worker at once and number of workers
+#
+ACL_APPLY_BATCH_SIZE = 512
+ACL_APPLY_WORKERS = 4
+
 
 #
 # Odds and ends
@@ -170,6 +190,78 @@ class Base_ACL_setfacl(object):
         return None
 
 
+class Base_ACL_native(object):
+    """
+    ACL set through acl(3) in libc, to apply the same ACL to many paths
+    without forking setfacl for each of them.
+
+    An empty `text` for ACL_TYPE_DEFAULT removes the default ACL.
+    Instances are not meant to be shared between threads.
+    """
+
+    _libc = None
+
+    @classmethod
+    def libc(cls):
+        if cls._libc is None:
+            libc = ctypes.CDLL("libc.so.7", use_errno=True)
+            libc.acl_get_link_np.argtypes = [ctypes.c_char_p, ctypes.c_int]
+            libc.acl_get_link_np.restype = ctypes.c_void_p
+            libc.acl_set_link_np.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p]
+            libc.acl_delete_def_link_np.argtypes = [ctypes.c_char_p]
+            libc.acl_from_text.argtypes = [ctypes.c_char_p]
+            libc.acl_from_text.restype = ctypes.c_void_p
+            libc.acl_to_text.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+            libc.acl_to_text.restype = ctypes.c_void_p
+            libc.acl_free.argtypes = [ctypes.c_void_p]
+            cls._libc = libc
+        return cls._libc
+
+    @staticmethod
+    def _error(path):
+        err = ctypes.get_errno()
+        return OSError(err, os.strerror(err), path)
+
+    @classmethod
+    def get_text(cls, path, acltype):
+        libc = cls.libc()
+        acl = libc.acl_get_link_np(os.fsencode(path), acltype)
+        if not acl:
+            raise cls._error(path)
+        try:
+            text = libc.acl_to_text(acl, None)
+            if not text:
+                raise cls._error(path)
+            try:
+                return ctypes.string_at(text).decode('utf-8')
+            finally:
+                libc.acl_free(text)
+        finally:
+            libc.acl_free(acl)
+
+    def __init__(self, text, acltype):
+        self.acltype = acltype
+        self.acl = None
+        if text:
+            self.acl = self.libc().acl_from_text(text.encode('utf-8'))
+            if not self.acl:
+                raise Base_ACL_Exception("Invalid ACL: %s" % text)
+
+    def apply(self, path):
+        libc = self.libc()
+        if self.acl is None:
+            ret = libc.acl_delete_def_link_np(os.fsencode(path))
+        else:
+            ret = libc.acl_set_link_np(os.fsencode(path), self.acltype, self.acl)
+        if ret != 0:
+            raise self._error(path)
+
+    def close(self):
+        if self.acl is not None:
+            self.libc().acl_free(self.acl)
+            self.acl = None
+
+
 class Base_ACL_Entry:
     pass
 
@@ -435,27 +527,31 @@ class Base_ACL_Hierarchy(Base_ACL):
 
         self.__jobs = []
 
-    def _recurse(self, path, callback, *args, **kwargs):
-        callback(path, *args, **kwargs)
-
-        files = os.listdir(path)
-        decoded = path.decode('utf-8')
-        for f in files:
-            file = os.path.join(decoded, f.decode('utf-8')).encode('utf-8')
-            st = os.lstat(file)
-
-            # Do not follow symbolic links (default for chmod)
-            if stat.S_ISLNK(st.st_mode):
-                continue
-
-            if stat.S_ISDIR(st.st_mode):
-                if self.get_acl_ostype(path) == ACL_FLAGS_OS_WINDOWS:
-                    self.windows = True
-                self._recurse(file, callback, *args, **kwargs)
+    def _walk(self, path):
+        """
+        Yield (path, is_dir, name) for `path` and everything below it,
+        without following symbolic links (default for chmod).
+        """
+        yield path, True, os.path.basename(path)
+        stack = [path]
+        while stack:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_symlink():
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        yield entry.path, True, entry.name
+                    else:
+                        yield entry.path, False, entry.name
 
+    def _recurse(self, path, callback, *args, **kwargs):
+        windows_file = os.fsencode(ACL_WINDOWS_FILE) if isinstance(path, bytes) else ACL_WINDOWS_FILE
+        for file, is_dir, name in self._walk(path):
+            if name == windows_file:
+                self.windows = True
             else:
-                if f != ACL_WINDOWS_FILE:
-                    callback(file, *args, **kwargs)
+                callback(file, *args, **kwargs)
 
     def new_ACL(self, path):
         return Base_ACL(path)
@@ -511,6 +607,113 @@ class Base_ACL_Hierarchy(Base_ACL):
         else:
             self.__set_defaults(self.path, *args, **kwargs)
 
+    def __default_acls(self):
+        """
+        Text of the ACLs set_defaults leaves on a file and on a directory,
+        computed by setting the defaults on `path` and a temporary file.
+        """
+        path = os.fsdecode(self.path)
+        acltype = ACL_TYPE_NFS4 if self.nfsv4 else ACL_TYPE_ACCESS
+
+        self.__set_defaults(path)
+        directory = [(Base_ACL_native.get_text(path, acltype), acltype)]
+        if not self.nfsv4:
+            directory.append((Base_ACL_native.get_text(path, ACL_TYPE_DEFAULT), ACL_TYPE_DEFAULT))
+
+        fd, probe = tempfile.mkstemp(prefix='.acl', dir=path)
+        os.close(fd)
+        try:
+            self.__set_defaults(probe)
+            file = [(Base_ACL_native.get_text(probe, acltype), acltype)]
+        finally:
+            os.unlink(probe)
+
+        return {True: directory, False: file}
+
+    def apply_defaults(self, workers=ACL_APPLY_WORKERS, batch_size=ACL_APPLY_BATCH_SIZE,
+                       dry_run=False, progress=None):
+        """
+        Recursive set_defaults for big trees.
+
+        Target ACLs are computed once, for a file and for a directory, then
+        set on every path through acl(3) by `workers` threads, `batch_size`
+        paths at a time. Whether the Windows defaults are used only depends
+        on `path` itself.
+
+        `dry_run` walks the tree and goes through the workers without
+        changing anything. `progress` is called with the number of paths
+        done so far.
+
+        Returns the number of paths and the time it took.
+        """
+        started = time.monotonic()
+        windows_file = os.fsencode(ACL_WINDOWS_FILE) if isinstance(self.path, bytes) else ACL_WINDOWS_FILE
+        templates = None if dry_run else self.__default_acls()
+
+        local = threading.local()
+        natives = []
+        natives_lock = threading.Lock()
+
+        def apply_batch(batch):
+            if templates is None:
+                return len(batch)
+            acls = getattr(local, 'acls', None)
+            if acls is None:
+                acls = local.acls = {
+                    is_dir: [Base_ACL_native(text, acltype) for text, acltype in acl]
+                    for is_dir, acl in templates.items()
+                }
+                with natives_lock:
+                    for acl in acls.values():
+                        natives.extend(acl)
+            for path, is_dir in batch:
+                for native in acls[is_dir]:
+                    try:
+                        native.apply(path)
+                    except OSError as e:
+                        # Removed while walking the tree
+                        if e.errno != errno.ENOENT:
+                            raise
+            return len(batch)
+
+        # The root has been taken care of computing the target ACLs
+        done = 1
+        pending = deque()
+        batch = []
+        walk = self._walk(self.path)
+        next(walk)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                try:
+                    for path, is_dir, name in walk:
+                        if name == windows_file:
+                            continue
+                        batch.append((path, is_dir))
+                        if len(batch) < batch_size:
+                            continue
+                        pending.append(executor.submit(apply_batch, batch))
+                        batch = []
+                        # Do not hold the whole tree in memory
+                        while len(pending) > workers * 2:
+                            done += pending.popleft().result()
+                            if progress:
+                                progress(done)
+                    if batch:
+                        pending.append(executor.submit(apply_batch, batch))
+                    while pending:
+                        done += pending.popleft().result()
+                        if progress:
+                            progress(done)
+                except BaseException:
+                    for future in pending:
+                        future.cancel()
+                    raise
+        finally:
+            for native in natives:
+                native.close()
+
+        return {'paths': done, 'seconds': time.monotonic() - started}
+
     def __reset(self, path, *args, **kwargs):
         log.debug("Base_ACL_Hierarchy.__reset: enter")
         log.debug("Base_ACL_Hierarchy.__reset: path = %s", path)
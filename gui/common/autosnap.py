@@ -0,0 +1,149 @@
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+Retention of the snapshots taken by the periodic snapshot tasks, kept
+apart from tools/autosnap so it can be used without Django.
+"""
+import re
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+RE_AUTOSNAP = re.compile(
+    r'^auto-(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2}).'
+    r'(?P<hour>\d{2})(?P<minute>\d{2})-(?P<retcount>\d+)'
+    r'(?P<retunit>[hdwmy])$'
+)
+
+
+def snapinfodict2datetime(snapinfo):
+    year = int(snapinfo['year'])
+    month = int(snapinfo['month'])
+    day = int(snapinfo['day'])
+    hour = int(snapinfo['hour'])
+    minute = int(snapinfo['minute'])
+    return datetime(year, month, day, hour, minute)
+
+
+def snap_expiration(snapinfo):
+    expiration = snapinfodict2datetime(snapinfo)
+    snap_ttl_value = int(snapinfo['retcount'])
+    snap_ttl_unit = snapinfo['retunit']
+
+    if snap_ttl_unit == 'h':
+        return expiration + timedelta(hours=snap_ttl_value)
+    elif snap_ttl_unit == 'd':
+        return expiration + timedelta(days=snap_ttl_value)
+    elif snap_ttl_unit == 'w':
+        return expiration + timedelta(days=7 * snap_ttl_value)
+    elif snap_ttl_unit == 'm':
+        return expiration + timedelta(days=int(30.436875 * snap_ttl_value))
+    elif snap_ttl_unit == 'y':
+        return expiration + timedelta(days=int(365.2425 * snap_ttl_value))
+    return expiration
+
+
+def snap_expired(snapinfo, snaptime):
+    return snap_expiration(snapinfo) <= snaptime
+
+
+class RetentionPlan(object):
+    """
+    Snapshots of the periodic snapshot tasks due at `snaptime`, indexed by
+    dataset and by (filesystem, retention, recursive) bucket in one pass.
+
+    `latest` holds the creation time of the latest snapshot still alive of
+    every bucket of `mp_to_task_map` and `expired` the datasets of every
+    expired snapshot name.
+    """
+
+    def __init__(self, mp_to_task_map, snaptime):
+        self.mp_to_task_map = mp_to_task_map
+        self.snaptime = snaptime
+        self.latest = {}
+        self.expired = defaultdict(set)
+        # Recursive tasks share their snapshot names across datasets, so
+        # parse and expire each name once
+        self.__parsed = {}
+
+    def parse(self, snapname):
+        """
+        Returns:
+            tuple(datetime, str, bool) - creation time, retention policy and
+                                         whether it is expired; None for
+                                         snapshots not taken by autosnap
+        """
+        try:
+            return self.__parsed[snapname]
+        except KeyError:
+            pass
+        snapname_match = RE_AUTOSNAP.match(snapname)
+        if snapname_match is None:
+            parsed = None
+        else:
+            snap_infodict = snapname_match.groupdict()
+            parsed = (
+                snapinfodict2datetime(snap_infodict),
+                '%s%s' % (snap_infodict['retcount'], snap_infodict['retunit']),
+                snap_expired(snap_infodict, self.snaptime),
+            )
+        self.__parsed[snapname] = parsed
+        return parsed
+
+    def add(self, snapshot_names):
+        for snapshot_name in snapshot_names:
+            fs, snapname = snapshot_name.split('@', 1)
+            parsed = self.parse(snapname)
+            if parsed is None:
+                continue
+            created, retention, expired = parsed
+            if expired:
+                self.expired[snapname].add(fs)
+                continue
+            for recursive in (True, False):
+                key = (fs, retention, recursive)
+                if key in self.mp_to_task_map and (key not in self.latest or self.latest[key] < created):
+                    self.latest[key] = created
+
+    def destroys(self):
+        """
+        Expired snapshots to destroy grouped per dataset, leaving out the
+        ones `zfs destroy -r` of the same snapshot of a parent takes care of.
+
+        Returns:
+            list(tuple(str, list(str))) - dataset and snapshot names
+        """
+        per_dataset = defaultdict(list)
+        for snapname, datasets in self.expired.items():
+            for fs in datasets:
+                parent = fs
+                while '/' in parent:
+                    parent = parent.rsplit('/', 1)[0]
+                    if parent in datasets:
+                        break
+                else:
+                    per_dataset[fs].append(snapname)
+        return sorted((fs, sorted(names)) for fs, names in per_dataset.items())
@@ -0,0 +1,246 @@
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+Copy of a data stream between two file descriptors, e.g. from `zfs send`
+to the ssh carrying it, with optional compression and rate limiting.
+
+It takes the place of the compressor | throttle | pipewatcher pipeline and
+keeps count of the bytes going through so the progress of the transfer can
+be reported.
+"""
+from collections import deque
+import errno
+import fcntl
+import os
+import select
+import threading
+import time
+
+# Bytes queued between the source and the destination
+PUMP_BUFFER_SIZE = 4 * 1024 * 1024
+# Bytes read at once from the source
+PUMP_READ_SIZE = 1024 * 1024
+# Seconds without any data going through before giving up, as pipewatcher
+PUMP_STALL_TIMEOUT = 3600
+# Seconds between calls to the progress callback
+PUMP_PROGRESS_INTERVAL = 1
+# Buffers written by a single writev(2)
+PUMP_IOV_MAX = 64
+
+
+class StreamError(Exception):
+    pass
+
+
+class StreamStalled(StreamError):
+    pass
+
+
+class Codec(object):
+    """
+    Compression of a stream, either in process through `compressor`, a
+    callable returning an object with the compress()/flush() interface of
+    zlib and lzma, or by an external filter `command`.
+
+    `decompress` is the shell command undoing it on the receiving side.
+    """
+
+    def __init__(self, decompress, compressor=None, command=None):
+        self.decompress = decompress
+        self.compressor = compressor
+        self.command = command
+
+
+class TokenBucket(object):
+    """
+    Rate limit of `rate` bytes per second allowing bursts of `burst` bytes.
+
+    It may be shared by several pumps, limiting their combined rate.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = int(burst or max(rate, 16384))
+        self.tokens = float(self.burst)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """
+        Take `amount` bytes out of the bucket, sleeping for as long as it is
+        in debt.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class StreamPump(object):
+    """
+    Copy everything read from `src` to `dst` until the end of `src`.
+
+    Both file descriptors are set non blocking. `dst` is not closed, it is
+    up to the caller to do so once run() returns.
+    """
+
+    def __init__(self, src, dst, compressor=None, limiter=None, progress=None,
+                 buffer_size=PUMP_BUFFER_SIZE, read_size=PUMP_READ_SIZE,
+                 stall_timeout=PUMP_STALL_TIMEOUT):
+        self.src = src
+        self.dst = dst
+        self.compressor = compressor
+        self.limiter = limiter
+        self.progress = progress
+        self.buffer_size = buffer_size
+        self.read_size = read_size
+        self.stall_timeout = stall_timeout
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.started = None
+        self.finished = None
+        # (time, bytes_out) of the last seconds, for the current rate
+        self._samples = deque(maxlen=6)
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self):
+        """
+        Bytes per second sent over the last few seconds, or over the whole
+        transfer once it is done.
+        """
+        if self.finished is not None:
+            return self.bytes_out / self.elapsed if self.elapsed else 0
+        if len(self._samples) < 2:
+            return 0
+        (t0, b0), (t1, b1) = self._samples[0], self._samples[-1]
+        return (b1 - b0) / (t1 - t0) if t1 > t0 else 0
+
+    def _sample(self, now):
+        self._samples.append((now, self.bytes_out))
+        if self.progress is not None:
+            self.progress(self)
+
+    def _write(self, chunks, queued):
+        # Never write more than the limiter allows in one go
+        limit = self.limiter.burst if self.limiter else queued
+        iov = []
+        size = 0
+        for chunk in chunks:
+            if len(iov) == PUMP_IOV_MAX or size >= limit:
+                break
+            if size + len(chunk) > limit:
+                chunk = chunk[:limit - size]
+            iov.append(chunk)
+            size += len(chunk)
+        try:
+            written = os.writev(self.dst, iov)
+        except BlockingIOError:
+            return 0
+        except OSError as e:
+            if e.errno == errno.EPIPE:
+                raise StreamError('Receiving side closed the stream')
+            raise
+
+        left = written
+        while left:
+            chunk = chunks[0]
+            if len(chunk) <= left:
+                chunks.popleft()
+                left -= len(chunk)
+            else:
+                chunks[0] = chunk[left:]
+                left = 0
+        self.bytes_out += written
+        if self.limiter and written:
+            self.limiter.consume(written)
+        return written
+
+    def run(self):
+        _set_nonblocking(self.src)
+        _set_nonblocking(self.dst)
+
+        # Data is queued as the buffers returned by read() and the
+        # compressor, written out by writev() without joining them
+        chunks = deque()
+        queued = 0
+        eof = False
+        self.started = last_activity = next_sample = time.monotonic()
+        self._sample(self.started)
+        try:
+            while not eof or chunks:
+                rlist = [self.src] if not eof and queued < self.buffer_size else []
+                wlist = [self.dst] if chunks else []
+                rlist, wlist = select.select(rlist, wlist, [], PUMP_PROGRESS_INTERVAL)[:2]
+
+                now = time.monotonic()
+                if rlist:
+                    try:
+                        data = os.read(self.src, self.read_size)
+                    except BlockingIOError:
+                        data = None
+                    if data:
+                        self.bytes_in += len(data)
+                        if self.compressor is not None:
+                            data = self.compressor.compress(data)
+                        last_activity = now
+                    elif data is not None:
+                        eof = True
+                        if self.compressor is not None:
+                            data = self.compressor.flush()
+                    if data:
+                        chunks.append(memoryview(data))
+                        queued += len(data)
+
+                if wlist:
+                    written = self._write(chunks, queued)
+                    if written:
+                        queued -= written
+                        last_activity = now = time.monotonic()
+
+                if now - last_activity > self.stall_timeout:
+                    raise StreamStalled('No data sent for %d seconds' % self.stall_timeout)
+                if now >= next_sample:
+                    self._sample(now)
+                    next_sample = now + PUMP_PROGRESS_INTERVAL
+        finally:
+            self.finished = time.monotonic()
+            self._sample(self.finished)
@@ -0,0 +1,77 @@
+import unittest
+
+from datetime import datetime
+
+from freenasUI.common.autosnap import RetentionPlan
+
+
+SNAPTIME = datetime(2017, 6, 15, 12, 0)
+
+
+class RetentionPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plan = RetentionPlan({
+            ('tank', '2w', True): [],
+            ('tank/home', '1h', False): [],
+        }, SNAPTIME)
+
+    def test_parse(self):
+        self.assertEqual(
+            self.plan.parse('auto-20170615.1100-2w'),
+            (datetime(2017, 6, 15, 11, 0), '2w', False),
+        )
+        self.assertEqual(
+            self.plan.parse('auto-20170615.1100-1h'),
+            (datetime(2017, 6, 15, 11, 0), '1h', True),
+        )
+        self.assertEqual(self.plan.parse('auto-20170501.0000-1m')[2], True)
+        self.assertIsNone(self.plan.parse('manual-20170615'))
+        self.assertIsNone(self.plan.parse('auto-20170615.1100-2x'))
+
+    def test_add(self):
+        self.plan.add([
+            'tank@auto-20170614.1200-2w',
+            'tank@auto-20170615.1100-2w',
+            'tank@manual',
+            'tank/home@auto-20170615.1130-1h',
+            'tank/home@auto-20170615.1000-1h',
+            'tank/other@auto-20170615.1100-1d',
+        ])
+        self.assertEqual(self.plan.latest, {
+            ('tank', '2w', True): datetime(2017, 6, 15, 11, 0),
+            ('tank/home', '1h', False): datetime(2017, 6, 15, 11, 30),
+        })
+        self.assertEqual(dict(self.plan.expired), {
+            'auto-20170615.1000-1h': {'tank/home'},
+        })
+
+    def test_destroys(self):
+        self.plan.add([
+            'tank@auto-20170601.1200-1w',
+            'tank/a@auto-20170601.1200-1w',
+            'tank/a/b@auto-20170601.1200-1w',
+            'tank/c@auto-20170601.1200-1w',
+            'data/a@auto-20170601.1200-1w',
+            'data/a/b@auto-20170601.1200-1w',
+            'data/c@auto-20170601.1200-1w',
+            'data/c@auto-20170602.1200-1w',
+            'data/d/e@auto-20170602.1200-1w',
+            'data@auto-20170615.1100-2w',
+        ])
+        # Children of a dataset with the same expired snapshot are destroyed
+        # by its `zfs destroy -r`
+        self.assertEqual(self.plan.destroys(), [
+            ('data/a', ['auto-20170601.1200-1w']),
+            ('data/c', ['auto-20170601.1200-1w', 'auto-20170602.1200-1w']),
+            ('data/d/e', ['auto-20170602.1200-1w']),
+            ('tank', ['auto-20170601.1200-1w']),
+        ])
+
+    def test_destroys_nothing_expired(self):
+        self.plan.add(['tank@auto-20170615.1100-2w'])
+        self.assertEqual(self.plan.destroys(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
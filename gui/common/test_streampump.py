@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+import unittest
+import zlib
+from unittest import mock
+
+from freenasUI.common import streampump
+from freenasUI.common.streampump import StreamError, StreamPump, StreamStalled, TokenBucket
+
+
+def feed(fd, data, chunk_size=65536):
+    def write():
+        with os.fdopen(fd, 'wb') as f:
+            for i in range(0, len(data), chunk_size):
+                f.write(data[i:i + chunk_size])
+    thread = threading.Thread(target=write, daemon=True)
+    thread.start()
+    return thread
+
+
+def drain(fd):
+    result = []
+
+    def read():
+        with os.fdopen(fd, 'rb') as f:
+            result.append(f.read())
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    return thread, result
+
+
+class StreamPumpTest(unittest.TestCase):
+
+    def pump(self, data, **kwargs):
+        src_r, src_w = os.pipe()
+        dst_r, dst_w = os.pipe()
+        writer = feed(src_w, data)
+        reader, result = drain(dst_r)
+        pump = StreamPump(src_r, dst_w, **kwargs)
+        try:
+            pump.run()
+        finally:
+            os.close(src_r)
+            os.close(dst_w)
+        writer.join()
+        reader.join()
+        return pump, result[0]
+
+    def test_copy(self):
+        data = os.urandom(3 * 1024 * 1024 + 17)
+        pump, out = self.pump(data, buffer_size=256 * 1024, read_size=32 * 1024)
+        self.assertEqual(out, data)
+        self.assertEqual(pump.bytes_in, len(data))
+        self.assertEqual(pump.bytes_out, len(data))
+        self.assertIsNotNone(pump.finished)
+
+    def test_empty(self):
+        pump, out = self.pump(b'')
+        self.assertEqual(out, b'')
+        self.assertEqual((pump.bytes_in, pump.bytes_out), (0, 0))
+
+    def test_compressor(self):
+        data = b'freenas' * 200000
+        pump, out = self.pump(data, compressor=zlib.compressobj())
+        self.assertEqual(zlib.decompress(out), data)
+        self.assertEqual(pump.bytes_in, len(data))
+        self.assertEqual(pump.bytes_out, len(out))
+        self.assertLess(pump.bytes_out, pump.bytes_in)
+
+    def test_progress(self):
+        calls = []
+        pump, out = self.pump(os.urandom(100000), progress=lambda p: calls.append(p.bytes_out))
+        # Called when starting and once done, at least
+        self.assertGreaterEqual(len(calls), 2)
+        self.assertEqual(calls[0], 0)
+        self.assertEqual(calls[-1], 100000)
+        self.assertGreater(pump.rate, 0)
+
+    def test_receiver_closed(self):
+        src_r, src_w = os.pipe()
+        dst_r, dst_w = os.pipe()
+        os.close(dst_r)
+        writer = feed(src_w, os.urandom(10000))
+        try:
+            with self.assertRaises(StreamError):
+                StreamPump(src_r, dst_w).run()
+        finally:
+            os.close(src_r)
+            os.close(dst_w)
+        writer.join()
+
+    def test_stalled(self):
+        src_r, src_w = os.pipe()
+        dst_r, dst_w = os.pipe()
+        try:
+            with mock.patch.object(streampump, 'PUMP_PROGRESS_INTERVAL', 0.05):
+                with self.assertRaises(StreamStalled):
+                    StreamPump(src_r, dst_w, stall_timeout=0.2).run()
+        finally:
+            for fd in (src_r, src_w, dst_r, dst_w):
+                os.close(fd)
+
+    def test_limiter(self):
+        data = os.urandom(60000)
+        limiter = TokenBucket(100000, burst=20000)
+        start = time.monotonic()
+        pump, out = self.pump(data, limiter=limiter)
+        self.assertEqual(out, data)
+        # 40000 bytes over the initial burst at 100000 bytes per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.35)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst(self):
+        bucket = TokenBucket(1000, burst=5000)
+        start = time.monotonic()
+        bucket.consume(5000)
+        self.assertLess(time.monotonic() - start, 0.1)
+
+    def test_rate(self):
+        bucket = TokenBucket(100000, burst=10000)
+        start = time.monotonic()
+        for i in range(5):
+            bucket.consume(10000)
+        elapsed = time.monotonic() - start
+        self.assertGreaterEqual(elapsed, 0.35)
+        self.assertLess(elapsed, 1)
+
+    def test_default_burst(self):
+        self.assertEqual(TokenBucket(1000).burst, 16384)
+        self.assertEqual(TokenBucket(10 ** 6).burst, 10 ** 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
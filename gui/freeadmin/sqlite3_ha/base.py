@@ -1,12 +1,18 @@
 
+import atexit
+import fcntl
+import functools
 import logging
 import os
+import queue
+import re
+import struct
 import threading
 import time
+import zlib
 from sqlite3 import OperationalError
 
 from django.db.backends.sqlite3 import base as sqlite3base
-from lockfile import LockFile, LockTimeout
 import pickle as pickle
 import sqlparse
 
@@ -31,6 +37,21 @@ NO_SYNC_MAP = {
 }
 
 
+# Maximum number of statements sent to the remote side at once
+REPLICATION_BATCH_SIZE = 500
+# Minimum delay between attempts to replay the journal to the remote side
+JOURNAL_REPLAY_INTERVAL = 30
+# How long the failover status is trusted, transitions also invalidate it
+# in processes receiving CARP events (see invalidate_failover_status)
+FAILOVER_STATUS_TTL = 10
+
+RE_STATEMENT = re.compile(
+    r'^\s*(?:(?P<insert>insert)(?:\s+or\s+\w+)?\s+into|(?P<delete>delete)\s+from|'
+    r'(?P<update>update)(?:\s+or\s+\w+)?)\s+[`"\[]?(?P<table>\w+)',
+    re.I,
+)
+
+
 class DBSync(object):
     """
     Allow to execute all queries made within a with statement
@@ -54,84 +75,427 @@ class Journal(object):
     Interface for accessing the journal for the queries that couldn't run in
     the remote side, either for it being offline or failed to execute.
 
+    The journal is an append-only file of records, each one being a header
+    (payload length and CRC32) followed by a pickled (query, params). A
+    separate cursor file holds the offset of the first query not replayed
+    yet, so neither appending nor replaying has to rewrite the journal. It
+    is truncated once fully replayed and compacted when mostly replayed.
+
+    A record partially written by a crash fails its checksum and is
+    dropped along with anything after it.
+
     This should be used in a context and provides file locking by itself.
     """
 
     JOURNAL_FILE = '/data/ha-journal'
+    HEADER = struct.Struct('>II')
+    # Compact once that many bytes have been replayed and are more than half
+    # of the file
+    COMPACT_SIZE = 4 * 1024 * 1024
+
+    _thread_lock = threading.Lock()
+    # Whether this process made sure the journal does not end with a
+    # partially written record
+    _checked = False
+
+    def __init__(self):
+        self._lockfd = None
+        self._queries = None
+        self._loaded = None
+
+    @classmethod
+    def _cursor_file(cls):
+        return cls.JOURNAL_FILE + '.cursor'
+
+    @classmethod
+    def _read_cursor(cls):
+        """
+        The cursor file holds the inode of the journal along with the
+        offset, a journal rewritten (new inode) is replayed from the start.
+        """
+        try:
+            inode = os.stat(cls.JOURNAL_FILE).st_ino
+            with open(cls._cursor_file(), 'r') as f:
+                cursor_inode, offset = f.read().split()
+            if int(cursor_inode) != inode:
+                return 0
+            return int(offset)
+        except (OSError, ValueError):
+            return 0
 
     @classmethod
     def is_empty(cls):
-        if not os.path.exists(cls.JOURNAL_FILE):
-            return True
         try:
-            return os.stat(cls.JOURNAL_FILE).st_size == 0
+            size = os.stat(cls.JOURNAL_FILE).st_size
         except OSError:
             return True
+        return size <= cls._read_cursor()
 
-    def _get_queries(self):
+    def __enter__(self):
+        # flock is released by the kernel if the process dies, there is no
+        # stale lock to break. It does not exclude threads of this process.
+        self._thread_lock.acquire()
         try:
-            with open(self.JOURNAL_FILE, 'rb') as f:
-                self.queries = pickle.loads(f.read())
-        except (pickle.PickleError, EOFError):
-            self.queries = []
+            self._lockfd = os.open(self.JOURNAL_FILE + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self._lockfd, fcntl.LOCK_EX)
+            if not Journal._checked:
+                self._repair()
+                Journal._checked = True
+        except Exception:
+            if self._lockfd is not None:
+                os.close(self._lockfd)
+            self._thread_lock.release()
+            raise
+        return self
 
-    def __enter__(self):
-        self._lock = LockFile(self.JOURNAL_FILE)
-        while not self._lock.i_am_locking():
+    def __exit__(self, typ, value, traceback):
+        try:
+            # Compatibility with callers changing the `queries` list
+            if self._queries is not None and self._queries != self._loaded:
+                self._rewrite(self._queries)
+            self._queries = self._loaded = None
+        finally:
+            os.close(self._lockfd)
+            self._lockfd = None
+            self._thread_lock.release()
+        if typ is not None:
+            raise
+
+    def _write_cursor(self, offset):
+        tmp = self._cursor_file() + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('%d %d' % (os.stat(self.JOURNAL_FILE).st_ino, offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self._cursor_file())
+
+    def _records(self, offset):
+        """
+        Yield (offset of the next record, (query, params)) starting at `offset`
+        """
+        try:
+            f = open(self.JOURNAL_FILE, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(offset)
+            while True:
+                header = f.read(self.HEADER.size)
+                if len(header) < self.HEADER.size:
+                    return
+                length, crc = self.HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    log.warning('Ignoring corrupted HA journal after offset %d', offset)
+                    return
+                offset += self.HEADER.size + length
+                yield offset, pickle.loads(payload)
+
+    def _migrate(self):
+        """
+        Convert the journal left by previous versions, a single pickled list
+        of queries, to records.
+        """
+        try:
+            f = open(self.JOURNAL_FILE, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            header = f.read(self.HEADER.size)
+            if not header:
+                return
+            if len(header) == self.HEADER.size:
+                length, crc = self.HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) == length and zlib.crc32(payload) == crc:
+                    return
+            f.seek(0)
             try:
-                self._lock.acquire(timeout=5)
-            except LockTimeout:
-                self._lock.break_lock()
+                queries = pickle.loads(f.read())
+            except Exception:
+                return
+        if not isinstance(queries, list):
+            return
+        log.info('Converting %d queries of the HA journal to the new format', len(queries))
+        self._rewrite(queries)
 
-        if not os.path.exists(self.JOURNAL_FILE):
-            open(self.JOURNAL_FILE, 'a').close()
+    def _repair(self):
+        """
+        Drop whatever was left by a write interrupted by a crash.
+        """
+        self._migrate()
+        try:
+            size = os.stat(self.JOURNAL_FILE).st_size
+        except FileNotFoundError:
+            return
+        end = self._read_cursor()
+        for end, query in self._records(end):
+            pass
+        if end < size:
+            with open(self.JOURNAL_FILE, 'r+b') as f:
+                f.truncate(end)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def append(self, queries):
+        """
+        Append queries, only writing the new records.
+        """
+        data = bytearray()
+        for query in queries:
+            payload = pickle.dumps(tuple(query))
+            data += self.HEADER.pack(len(payload), zlib.crc32(payload))
+            data += payload
 
-        self._get_queries()
-        return self
+        fd = os.open(self.JOURNAL_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, bytes(data))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
-    def __exit__(self, typ, value, traceback):
+    def read(self, limit=None):
+        """
+        Returns up to `limit` queries not replayed yet and the cursor to
+        `advance` to once they have been.
+        """
+        cursor = self._read_cursor()
+        queries = []
+        for cursor, query in self._records(cursor):
+            queries.append(query)
+            if limit is not None and len(queries) >= limit:
+                break
+        return queries, cursor
+
+    def advance(self, cursor):
+        """
+        Mark queries up to `cursor` as replayed.
+        """
+        try:
+            size = os.stat(self.JOURNAL_FILE).st_size
+        except OSError:
+            size = 0
+        if cursor >= size:
+            self.clear()
+        elif cursor > self.COMPACT_SIZE and cursor > size / 2:
+            self._rewrite([query for end, query in self._records(cursor)])
+        else:
+            self._write_cursor(cursor)
+
+    def clear(self):
+        self._rewrite([])
+
+    def _rewrite(self, queries):
+        # The new file gets a new inode, invalidating the cursor
+        tmp = self.JOURNAL_FILE + '.tmp'
+        with open(tmp, 'wb') as f:
+            for query in queries:
+                payload = pickle.dumps(tuple(query))
+                f.write(self.HEADER.pack(len(payload), zlib.crc32(payload)))
+                f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.JOURNAL_FILE)
+        self._write_cursor(0)
+
+    @property
+    def queries(self):
+        """
+        List of the queries not replayed yet. Changes made to it are
+        written back on exit, prefer `append`, `read` and `advance`.
+        """
+        if self._queries is None:
+            self._loaded = self.read()[0]
+            self._queries = list(self._loaded)
+        return self._queries
+
+    @queries.setter
+    def queries(self, value):
+        if self._loaded is None:
+            self._loaded = self.read()[0]
+        self._queries = value
+
+    def replay(self, send, batch_size=None):
+        """
+        Send the queries to the remote side in batches through `send`,
+        advancing the cursor after each batch. Stops at the first failure,
+        in which case the exception is raised.
+        """
+        batch_size = batch_size or REPLICATION_BATCH_SIZE
+        while True:
+            queries, cursor = self.read(batch_size)
+            if not queries:
+                return
+            send(queries)
+            self.advance(cursor)
 
-        with open(self.JOURNAL_FILE, 'wb+') as f:
-            if self.queries:
-                f.write(pickle.dumps(self.queries))
 
-        self._lock.release()
-        if typ is not None:
-            raise
+class FailoverStatus(object):
+    """
+    Cache of notifier().failover_status(), which is very expensive to run
+    for every write.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._status = None
+        self._updated = 0
 
+    def get(self):
+        with self._lock:
+            if (
+                self._status is not None and
+                time.monotonic() - self._updated < FAILOVER_STATUS_TTL
+            ):
+                return self._status
+        try:
+            from freenasUI.middleware.notifier import notifier
+            if hasattr(notifier, 'failover_status'):
+                status = notifier().failover_status()
+            else:
+                status = None
+        except Exception:
+            status = None
+        with self._lock:
+            self._status = status
+            self._updated = time.monotonic()
+        return status
 
-class RunSQLRemote(threading.Thread):
+    def invalidate(self):
+        with self._lock:
+            self._status = None
+
+
+failover_status = FailoverStatus()
+
+
+def invalidate_failover_status():
+    failover_status.invalidate()
+
+
+@functools.lru_cache(maxsize=1024)
+def classify(query):
     """
-    This is a thread responsible for running the queries on the remote side.
+    Returns (statement, table) for INSERT, DELETE and UPDATE queries,
+    None otherwise.
 
-    The query will be appended to the Journal in case the Journal is not empty
-    or if it fails (e.g. remote side offline)
+    Queries are parameterized so the same few strings are seen over and
+    over, hence the cache.
     """
+    reg = RE_STATEMENT.match(query)
+    if not reg:
+        return None
+    for statement in ('insert', 'delete', 'update'):
+        if reg.group(statement):
+            return statement.upper(), reg.group('table')
+
 
-    def __init__(self, *args, **kwargs):
-        self._sql = kwargs.pop('sql')
-        self._params = kwargs.pop('params')
-        super(RunSQLRemote, self).__init__(*args, **kwargs)
+class Replicator(threading.Thread):
+    """
+    Background thread sending queries to the remote side in order.
+
+    Queries queued while a batch is in flight are sent together in the next
+    one, within a single remote transaction. They are appended to the
+    Journal in case it is not empty or if the remote side fails (e.g. it
+    is offline).
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        super(Replicator, self).__init__(daemon=True, name='sqlite3_ha_replicator')
+        self.queue = queue.Queue()
+        self.pid = os.getpid()
+        self.last_replay = 0
+
+    @classmethod
+    def get(cls):
+        with cls._instance_lock:
+            # Threads do not survive a fork
+            if cls._instance is None or cls._instance.pid != os.getpid():
+                cls._instance = cls()
+                cls._instance.start()
+            return cls._instance
+
+    def put(self, sql, params, wait=False):
+        event = threading.Event() if wait else None
+        self.queue.put((sql, params, event))
+        if event:
+            event.wait()
+
+    def flush(self):
+        """Wait for every query queued so far to be sent or journaled"""
+        event = threading.Event()
+        self.queue.put((None, None, event))
+        event.wait()
 
     def run(self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < REPLICATION_BATCH_SIZE:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            queries = [(sql, params) for sql, params, event in items if sql is not None]
+            try:
+                if queries:
+                    self.send(queries)
+            finally:
+                for sql, params, event in items:
+                    if event:
+                        event.set()
+
+    def send(self, queries):
         from freenasUI.middleware.client import client, ClientException
+
+        def send_remote(queries):
+            with client as c:
+                c.call('failover.call_remote', 'datastore.sql_batch', [queries])
+
         try:
             with Journal() as f:
-                if f.queries:
-                    f.queries.append((self._sql, self._params))
-                else:
-                    with client as c:
-                        c.call('failover.call_remote', 'datastore.sql', [self._sql, self._params])
-        except ClientException:
-            with Journal() as f:
-                f.queries.append((self._sql, self._params))
-            return False
+                if not f.is_empty():
+                    # Queries must run in order, replay the journal first
+                    # when the remote side may be back
+                    if time.monotonic() - self.last_replay < JOURNAL_REPLAY_INTERVAL:
+                        f.append(queries)
+                        return False
+                    self.last_replay = time.monotonic()
+                    try:
+                        f.replay(send_remote)
+                    except ClientException:
+                        f.append(queries)
+                        return False
+                send_remote(queries)
         except Exception as err:
-            log.error('Failed to run SQL remotely %s: %s', self._sql, err, exc_info=True)
+            if not isinstance(err, ClientException):
+                log.error('Failed to run %d SQL queries remotely: %s', len(queries), err, exc_info=True)
+            # Keep them for the next replay rather than losing them
+            try:
+                with Journal() as f:
+                    f.append(queries)
+            except Exception:
+                log.error('Failed to journal %d SQL queries', len(queries), exc_info=True)
             return False
         return True
 
 
+def _flush_replicator():
+    """
+    The replicator is a daemon thread, make sure what it was given is sent
+    or journaled before the process exits.
+    """
+    instance = Replicator._instance
+    if instance is not None and instance.pid == os.getpid() and instance.is_alive():
+        instance.flush()
+
+
+atexit.register(_flush_replicator)
+
+
 class DatabaseFeatures(sqlite3base.DatabaseFeatures):
     pass
 
@@ -143,7 +507,16 @@ class DatabaseOperations(sqlite3base.DatabaseOperations):
 class DatabaseWrapper(sqlite3base.DatabaseWrapper):
 
     def create_cursor(self):
-        return self.connection.cursor(factory=HASQLiteCursorWrapper)
+        cursor = self.connection.cursor(factory=HASQLiteCursorWrapper)
+        cursor.db = self
+        return cursor
+
+    def _commit(self):
+        rv = super(DatabaseWrapper, self)._commit()
+        # Queries of a transaction are only waited for once it is committed
+        if execute_sync:
+            Replicator.get().flush()
+        return rv
 
     def dump(self):
         """
@@ -239,7 +612,7 @@ class DatabaseWrapper(sqlite3base.DatabaseWrapper):
         ))
 
         with Journal() as j:
-            j.queries = []
+            j.clear()
 
         return True
 
@@ -249,131 +622,101 @@ class HASQLiteCursorWrapper(Database.Cursor):
     def execute_passive(self, query, params=None):
         """
         Process the query, modify it if necessary based on NO_SYNC_MAP rules
-        and execute it on the remote side.
+        and queue it to be executed on the remote side.
         """
         global execute_sync
 
-        # Skip SELECT queries
-        if query.lower().startswith('select'):
+        # Only care for DELETE, INSERT and UPDATE queries
+        statement = classify(query)
+        if statement is None:
             return
+        statement, table = statement
 
-        try:
-            # FIXME: This is extremely time-consuming (failover.status)
-            from freenasUI.middleware.notifier import notifier
-            if not (
-                hasattr(notifier, 'failover_status') and
-                notifier().failover_status() == 'MASTER'
-            ):
-                return
-        except:
+        if failover_status.get() != 'MASTER':
             return
 
-        parse = sqlparse.parse(query)
-        for p in parse:
-
-            # Only care for DELETE, INSERT and UPDATE queries
-            if p.tokens[0].normalized not in ('DELETE', 'INSERT', 'UPDATE'):
-                continue
-
-            cparams = list(params)
-            if p.tokens[0].normalized == 'INSERT':
-
-                into = p.token_next_by(m=(sqlparse.tokens.Keyword, 'INTO'))
-                if not into:
-                    continue
+        sql = query
+        cparams = list(params) if params is not None else []
+        if table in NO_SYNC_MAP:
+            no_sync = NO_SYNC_MAP[table]
+            if statement != 'UPDATE' or not no_sync or 'fields' not in no_sync:
+                return
+            sql, cparams = self._strip_no_sync_fields(query, cparams, no_sync)
+            if sql is None:
+                return
+            if params is not None:
+                sql = self.convert_query(sql)
 
-                next_ = p.token_next(into[0])
+        # Within a transaction the queries are waited for on commit
+        db = getattr(self, 'db', None)
+        Replicator.get().put(
+            sql, cparams, wait=execute_sync and not (db and db.in_atomic_block),
+        )
 
-                if next_[1].value in NO_SYNC_MAP:
-                    continue
+    def _strip_no_sync_fields(self, query, cparams, no_sync):
+        """
+        Remove the fields not to be synced from an UPDATE query.
 
-            elif p.tokens[0].normalized == 'DELETE':
+        Returns the new query and params, query is None if there is nothing
+        left to update.
+        """
+        for p in sqlparse.parse(query):
 
-                from_ = p.token_next_by(m=(sqlparse.tokens.Keyword, 'FROM'))
-                if not from_:
-                    continue
+            set_ = p.token_next_by(m=(sqlparse.tokens.Keyword, 'SET'))
+            if not set_:
+                return None, cparams
 
-                next_ = p.token_next(from_[0])
+            next_ = p.token_next(set_[0])
+            if not next_:
+                return None, cparams
 
-                if next_[1].value in NO_SYNC_MAP:
-                    continue
+            lookup = []
+            if issubclass(
+                next_[1].__class__, sqlparse.sql.IdentifierList
+            ):
+                lookup = list(next_[1].get_sublists())
+            elif issubclass(next_[1].__class__, sqlparse.sql.Comparison):
+                lookup = [next_[1]]
 
-            elif p.tokens[0].normalized == 'UPDATE':
+            # Get all placeholders from the query (%s or ?)
+            placeholders = [a for a in p.flatten() if a.value in ('%s', '?')]
 
-                name = p.token_next(0)[1].value
-                no_sync = NO_SYNC_MAP.get(name)
-                # Skip if table is in set to not to sync and has no attrs
-                if no_sync is None and name in NO_SYNC_MAP:
-                    continue
+            # Remember correspondent cparams to delete
+            delete_idx = []
 
-                set_ = p.token_next_by(m=(sqlparse.tokens.Keyword, 'SET'))
-                if not set_:
-                    continue
+            for l in lookup:
 
-                next_ = p.token_next(set_[0])
-                if not next_:
+                if l.value not in no_sync['fields']:
                     continue
 
-                if no_sync is None:
-                    lookup = []
-                else:
-
-                    if 'fields' not in no_sync:
-                        continue
-
-                    if issubclass(
-                        next_[1].__class__, sqlparse.sql.IdentifierList
-                    ):
-                        lookup = list(next_[1].get_sublists())
-                    elif issubclass(next_[1].__class__, sqlparse.sql.Comparison):
-                        lookup = [next_[1]]
-
-                    # Get all placeholders from the query (%s or ?)
-                    placeholders = [a for a in p.flatten() if a.value in ('%s', '?')]
-
-                # Remember correspondent cparams to delete
-                delete_idx = []
-
-                for l in lookup:
-
-                    if l.value not in no_sync['fields']:
-                        continue
-
-                    # Remove placeholder from the params
-                    try:
-                        idx = placeholders.index(l.tokens[-1])
-                        if cparams:
-                            delete_idx.append(idx)
-                    except ValueError:
-                        pass
-
-                    # If it is a list we must also remove the comma around it
-                    t_index = l.parent.token_index(l)
-                    prev_ = l.parent.token_prev(t_index)
-                    next_ = l.parent.token_next(t_index)
-                    if next_ and issubclass(
-                        next_[1].__class__, sqlparse.sql.Token
-                    ) and next_[1].value == ',':
-                        del l.parent.tokens[next_[0]]
-                    elif prev_ and issubclass(
-                        prev_[1].__class__, sqlparse.sql.Token
-                    ) and prev_[1].value == ',':
-                        del l.parent.tokens[prev_[0]]
-                    del l.parent.tokens[l.parent.token_index(l)]
-
-                delete_idx.sort(reverse=True)
-                for i in delete_idx:
-                    del cparams[i]
-
-            if params is not None:
-                sql = self.convert_query(str(p))
-            else:
-                sql = str(p)
-            # Actually try to run the query on the remote side within a thread
-            rsr = RunSQLRemote(sql=sql, params=cparams)
-            rsr.start()
-            if execute_sync:
-                rsr.join()
+                # Remove placeholder from the params
+                try:
+                    idx = placeholders.index(l.tokens[-1])
+                    if cparams:
+                        delete_idx.append(idx)
+                except ValueError:
+                    pass
+
+                # If it is a list we must also remove the comma around it
+                t_index = l.parent.token_index(l)
+                prev_ = l.parent.token_prev(t_index)
+                next_ = l.parent.token_next(t_index)
+                if next_ and issubclass(
+                    next_[1].__class__, sqlparse.sql.Token
+                ) and next_[1].value == ',':
+                    del l.parent.tokens[next_[0]]
+                elif prev_ and issubclass(
+                    prev_[1].__class__, sqlparse.sql.Token
+                ) and prev_[1].value == ',':
+                    del l.parent.tokens[prev_[0]]
+                del l.parent.tokens[l.parent.token_index(l)]
+
+            delete_idx.sort(reverse=True)
+            for i in delete_idx:
+                del cparams[i]
+
+            return str(p), cparams
+        return None, cparams
 
     def locked_retry(self, method, *args, **kwargs):
         """
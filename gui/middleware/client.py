@@ -1,14 +1,145 @@
 from middlewared.client import CallTimeout, Client, ClientException
 
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger('middleware.client')
+
+
+class PooledClient(Client):
+    """
+    Client handed out by ClientPool.
+
+    It remembers whether it picked up state the server keeps per session,
+    an authentication or an event subscription (which job calls make), so
+    such a connection is closed instead of being handed to someone else.
+    """
+
+    SESSION_METHODS = ('auth.login', 'auth.token')
+
+    def __init__(self, *args, **kwargs):
+        self.session_changed = False
+        super(PooledClient, self).__init__(*args, **kwargs)
+
+    def call(self, method, *params, **kwargs):
+        if method in self.SESSION_METHODS:
+            self.session_changed = True
+        return super(PooledClient, self).call(method, *params, **kwargs)
+
+    def call_many(self, calls, *args, **kwargs):
+        if any(call[0] in self.SESSION_METHODS for call in calls):
+            self.session_changed = True
+        return super(PooledClient, self).call_many(calls, *args, **kwargs)
+
+    def subscribe(self, name, callback):
+        self.session_changed = True
+        return super(PooledClient, self).subscribe(name, callback)
+
+
+class ClientPool(object):
+    """
+    Thread-safe pool of persistent middlewared connections.
+
+    Opening a Client means a new websocket, protocol handshake, server side
+    authentication and a reader thread, so connections are kept open and
+    handed out again on the next `with client as c:`.
+
+    Connections which picked up session state (see PooledClient) are not
+    kept.
+
+    Only idle connections are bounded: a borrower finding none idle always
+    gets a new connection, so there may be more than `maxsize` open while
+    many threads use the pool at once. The extra ones are closed when given
+    back.
+
+    Arguments:
+       :maxsize(int): maximum number of idle connections kept open
+       :keepalive(int): seconds a connection may sit idle before it is
+                        pinged to make sure it is still usable
+    """
+
+    def __init__(self, maxsize=8, keepalive=30):
+        self.maxsize = maxsize
+        self.keepalive = keepalive
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _pop_idle(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Websockets and their reader threads do not survive a fork,
+                # the child has to open its own connections.
+                self._idle = []
+                self._pid = os.getpid()
+            if self._idle:
+                return self._idle.pop()
+        return None, None
+
+    def get(self):
+        while True:
+            c, last_used = self._pop_idle()
+            if c is None:
+                return PooledClient()
+            if c.closed:
+                continue
+            if time.monotonic() - last_used > self.keepalive:
+                try:
+                    alive = c.ping(timeout=5)
+                except Exception:
+                    alive = False
+                if not alive:
+                    self._close(c)
+                    continue
+            return c
+
+    def put(self, c, discard=False):
+        if not discard and not c.closed and not c.session_changed:
+            with self._lock:
+                if self._pid == os.getpid() and len(self._idle) < self.maxsize:
+                    self._idle.append((c, time.monotonic()))
+                    return
+        self._close(c)
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for c, last_used in idle:
+            self._close(c)
+
+    def _close(self, c):
+        try:
+            c.close()
+        except Exception:
+            log.debug('Failed to close middleware connection', exc_info=True)
+
 
 class Connection(object):
 
+    def __init__(self, pool=None):
+        self.pool = pool or ClientPool()
+        self._local = threading.local()
+
     def __enter__(self):
-        self.client = Client()
-        return self.client
+        # `with client as c:` blocks may be nested within the same thread
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        c = self.pool.get()
+        stack.append(c)
+        return c
 
     def __exit__(self, typ, value, traceback):
-        self.client.close()
+        c = self._local.stack.pop()
+        # A timed out call may still be answered later and any other error
+        # that is not a regular method error may have left the websocket in
+        # an unknown state, so do not give that connection back.
+        discard = typ is not None and (
+            issubclass(typ, CallTimeout) or not issubclass(typ, ClientException)
+        )
+        self.pool.put(c, discard=discard)
         if typ is not None:
             raise
 
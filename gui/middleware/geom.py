@@ -0,0 +1,306 @@
+# Copyright (c) 2017 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+"""
+Shared, indexed model of the GEOM topology (kern.geom.confxml).
+
+The XML is parsed once and hash indexes are built in a single pass so
+lookups by geom name, disk ident, lunid, partition rawuuid and label do not
+have to scan the whole tree with XPath.
+
+The model is cached per process. middlewared invalidates it whenever devd
+reports a GEOM/DEVFS change (see `watch`), other processes fall back to
+a short expiration time. Code changing GEOM itself must call `invalidate`.
+"""
+from collections import defaultdict
+import re
+import threading
+import time
+
+from lxml import etree
+import sysctl
+
+# How long the topology is trusted in processes not fed by devd events
+CACHE_TIMEOUT = 5
+
+RE_GEOM_CMD = re.compile(
+    r'^\s*\(?\s*(/s?bin/)?(camcontrol|dd|geli|geom|glabel|gmirror|gmultipath|gnop|gpart|mdconfig)\b'
+)
+
+RE_IDENTIFIER = re.compile(r'\{(?P<type>.+?)\}(?P<value>.+)')
+# freebsd-zfs GPT partition type
+ZFS_PART_RAWTYPE = '516e7cba-6ecf-11d6-8ff8-00022d09712b'
+
+_lock = threading.Lock()
+_topology = None
+_watched = False
+
+
+def _normalize(value):
+    return ' '.join(value.split())
+
+
+class GeomTopology(object):
+
+    def __init__(self, xml):
+        self.doc = etree.fromstring(xml)
+        self.created = time.monotonic()
+
+        # (class name, geom name) -> geom element
+        self.geoms = {}
+        # class name -> [geom element]
+        self.geoms_by_class = defaultdict(list)
+        # provider id -> provider element
+        self.providers = {}
+        # provider id -> (geom name, class name)
+        self.provider_owner = {}
+        # provider id -> [geom element] consuming it
+        self.consumers = defaultdict(list)
+        # (class name, provider name) -> geom element
+        self.provider_geom = {}
+        # DISK lookups, first match wins as with XPath
+        self.disk_by_ident = {}
+        self.disk_by_normalized_ident = {}
+        self.disk_by_ident_lunid = {}
+        # PART lookups
+        self.part_disks_by_rawuuid = defaultdict(list)
+        self.part_rawuuid_by_provider = {}
+        self.part_by_type = {}
+
+        self.serials = None
+
+        for klass in self.doc.iterfind('class'):
+            cname = klass.findtext('name')
+            for geom in klass.iterfind('geom'):
+                gname = geom.findtext('name')
+                self.geoms.setdefault((cname, gname), geom)
+                self.geoms_by_class[cname].append(geom)
+
+                for consumer in geom.iterfind('consumer'):
+                    provider = consumer.find('provider')
+                    if provider is not None:
+                        self.consumers[provider.get('ref')].append(geom)
+
+                for provider in geom.iterfind('provider'):
+                    pid = provider.get('id')
+                    pname = provider.findtext('name')
+                    self.providers[pid] = provider
+                    self.provider_owner[pid] = (gname, cname)
+                    self.provider_geom.setdefault((cname, pname), geom)
+
+                    config = provider.find('config')
+                    if config is None:
+                        continue
+                    if cname == 'DISK':
+                        ident = config.findtext('ident')
+                        if ident is not None:
+                            self.disk_by_ident.setdefault(ident, gname)
+                            self.disk_by_normalized_ident.setdefault(_normalize(ident), gname)
+                            self.disk_by_ident_lunid.setdefault(
+                                '{}_{}'.format(ident, config.findtext('lunid') or ''), gname
+                            )
+                    elif cname == 'PART':
+                        rawuuid = config.findtext('rawuuid')
+                        if rawuuid is not None:
+                            self.part_disks_by_rawuuid[rawuuid].append(gname)
+                            self.part_rawuuid_by_provider.setdefault(pname, rawuuid)
+                        ptype = config.findtext('type')
+                        if ptype is not None:
+                            self.part_by_type.setdefault((gname, ptype), pname)
+
+    def geom_by_name(self, klass, name):
+        return self.geoms.get((klass, name))
+
+    def geom_names(self, klass):
+        return [g.findtext('name') for g in self.geoms_by_class.get(klass, [])]
+
+    def provider_names(self, klass, name):
+        geom = self.geoms.get((klass, name))
+        if geom is None:
+            return []
+        return [p.findtext('name') for p in geom.iterfind('provider')]
+
+    def consumed_provider(self, geom):
+        """Provider id consumed by `geom`, if any"""
+        provider = geom.find('consumer/provider')
+        if provider is None:
+            return None
+        return provider.get('ref')
+
+    def label_to_disk(self, name):
+        """
+        Given a label (geom label or disk partition) find out the disk name
+        """
+        geom = self.provider_geom.get(('LABEL', name))
+        if geom is None:
+            geom = self.geoms.get(('DEV', name))
+        if geom is None:
+            return None
+        owner = self.provider_owner.get(self.consumed_provider(geom))
+        if owner is None:
+            return None
+        disk, klass = owner
+        if klass == 'ELI':
+            return self.label_to_disk(disk.replace('.eli', ''))
+        return disk
+
+    def label_geom_name(self, provider_name):
+        """Name of the LABEL geom providing `provider_name` (e.g. gptid/...)"""
+        geom = self.provider_geom.get(('LABEL', provider_name))
+        if geom is None:
+            return None
+        return geom.findtext('name')
+
+    def disk_by_rawuuid(self, rawuuid):
+        for name in self.part_disks_by_rawuuid.get(rawuuid, []):
+            if not name.startswith('label'):
+                return name
+        return None
+
+    def identifier_to_device(self, ident):
+        """
+        Translate a disk identifier ({type}value) to a device name.
+
+        Serials not reported to GEOM cannot be resolved here, callers may
+        fall back to asking the disks directly (see `serials`).
+        """
+        search = RE_IDENTIFIER.search(ident or '')
+        if not search:
+            return None
+        tp = search.group('type')
+        value = search.group('value')
+        if tp == 'uuid':
+            return self.disk_by_rawuuid(value)
+        elif tp == 'label':
+            return self.label_geom_name(value)
+        elif tp == 'serial':
+            return (
+                self.disk_by_ident.get(value) or
+                self.disk_by_normalized_ident.get(_normalize(value))
+            )
+        elif tp == 'serial_lunid':
+            return self.disk_by_ident_lunid.get(value)
+        elif tp == 'devicename':
+            if ('DEV', value) in self.geoms:
+                return value
+            return None
+        raise NotImplementedError(tp)
+
+    def disk_info(self, name):
+        """ident, lunid and mediasize of the DISK geom `name`"""
+        geom = self.geoms.get(('DISK', name))
+        if geom is None:
+            return None
+        provider = geom.find('provider')
+        if provider is None:
+            return None
+        mediasize = provider.findtext('mediasize')
+        return {
+            'ident': provider.findtext('config/ident') or '',
+            'lunid': provider.findtext('config/lunid') or '',
+            'mediasize': int(mediasize) if mediasize else 0,
+        }
+
+    def device_to_identifier(self, name, serial=None):
+        """
+        Unique identifier for the device `name`, see disk.device_to_identifier.
+
+        `serial` is the serial reported by the disk itself, only used when
+        GEOM does not know about it.
+        """
+        info = self.disk_info(name)
+        if info and info['ident']:
+            if info['lunid']:
+                return '{serial_lunid}%s_%s' % (info['ident'], info['lunid'])
+            return '{serial}%s' % info['ident']
+
+        if serial:
+            return '{serial}%s' % serial
+
+        geom = self.geoms.get(('PART', name))
+        if geom is not None:
+            for provider in geom.iterfind('provider'):
+                if (
+                    provider.findtext('name') == name and
+                    provider.findtext('config/rawtype') == ZFS_PART_RAWTYPE
+                ):
+                    return '{uuid}%s' % provider.findtext('config/rawuuid')
+
+        geom = self.geoms.get(('LABEL', name))
+        if geom is not None:
+            provider = geom.find('provider')
+            if provider is not None:
+                return '{label}%s' % provider.findtext('name')
+
+        if ('DEV', name) in self.geoms:
+            return '{devicename}%s' % name
+
+        return ''
+
+    def part_type_from_device(self, name, device):
+        return self.part_by_type.get((device, 'freebsd-%s' % name), '')
+
+    def geoms_consuming(self, provider_id):
+        """All geoms depending on the provider `provider_id`, recursively"""
+        geoms = []
+        for geom in self.consumers.get(provider_id, []):
+            geoms.append(geom)
+            for provider in geom.iterfind('provider'):
+                geoms.extend(self.geoms_consuming(provider.get('id')))
+        return geoms
+
+
+def watch():
+    """
+    Flag this process as being notified of every GEOM change through
+    `invalidate`, so the cached topology no longer expires on its own.
+    """
+    global _watched
+    _watched = True
+
+
+def invalidate():
+    global _topology
+    with _lock:
+        _topology = None
+
+
+def invalidate_for_command(command):
+    """Invalidate the topology if `command` is a tool known to change GEOM"""
+    if isinstance(command, (list, tuple)):
+        command = ' '.join(command)
+    if RE_GEOM_CMD.match(command):
+        invalidate()
+
+
+def get_topology():
+    global _topology
+    with _lock:
+        topology = _topology
+        if topology is not None and (
+            _watched or time.monotonic() - topology.created < CACHE_TIMEOUT
+        ):
+            return topology
+        topology = _topology = GeomTopology(sysctl.filter('kern.geom.confxml')[0].value)
+        return topology
@@ -44,7 +44,11 @@ class Multipath(object):
             devs.append(consumer.devname)
         return devs
 
-    def __init__(self, doc, xmlnode):
+    def __init__(self, doc, xmlnode, providers=None):
+        """
+        Arguments:
+           :providers(dict): optional index of provider elements by id
+        """
         self.name = xmlnode.xpath("./name")[0].text
         self.devname = "multipath/%s" % self.name
         self._status = xmlnode.xpath("./config/State")[0].text
@@ -52,7 +56,10 @@ class Multipath(object):
         for consumer in xmlnode.xpath("./consumer"):
             status = consumer.xpath("./config/State")[0].text
             provref = consumer.xpath("./provider/@ref")[0]
-            prov = doc.xpath("//provider[@id = '%s']" % provref)[0]
+            if providers is not None:
+                prov = providers[provref]
+            else:
+                prov = doc.xpath("//provider[@id = '%s']" % provref)[0]
             self.consumers.append(Consumer(status, prov))
 
         self.__xml = xmlnode
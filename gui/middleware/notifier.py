@@ -117,7 +117,7 @@ from freenasUI.common.warden import (Warden, WardenJail,
                                      WARDEN_TYPE_PLUGINJAIL,
                                      WARDEN_STATUS_RUNNING)
 from freenasUI.freeadmin.hook import HookMetaclass
-from freenasUI.middleware import zfs
+from freenasUI.middleware import geom, zfs
 from freenasUI.middleware.client import client, ClientException
 from freenasUI.middleware.encryption import random_wipe
 from freenasUI.middleware.exceptions import MiddlewareError
@@ -128,6 +128,22 @@ RE_DSKNAME = re.compile(r'^([a-z]+)([0-9]+)$')
 log = logging.getLogger('middleware.notifier')
 
 
+class GeomPopen(Popen):
+    """
+    Popen of a command changing GEOM, invalidating the topology once it is
+    done so a topology read while it ran is not kept.
+    """
+
+    def __init__(self, notifier, *args, **kwargs):
+        self._notifier = notifier
+        super(GeomPopen, self).__init__(*args, **kwargs)
+
+    def wait(self, *args, **kwargs):
+        rv = super(GeomPopen, self).wait(*args, **kwargs)
+        self._notifier._geom_invalidate()
+        return rv
+
+
 class notifier(metaclass=HookMetaclass):
 
     from grp import getgrnam as ___getgrnam
@@ -138,6 +154,7 @@ class notifier(metaclass=HookMetaclass):
 
     def _system(self, command):
         log.debug("Executing: %s", command)
+        self._geom_invalidate_for(command)
         # TODO: python's signal class should be taught about sigprocmask(2)
         # This is hacky hack to work around this issue.
         libc = ctypes.cdll.LoadLibrary("libc.so.7")
@@ -158,11 +175,13 @@ class notifier(metaclass=HookMetaclass):
             ret = p.returncode
         finally:
             libc.sigprocmask(signal.SIGQUIT, pomask, None)
+            self._geom_invalidate_for(command)
         log.debug("Executed: %s -> %s", command, ret)
         return ret
 
     def _system_nolog(self, command):
         log.debug("Executing: %s", command)
+        self._geom_invalidate_for(command)
         # TODO: python's signal class should be taught about sigprocmask(2)
         # This is hacky hack to work around this issue.
         libc = ctypes.cdll.LoadLibrary("libc.so.7")
@@ -179,12 +198,16 @@ class notifier(metaclass=HookMetaclass):
             retval = p.returncode
         finally:
             libc.sigprocmask(signal.SIGQUIT, pomask, None)
+            self._geom_invalidate_for(command)
         log.debug("Executed: %s; returned %d", command, retval)
         return retval
 
     def _pipeopen(self, command, logger=log):
         if logger:
             logger.debug("Popen()ing: %s", command)
+        if geom.RE_GEOM_CMD.match(command):
+            self._geom_invalidate()
+            return GeomPopen(self, command, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=True, close_fds=True, encoding='utf8')
         return Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=True, close_fds=True, encoding='utf8')
 
     def _pipeerr(self, command, good_status=0):
@@ -568,13 +591,7 @@ class notifier(metaclass=HookMetaclass):
             self.__geli_delkey(dev, slot, force)
 
     def geli_is_decrypted(self, dev):
-        doc = self._geom_confxml()
-        geom = doc.xpath("//class[name = 'ELI']/geom[name = '%s.eli']" % (
-            dev,
-        ))
-        if geom:
-            return True
-        return False
+        return self._geom_topology().geom_by_name('ELI', '%s.eli' % dev) is not None
 
     def geli_attach_single(self, dev, key, passphrase=None, skip_existing=False):
         if skip_existing or not os.path.exists("/dev/%s.eli" % dev):
@@ -686,7 +703,7 @@ class notifier(metaclass=HookMetaclass):
                                  devname=disk,
                                  swapsize=swapsize)
 
-        self.__confxml = None  # Make sure to invalidate cache
+        self._geom_invalidate()  # Make sure to invalidate cache
         doc = self._geom_confxml()
         for disk in disks:
             devname = self.part_type_from_device('zfs', disk)
@@ -904,15 +921,13 @@ class notifier(metaclass=HookMetaclass):
             user = repl.repl_remote.ssh_remote_dedicateduser
         else:
             user = 'root'
-        proc = self._pipeopen('/usr/local/bin/ssh -i /data/ssh/replication -o ConnectTimeout=3 -o BatchMode=yes -o StrictHostKeyChecking=yes -p %s "%s"@"%s" "zfs list -Ht snapshot -o name"' % (
-            repl.repl_remote.ssh_remote_port,
-            user,
-            repl.repl_remote.ssh_remote_hostname,
-        ))
-        data = proc.communicate()[0]
-        if proc.returncode != 0:
-            return []
-        return data.strip('\n').split('\n')
+        with client as c:
+            return c.call(
+                'zfs.snapshot_index.remote_snapshots',
+                repl.repl_remote.ssh_remote_hostname,
+                repl.repl_remote.ssh_remote_port,
+                user,
+            )
 
     def destroy_zfs_dataset(self, path, recursive=False):
         retval = None
@@ -930,6 +945,7 @@ class notifier(metaclass=HookMetaclass):
                 zfsproc = self._pipeopen("zfs destroy '%s'" % (path))
             retval = zfsproc.communicate()[1]
             if zfsproc.returncode == 0:
+                self._snapshot_index_refresh([path])
                 from freenasUI.storage.models import Task, Replication
                 Task.objects.filter(task_filesystem=path).delete()
                 Replication.objects.filter(repl_filesystem=path).delete()
@@ -950,6 +966,8 @@ class notifier(metaclass=HookMetaclass):
             str(name),
         ))
         retval = zfsproc.communicate()[1]
+        if zfsproc.returncode == 0:
+            self._snapshot_index_refresh([name])
         return retval
 
     def __destroy_zfs_volume(self, volume):
@@ -991,7 +1009,7 @@ class notifier(metaclass=HookMetaclass):
         if to_label == '':
             raise MiddlewareError('freebsd-zfs partition could not be found')
 
-        self.__confxml = None  # Clear cache
+        self._geom_invalidate()  # Clear cache
         doc = self._geom_confxml()
         uuid = doc.xpath(
             "//class[name = 'PART']"
@@ -2440,6 +2458,7 @@ class notifier(metaclass=HookMetaclass):
         elif fstype == 'EXT2FS':
             p1 = Popen(["/usr/local/sbin/tune2fs", "-L", label, dev], stdin=PIPE, stdout=PIPE)
         elif fstype is None:
+            self._geom_invalidate()
             p1 = Popen(["/sbin/geom", "label", "label", label, dev], stdin=PIPE, stdout=PIPE)
         else:
             return False, 'Unknown fstype %r' % fstype
@@ -2449,11 +2468,7 @@ class notifier(metaclass=HookMetaclass):
         return False, err
 
     def disk_check_clean(self, disk):
-        doc = self._geom_confxml()
-        search = doc.xpath("//class[name = 'PART']/geom[name = '%s']" % disk)
-        if len(search) > 0:
-            return False
-        return True
+        return self._geom_topology().geom_by_name('PART', disk) is None
 
     def detect_volumes(self, extra=None):
         """
@@ -2741,6 +2756,31 @@ class notifier(metaclass=HookMetaclass):
             raise MiddlewareError('Unable to scrub %s: %s' % (name, stderr))
         return True
 
+    def _snapshot_replication(self, fs, name, replications):
+        """
+        'OK' if the snapshot `fs`@`name` is found on the remote side of one
+        of the `replications` (task -> remote snapshot names)
+        """
+        replication = None
+        for repl, snaps in replications.items():
+            if not (
+                fs == repl.repl_filesystem or (
+                    repl.repl_userepl and fs.startswith(repl.repl_filesystem + '/')
+                )
+            ):
+                continue
+            # Make sure remote snapshot is checked correctly
+            # when destination is root dataset
+            if '/' not in repl.repl_zfs:
+                replace = '{}/{}'.format(repl.repl_zfs, repl.repl_filesystem.rsplit('/')[-1])
+            else:
+                replace = repl.repl_zfs
+            remotename = '%s@%s' % (fs.replace(repl.repl_filesystem, replace), name)
+            if remotename in snaps:
+                replication = 'OK'
+                # TODO: Multiple replication tasks
+        return replication
+
     def zfs_snapshot_list(self, path=None, replications=None, sort=None, system=False):
         from freenasUI.storage.models import Volume
         fsinfo = dict()
@@ -2788,25 +2828,7 @@ class notifier(metaclass=HookMetaclass):
                 except:
                     snaplist = []
                     mostrecent = True
-                replication = None
-                for repl in replications:
-                    if not (
-                        fs == repl.repl_filesystem or (
-                            repl.repl_userepl and fs.startswith(repl.repl_filesystem + '/')
-                        )
-                    ):
-                        continue
-                    snaps = replications[repl]
-                    # Make sure remote snapshot is checked correctly
-                    # when destination is root dataset
-                    if '/' not in repl.repl_zfs:
-                        replace = '{}/{}'.format(repl.repl_zfs, repl.repl_filesystem.rsplit('/')[-1])
-                    else:
-                        replace = repl.repl_zfs
-                    remotename = '%s@%s' % (fs.replace(repl.repl_filesystem, replace), name)
-                    if remotename in snaps:
-                        replication = 'OK'
-                        # TODO: Multiple replication tasks
+                replication = self._snapshot_replication(fs, name, replications)
 
                 snaplist.insert(0, zfs.Snapshot(
                     name=name,
@@ -2821,6 +2843,47 @@ class notifier(metaclass=HookMetaclass):
                 fsinfo[fs] = snaplist
         return fsinfo
 
+    def zfs_snapshot_query(self, options=None, replications=None, system=False):
+        """
+        Query a range of snapshots from the middleware snapshot index, see
+        zfs.snapshot_index.query for `options`.
+
+        Returns the number of matching snapshots and a list of zfs.Snapshot
+        """
+        from freenasUI.storage.models import Volume
+        options = dict(options or {})
+        options.setdefault('pools', [o.vol_name for o in Volume.objects.all()])
+        if system is False:
+            basename = self.system_dataset_settings()[1]
+            if basename:
+                options['exclude'] = options.get('exclude', []) + [basename]
+
+        with client as c:
+            result = c.call('zfs.snapshot_index.query', options)
+
+        snapshots = []
+        for snap in result['snapshots']:
+            snapshots.append(zfs.Snapshot(
+                name=snap['snapshot'],
+                filesystem=snap['dataset'],
+                used=snap['used'],
+                refer=snap['referenced'],
+                mostrecent=snap['mostrecent'],
+                parent_type=snap['parent_type'],
+                replication=self._snapshot_replication(
+                    snap['dataset'], snap['snapshot'], replications or {}
+                ),
+                vmsynced=snap['vmsynced'],
+            ))
+        return result['total'], snapshots
+
+    def _snapshot_index_refresh(self, names):
+        try:
+            with client as c:
+                c.call('zfs.snapshot_index.refresh', names)
+        except Exception:
+            log.debug('Failed to refresh snapshot index', exc_info=True)
+
     def zfs_mksnap(self, dataset, name, recursive=False, vmsnaps_count=0):
         if vmsnaps_count > 0:
             vmflag = '-o freenas:vmsynced=Y '
@@ -2833,6 +2896,7 @@ class notifier(metaclass=HookMetaclass):
         if p1.wait() != 0:
             err = p1.communicate()[1]
             raise MiddlewareError("Snapshot could not be taken: %s" % err)
+        self._snapshot_index_refresh([dataset])
         return True
 
     def zfs_clonesnap(self, snapshot, dataset):
@@ -2846,6 +2910,9 @@ class notifier(metaclass=HookMetaclass):
             snapshot,
         ))
         retval = zfsproc.communicate()[1]
+        if zfsproc.returncode == 0:
+            # Rolling back destroys snapshots taken afterwards
+            self._snapshot_index_refresh([snapshot])
         return retval
 
     def config_restore(self):
@@ -3282,110 +3349,65 @@ class notifier(metaclass=HookMetaclass):
         return None
 
     def __init__(self):
-        self.__confxml = None
+        self.__geom = None
 
     def __del__(self):
-        self.__confxml = None
+        self.__geom = None
+
+    def _geom_invalidate(self):
+        self.__geom = None
+        geom.invalidate()
+
+    def _geom_invalidate_for(self, command):
+        """
+        Called before and after running `command`: the topology may be read
+        again by another thread while it runs.
+        """
+        if geom.RE_GEOM_CMD.match(command):
+            self._geom_invalidate()
+
+    def _geom_topology(self):
+        if self.__geom is None:
+            self.__geom = geom.get_topology()
+        return self.__geom
 
     def _geom_confxml(self):
-        from lxml import etree
-        if self.__confxml is None:
-            self.__confxml = etree.fromstring(self.sysctl('kern.geom.confxml'))
-        return self.__confxml
+        return self._geom_topology().doc
 
     def label_to_disk(self, name):
         """
         Given a label go through the geom tree to find out the disk name
         label = a geom label or a disk partition
         """
-        doc = self._geom_confxml()
-
-        # try to find the provider from GEOM_LABEL
-        search = doc.xpath("//class[name = 'LABEL']//provider[name = '%s']/../consumer/provider/@ref" % name)
-        if len(search) > 0:
-            provider = search[0]
-        else:
-            # the label does not exist, try to find it in GEOM DEV
-            search = doc.xpath("//class[name = 'DEV']/geom[name = '%s']//provider/@ref" % name)
-            if len(search) > 0:
-                provider = search[0]
-            else:
-                return None
-        search = doc.xpath("//provider[@id = '%s']/../name" % provider)
-        disk = search[0].text
-        if search[0].getparent().getparent().xpath("./name")[0].text in ('ELI', ):
-            return self.label_to_disk(disk.replace(".eli", ""))
-        return disk
+        return self._geom_topology().label_to_disk(name)
 
     def identifier_to_device(self, ident):
 
         if not ident:
             return None
 
-        doc = self._geom_confxml()
-
-        search = re.search(r'\{(?P<type>.+?)\}(?P<value>.+)', ident)
-        if not search:
-            return None
+        topology = self._geom_topology()
+        name = topology.identifier_to_device(ident)
+        if name or not ident.startswith('{serial}'):
+            return name
 
-        tp = search.group("type")
-        # We need to escape single quotes to html entity
-        value = search.group("value").replace("'", "%27")
-
-        if tp == 'uuid':
-            search = doc.xpath("//class[name = 'PART']/geom//config[rawuuid = '%s']/../../name" % value)
-            if len(search) > 0:
-                for entry in search:
-                    if not entry.text.startswith('label'):
-                        return entry.text
-            return None
-
-        elif tp == 'label':
-            search = doc.xpath("//class[name = 'LABEL']/geom//provider[name = '%s']/../name" % value)
-            if len(search) > 0:
-                return search[0].text
-            return None
-
-        elif tp == 'serial':
-            search = doc.xpath("//class[name = 'DISK']/geom/provider/config[ident = '%s']/../../name" % value)
-            if len(search) > 0:
-                return search[0].text
-            search = doc.xpath("//class[name = 'DISK']/geom/provider/config[normalize-space(ident) = normalize-space('%s')]/../../name" % value)
-            if len(search) > 0:
-                return search[0].text
+        # Disks not reporting their serial to GEOM are asked through
+        # smartctl, once per topology instead of once per lookup.
+        if topology.serials is None:
+            devnames = self.__get_disks()
             with client as c:
-                for devname in self.__get_disks():
-                    serial = c.call('disk.serial_from_device', devname)
-                    if serial == value:
-                        return devname
-            return None
-
-        elif tp == 'serial_lunid':
-            search = doc.xpath("//class[name = 'DISK']/geom/provider/config[concat(ident,'_',lunid) = '%s']/../../name" % value)
-            if len(search) > 0:
-                return search[0].text
-            return None
-
-        elif tp == 'devicename':
-            search = doc.xpath("//class[name = 'DEV']/geom[name = '%s']" % value)
-            if len(search) > 0:
-                return value
-            return None
-        else:
-            raise NotImplementedError
+                topology.serials = dict(zip(c.call_many([
+                    ('disk.serial_from_device', devname) for devname in devnames
+                ]), devnames))
+        return topology.serials.get(ident[len('{serial}'):])
 
     def part_type_from_device(self, name, device):
         """
         Given a partition a type and a disk name (adaX)
         get the first partition that matches the type
         """
-        doc = self._geom_confxml()
         # TODO get from MBR as well?
-        search = doc.xpath("//class[name = 'PART']/geom[name = '%s']//config[type = 'freebsd-%s']/../name" % (device, name))
-        if len(search) > 0:
-            return search[0].text
-        else:
-            return ''
+        return self._geom_topology().part_type_from_device(name, device)
 
     def zpool_parse(self, name):
         doc = self._geom_confxml()
@@ -3485,10 +3507,10 @@ class notifier(metaclass=HookMetaclass):
         Returns:
             A list of Multipath objects
         """
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
         return [
-            Multipath(doc=doc, xmlnode=geom)
-            for geom in doc.xpath("//class[name = 'MULTIPATH']/geom")
+            Multipath(doc=topology.doc, xmlnode=node, providers=topology.providers)
+            for node in topology.geoms_by_class.get('MULTIPATH', [])
         ]
 
     def _find_root_devs(self):
@@ -3564,25 +3586,12 @@ class notifier(metaclass=HookMetaclass):
         """
         Get _ALL_ geom nodes that depends on a given provider
         """
-        doc = self._geom_confxml()
-        geoms = []
-        for c in doc.xpath("//consumer/provider[@ref = '%s']" % (prvid, )):
-            geom = c.getparent().getparent()
-            if geom.tag != 'geom':
-                continue
-            geoms.append(geom)
-            for prov in geom.xpath('./provider'):
-                geoms.extend(self.__get_geoms_recursive(prov.attrib.get('id')))
-
-        return geoms
+        return self._geom_topology().geoms_consuming(prvid)
 
     def disk_get_consumers(self, devname):
-        doc = self._geom_confxml()
-        geom = doc.xpath("//class[name = 'DISK']/geom[name = '%s']" % (
-            devname,
-        ))
-        if geom:
-            provid = geom[0].xpath("./provider/@id")[0]
+        node = self._geom_topology().geom_by_name('DISK', devname)
+        if node is not None:
+            provid = node.xpath("./provider/@id")[0]
         else:
             raise ValueError("Unknown disk %s" % (devname, ))
         return self.__get_geoms_recursive(provid)
@@ -29,7 +29,7 @@ import logging
 import re
 import subprocess
 
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict
 from django.utils.translation import ugettext_lazy as _
 
 log = logging.getLogger('middleware.zfs')
@@ -867,20 +867,90 @@ def parse_status(name, doc, data):
     return pool
 
 
-def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
-             types=None):
+# (zfs property, attribute, type, dataset types it applies to)
+ZFS_LIST_PROPERTIES = (
+    ('available', 'avail', int, None),
+    ('used', 'used', int, None),
+    ('usedbysnapshots', 'usedsnap', int, None),
+    ('usedbydataset', 'usedds', int, None),
+    ('usedbyrefreservation', 'usedrefreserv', int, None),
+    ('usedbychildren', 'usedchild', int, None),
+    ('referenced', 'refer', int, None),
+    ('compression', 'compression', str, None),
+    ('dedup', 'dedup', str, None),
+    ('readonly', 'readonly', str, None),
+    ('org.freenas:description', 'description', str, None),
+    ('atime', 'atime', str, ('filesystem',)),
+    ('mountpoint', 'mountpoint', str, ('filesystem',)),
+    ('quota', 'quota', int, ('filesystem',)),
+    ('refquota', 'refquota', int, ('filesystem',)),
+    ('reservation', 'reservation', int, ('filesystem',)),
+    ('refreservation', 'refreservation', int, ('filesystem',)),
+    ('recordsize', 'recordsize', int, ('filesystem',)),
+    ('volsize', 'volsize', int, ('volume',)),
+)
+
+
+def _zfs_get(args):
     """
-    Return a dictionary that contains all ZFS dataset list and their
-    mountpoints
+    Run `zfs get` and yield (name, {property: (value, source)}) as soon as
+    every property of a dataset has been read, output is grouped by dataset.
+    """
+    zfsproc = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        encoding='utf8')
+    try:
+        name = None
+        props = None
+        for line in zfsproc.stdout:
+            data = line.rstrip('\n').split('\t')
+            if len(data) < 4:
+                continue
+            if data[0] != name:
+                if name is not None:
+                    yield name, props
+                name = data[0]
+                props = {}
+            props[data[1]] = (data[2], data[3])
+        if name is not None:
+            yield name, props
+    finally:
+        zfsproc.stdout.close()
+        if zfsproc.poll() is None:
+            # Generator was not consumed to the end
+            zfsproc.kill()
+        zfsproc.wait()
+
+
+def iter_zfs_list(path="", recursive=False, include_root=False, types=None,
+                  properties=None, sources=False):
+    """
+    Lazily yield ZFSDataset and ZFSVol objects, in `zfs get` order.
+
+    `properties` restricts the attributes retrieved from ZFS (e.g. ['used',
+    'avail']), the others are None. By default all of them are retrieved.
+
+    The local, default and inherit lists of datasets only name the
+    properties retrieved unless `sources` is set, which retrieves all ZFS
+    properties (`zfs get all`) to fill them in.
     """
+    types = types or ['filesystem', 'volume']
+    wanted = [
+        i for i in ZFS_LIST_PROPERTIES
+        if (properties is None or i[1] in properties) and (
+            i[3] is None or set(i[3]) & set(types)
+        )
+    ]
     args = [
         "/sbin/zfs",
         "get",
         "-p",
         "-H",
-        "-t", ",".join(types or ['filesystem', 'volume']),
+        "-t", ",".join(types),
         "-o", "name,property,value,source",
-        "all",
+        "all" if sources else ",".join(['type'] + [i[0] for i in wanted]),
     ]
     if recursive:
         args.insert(3, "-r")
@@ -888,75 +958,45 @@ def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
     if path:
         args.append(path)
 
-    zfsproc = subprocess.Popen(
-        args,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        encoding='utf8')
-
-    zfs_output, zfs_err = zfsproc.communicate()
-    zfs_output = zfs_output.split('\n')
-    zfsget = defaultdict(OrderedDict)
-    for line in zfs_output:
-        if not line:
-            continue
-        data = line.split('\t')
-        zfsget[data[0]][data[1]] = (data[2], data[3])
-
-    zfslist = ZFSList()
-    for path, props in zfsget.items():
-        names = path.split('/')
-        depth = len(names)
+    for path, props in _zfs_get(args):
         # root filesystem is not treated as dataset by us
-        if depth == 1 and not include_root:
+        if '/' not in path and not include_root:
             continue
 
+        _type = props['type'][0]
         zprops = {}
-        for pname, dname, ptype in (
-            ('available', 'avail', int),
-            ('used', 'used', int),
-            ('usedbysnapshots', 'usedsnap', int),
-            ('usedbydataset', 'usedds', int),
-            ('usedbyrefreservation', 'usedrefreserv', int),
-            ('usedbychildren', 'usedchild', int),
-            ('referenced', 'refer', int),
-            ('compression', 'compression', str),
-            ('dedup', 'dedup', str),
-            ('readonly', 'readonly', str),
-            ('org.freenas:description', 'description', str),
-        ):
-            if pname not in props:
-                zprops[dname] = None
+        for pname, dname, ptype, ptypes in wanted:
+            if ptypes is not None and _type not in ptypes:
                 continue
+            value, source = props.get(pname, ('-', '-'))
             if ptype is int:
-                if props[pname][0].isdigit():
-                    zprops[dname] = int(props[pname][0])
-                else:
-                    zprops[dname] = None
+                zprops[dname] = int(value) if value.isdigit() else None
+            elif value == '-' and source == '-':
+                # Unset user property
+                zprops[dname] = None
             else:
-                zprops[dname] = props[pname][0]
+                zprops[dname] = value
 
+        if sources:
+            sourced = props.items()
+        else:
+            sourced = [
+                (pname, props[pname]) for pname, dname, ptype, ptypes in wanted
+                if pname in props and (ptypes is None or _type in ptypes)
+            ]
         local_props = []
         default_props = []
         inherit_props = []
-        for k, v in props.items():
-            if v[1] == 'local':
-                local_props.append(k)
-            elif v[1] == 'default':
-                default_props.append(k)
-            elif v[1].startswith('inherited'):
-                inherit_props.append(k)
+        for pname, (value, source) in sourced:
+            if source == 'local':
+                local_props.append(pname)
+            elif source == 'default':
+                default_props.append(pname)
+            elif source.startswith('inherited'):
+                inherit_props.append(pname)
 
-        _type = props['type'][0]
         if _type == 'filesystem':
-            zprops['atime'] = props['atime'][0]
-            zprops['mountpoint'] = props['mountpoint'][0]
-            zprops['quota'] = int(props['quota'][0]) if props['quota'][0].isdigit() else None
-            zprops['refquota'] = int(props['refquota'][0]) if props['refquota'][0].isdigit() else None
-            zprops['reservation'] = int(props['reservation'][0]) if props['reservation'][0].isdigit() else None
-            zprops['refreservation'] = int(props['refreservation'][0]) if props['refreservation'][0].isdigit() else None
-            zprops['recordsize'] = int(props['recordsize'][0]) if props['recordsize'][0].isdigit() else None
-            item = ZFSDataset(
+            yield ZFSDataset(
                 path=path,
                 include_root=include_root,
                 props=zprops,
@@ -965,19 +1005,41 @@ def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
                 inherit=inherit_props,
             )
         elif _type == 'volume':
-            zprops['volsize'] = int(props['volsize'][0]) if props['volsize'][0].isdigit() else None
-            item = ZFSVol(
+            yield ZFSVol(
                 path=path,
                 props=zprops,
             )
         else:
             raise NotImplementedError
 
+
+def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
+             types=None, properties=None, sources=False):
+    """
+    Return a dictionary that contains all ZFS dataset list and their
+    mountpoints
+    """
+    zfslist = ZFSList()
+    # path -> node, parents are always listed before their children
+    nodes = {}
+    for item in iter_zfs_list(
+        path=path,
+        recursive=recursive,
+        include_root=include_root,
+        types=types,
+        properties=properties,
+        sources=sources,
+    ):
         if not hierarchical:
             zfslist.append(item)
             continue
 
-        parentds = zfslist.find(names, root=include_root)
+        parentds = None
+        parent = item.path
+        while parentds is None and '/' in parent:
+            parent = parent.rsplit('/', 1)[0]
+            parentds = nodes.get(parent)
+        nodes[item.path] = item
         if parentds:
             parentds.append(item)
         else:
@@ -987,13 +1049,15 @@ def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
 
 
 def list_datasets(path="", recursive=False, hierarchical=False,
-                  include_root=False):
+                  include_root=False, properties=None, sources=False):
     return zfs_list(
         path=path,
         recursive=recursive,
         hierarchical=hierarchical,
         include_root=include_root,
         types=["filesystem"],
+        properties=properties,
+        sources=sources,
     )
 
 
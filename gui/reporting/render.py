@@ -0,0 +1,248 @@
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+Rendering of the reporting graphs.
+
+Graphs are drawn by a bounded pool of persistent `rrdtool -` processes
+instead of forking rrdtool for every image, and the images are cached by
+the content they depend on: the graph arguments and the modification time
+of the RRD files they read, so a graph is only drawn again once collectd
+has written new data.
+"""
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import queue
+import re
+import subprocess
+import tempfile
+import threading
+
+log = logging.getLogger('reporting.render')
+
+RRDTOOL_PATH = '/usr/local/bin/rrdtool'
+# Number of rrdtool processes, i.e. graphs drawn at the same time
+RENDER_WORKERS = 4
+# Number of images kept
+RENDER_CACHE_SIZE = 256
+
+RE_DEF_PATH = re.compile(r'^DEF:[^=]+=(?P<path>.+):[^:]+:[A-Z]+$')
+
+
+class RenderError(Exception):
+    pass
+
+
+def _quote(arg):
+    """
+    Quote `arg` for the rrdtool pipe mode, which knows about quotes but not
+    about escaping them. Returns None if it cannot be done.
+    """
+    if '\n' in arg:
+        return None
+    if "'" not in arg:
+        return "'%s'" % arg
+    if '"' not in arg:
+        return '"%s"' % arg
+    return None
+
+
+class Renderer(object):
+    """
+    rrdtool running in pipe mode, drawing one graph at a time.
+    """
+
+    def __init__(self):
+        self.proc = subprocess.Popen(
+            [RRDTOOL_PATH, '-'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            close_fds=True,
+        )
+
+    @property
+    def alive(self):
+        return self.proc.poll() is None
+
+    def graph(self, path, args):
+        """
+        Draw the graph described by the quoted `args` to `path`
+        """
+        line = ' '.join(['graph', _quote(path)] + args) + '\n'
+        try:
+            self.proc.stdin.write(line.encode('utf8'))
+            self.proc.stdin.flush()
+        except OSError as e:
+            raise RenderError('rrdtool is gone: %s' % e)
+
+        # The image size and PRINT lines come before the status line
+        while True:
+            out = self.proc.stdout.readline()
+            if not out:
+                raise RenderError('rrdtool is gone')
+            if out.startswith(b'OK '):
+                return
+            if out.startswith(b'ERROR:'):
+                raise RenderError(out[6:].decode('utf8', 'ignore').strip())
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except Exception:
+            self.proc.kill()
+
+
+class RenderPool(object):
+    """
+    Up to `size` renderers shared by the request threads of this process.
+    """
+
+    def __init__(self, size=RENDER_WORKERS):
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._pid = os.getpid()
+
+    def _get(self):
+        if self._pid != os.getpid():
+            # Pipes to the parent renderers are not ours to use
+            self._idle = queue.LifoQueue()
+            self._pid = os.getpid()
+        try:
+            renderer = self._idle.get_nowait()
+        except queue.Empty:
+            return Renderer()
+        if not renderer.alive:
+            renderer.close()
+            return Renderer()
+        return renderer
+
+    def _fork(self, path, args):
+        proc = subprocess.Popen(
+            [RRDTOOL_PATH, 'graph', path] + args,
+            stdout=subprocess.PIPE,
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        err = proc.communicate()[1]
+        if proc.returncode != 0:
+            raise RenderError(err.decode('utf8', 'ignore').strip())
+
+    def render(self, args):
+        """
+        Image drawn by `rrdtool graph` given `args`
+        """
+        fd, path = tempfile.mkstemp(suffix='.png')
+        os.close(fd)
+        try:
+            quoted = [_quote(arg) for arg in args]
+            with self._slots:
+                try:
+                    if None in quoted or _quote(path) is None:
+                        self._fork(path, args)
+                    else:
+                        renderer = self._get()
+                        try:
+                            renderer.graph(path, quoted)
+                        finally:
+                            if renderer.alive:
+                                self._idle.put(renderer)
+                            else:
+                                renderer.close()
+                except RenderError as e:
+                    log.error("Failed to generate graph: %s", e)
+            with open(path, 'rb') as f:
+                return f.read()
+        finally:
+            try:
+                os.unlink(path)
+            except OSError as e:
+                log.warn("Failed to remove reporting temp file: %s", e)
+
+
+class RenderCache(object):
+    """
+    Least recently used images, by content key.
+    """
+
+    def __init__(self, size=RENDER_CACHE_SIZE):
+        self.size = size
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._images.get(key)
+            if data is not None:
+                self._images.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            self._images[key] = data
+            self._images.move_to_end(key)
+            while len(self._images) > self.size:
+                self._images.popitem(last=False)
+
+
+pool = RenderPool()
+cache = RenderCache()
+
+
+def graph_key(plugin, args):
+    """
+    Content key of the graph of `plugin` drawn with `args`
+    """
+    mtimes = []
+    for arg in args:
+        reg = RE_DEF_PATH.match(arg)
+        if not reg:
+            continue
+        try:
+            mtimes.append(os.stat(reg.group('path')).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return hashlib.sha1(repr((
+        plugin.name, plugin.identifier, plugin.unit, plugin.step, mtimes, args,
+    )).encode('utf8')).hexdigest()
+
+
+def render(plugin):
+    """
+    Returns:
+        tuple(str, bytes) - content key (suitable for an ETag) and image
+    """
+    args = plugin.get_graph_args()
+    key = graph_key(plugin, args)
+    data = cache.get(key)
+    if data is None:
+        data = pool.render(args)
+        if data:
+            cache.put(key, data)
+    return key, data
@@ -32,7 +32,7 @@ import subprocess
 
 from freenasUI.common.pipesubr import pipeopen
 from freenasUI.middleware.client import client
-from middlewared.utils import cache_with_autorefresh, filter_list
+from middlewared.utils import cache_with_autorefresh
 
 
 log = logging.getLogger('reporting.rrd')
@@ -121,25 +121,17 @@ class RRDBase(object, metaclass=RRDMeta):
     def get_identifiers(self):
         return None
 
-    def generate(self):
+    def get_graph_args(self):
         """
-        Call rrdgraph to generate the graph on a temp file
-
-        Returns:
-            str - path to the image
+        Arguments of `rrdtool graph` following the image path
         """
-
         starttime = '1%s' % (self.unit[0], )
         if self.step == 0:
             endtime = 'now'
         else:
             endtime = 'now-%d%s' % (self.step, self.unit[0], )
 
-        fh, path = tempfile.mkstemp()
         args = [
-            "/usr/local/bin/rrdtool",
-            "graph",
-            path,
             '--imgformat', self.imgformat,
             '--vertical-label', str(self.get_vertical_label()),
             '--title', str(self.get_title()),
@@ -148,6 +140,23 @@ class RRDBase(object, metaclass=RRDMeta):
             '--start', 'end-%s' % starttime, '-b', '1024',
         ]
         args.extend(self.graph())
+        return args
+
+    def generate(self):
+        """
+        Call rrdgraph to generate the graph on a temp file
+
+        Returns:
+            str - path to the image
+        """
+
+        fh, path = tempfile.mkstemp()
+        args = [
+            "/usr/local/bin/rrdtool",
+            "graph",
+            path,
+        ]
+        args.extend(self.get_graph_args())
         # rrdtool python is suffering from some sort of threading locking issue
         # See #3478
         # rrdtool.graph(*args)
@@ -775,16 +784,20 @@ class CTLPlugin(RRDBase):
 
 
 @cache_with_autorefresh(0, 5)
-def get_disks():
+def get_disk_descriptions():
+    """
+    Description of every disk by name, fetched with a single call and shared
+    by the titles of all the disk graphs.
+    """
     with client as c:
-        return c.call('disk.query')
+        return {disk['name']: disk['description'] for disk in c.call('disk.query')}
 
 
 class DiskBase():
     def get_disk_description(self, name):
         disk_desc = ''
         try:
-            disk_desc = filter_list(get_disks(), [('name', '=', name)], {'get': True})['description']
+            disk_desc = get_disk_descriptions().get(name)
         except BaseException as error:
             # it would be lame to fail just coz we could not get disk description
             # but lets log it
@@ -24,13 +24,13 @@
 #
 #####################################################################
 import logging
-import os
 
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
 from django.shortcuts import render
 
 from freenasUI.freeadmin.apppool import appPool
 from freenasUI.reporting import rrd
+from freenasUI.reporting.render import render as render_graph
 
 RRD_BASE_PATH = "/var/db/collectd/rrd/localhost"
 
@@ -79,6 +79,14 @@ def generic_graphs(request, names=None):
     if names is None:
         names = []
 
+    # Titles of the disk graphs need the disk descriptions, fetch all of
+    # them at once rather than as each graph is drawn
+    if any(name.startswith('disk') for name in names):
+        try:
+            rrd.get_disk_descriptions()
+        except Exception:
+            log.debug("Failed to prefetch disk descriptions", exc_info=True)
+
     graphs = []
     for name in names:
         graphs.extend(plugin2graphs(name))
@@ -106,18 +114,16 @@ def generate(request):
             step=step,
             identifier=identifier
         )
-        fd, path = plugin.generate()
-        with open(path, 'rb') as f:
-            data = f.read()
-
-        try:
-            os.unlink(path)
-            os.close(fd)
-        except OSError as e:
-            log.warn("Failed to remove reporting temp file: %s", e)
-
-        response = HttpResponse(data)
-        response['Content-type'] = 'image/png'
+        etag, data = render_graph(plugin)
+        etag = '"%s"' % etag
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(data)
+            response['Content-type'] = 'image/png'
+        response['ETag'] = etag
+        # Browsers must revalidate, the image changes as new data comes in
+        response['Cache-Control'] = 'no-cache'
         return response
     except Exception as e:
         log.debug("Failed to generate rrd graph: %s", e, exc_info=True)
@@ -1400,7 +1400,7 @@ class ZFSDatasetCreateForm(ZFSDatasetCommonForm):
         if os.path.exists(path):
             raise forms.ValidationError(_('The path %s already exists.') % path)
 
-        if len(zfs.list_datasets(path=full_dataset_name)) > 0:
+        if any(zfs.iter_zfs_list(path=full_dataset_name, properties=[])):
             msg = _("You already have a dataset with the same name")
             self._errors["dataset_name"] = self.error_class([msg])
             del cleaned_data["dataset_name"]
@@ -1766,7 +1766,7 @@ class ZVol_CreateForm(CommonZVol):
         full_zvol_name = "%s/%s" % (
             self.parentds,
             cleaned_data.get("zvol_name"))
-        if len(zfs.list_datasets(path=full_zvol_name)) > 0:
+        if any(zfs.iter_zfs_list(path=full_zvol_name, properties=[])):
             msg = _("You already have a dataset with the same name")
             self._errors["zvol_name"] = self.error_class([msg])
             del cleaned_data["zvol_name"]
@@ -25,6 +25,7 @@
 #####################################################################
 
 from datetime import time
+import json
 import pickle
 import logging
 import os
@@ -34,6 +35,7 @@ import subprocess
 
 from django.db import models
 from django.db.models import Q
+from django.template.defaultfilters import filesizeformat
 from django.utils.translation import ugettext as __, ugettext_lazy as _
 
 from freenasUI import choices
@@ -904,17 +906,27 @@ class Replication(Model):
         progressfile = '/tmp/.repl_progress_%d' % self.id
         if os.path.exists(progressfile):
             with open(progressfile, 'r') as f:
-                pid = int(f.read())
+                pid = int(f.readline())
+                try:
+                    progress = json.loads(f.readline())
+                except ValueError:
+                    progress = None
             title = notifier().get_proc_title(pid)
             if title:
                 reg = re.search(r'sending (\S+) \((\d+)%', title)
                 if reg:
-                    return _('Sending %(snapshot)s (%(percent)s%%)') % {
+                    status = _('Sending %(snapshot)s (%(percent)s%%)') % {
                         'snapshot': reg.groups()[0],
                         'percent': reg.groups()[1],
                     }
                 else:
-                    return _('Sending')
+                    status = _('Sending')
+                if progress:
+                    status += ', ' + _('%(sent)s sent at %(rate)s/s') % {
+                        'sent': filesizeformat(progress['bytes']),
+                        'rate': filesizeformat(progress['rate']),
+                    }
+                return status
         if self.repl_lastresult:
             return self.repl_lastresult['msg']
 
@@ -348,11 +348,14 @@ def volimport_progress(request):
     with client as c:
         job = c.call('pool.get_current_import_disk_job')
 
+    extra = job["progress"]["extra"] or {}
     return HttpResponse(json.dumps({
         "status": "finished" if job["state"] in ["SUCCESS", "FAILED", "ABORTED"] else job["progress"]["description"],
         "volume": job["arguments"][0],
-        "extra": job["progress"]["extra"],
+        "extra": extra.get("file"),
         "percent": job["progress"]["percent"],
+        "rate": extra.get("rate"),
+        "eta": extra.get("eta"),
     }), content_type='application/json')
 
 
@@ -1,13 +1,16 @@
-import pickle
 import datetime
 import hashlib
 import imp
+import json
 import logging
 import os
 import socket
 import subprocess
+import tempfile
+import threading
 import time
 
+from django.utils import translation
 from django.utils.translation import ugettext_lazy as _
 import pysnmp.hlapi
 import pysnmp.smi
@@ -24,6 +27,11 @@ from lxml import etree
 
 log = logging.getLogger('system.alert')
 
+# Maximum number of alert modules running at the same time
+ALERT_WORKERS = 8
+# Modules not even started after that many seconds are skipped for this run
+ALERT_RUN_TIMEOUT = 120
+
 
 def alert_node():
     from freenasUI.middleware.notifier import notifier
@@ -53,6 +61,8 @@ class BaseAlert(object, metaclass=BaseAlertMetaclass):
     interval = 0
     fire_once = False
     name = None
+    # Seconds the module may run before its previous results are used instead
+    timeout = 30
 
     def __init__(self, alert):
         self.alert = alert
@@ -138,6 +148,28 @@ class Alert(object):
     def getDatetime(self):
         return datetime.datetime.fromtimestamp(self._timestamp)
 
+    def __getstate__(self):
+        return {
+            'level': self._level,
+            'message': str(self._message),
+            'id': self._id,
+            'dismiss': self._dismiss,
+            'hardware': self._hardware,
+            'timestamp': self._timestamp,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        alert = cls(
+            state['level'],
+            state['message'],
+            id=state['id'],
+            dismiss=state['dismiss'],
+            hardware=state['hardware'],
+        )
+        alert.setTimestamp(state['timestamp'])
+        return alert
+
 
 class SnmpTrapSender:
     def __init__(self):
@@ -180,9 +212,106 @@ class SnmpTrapSender:
         return True
 
 
+class AlertModuleRun(object):
+    """
+    Run of a single alert module in its own (daemon) thread so a hung
+    module can be given up on without blocking the others.
+
+    The active language is per thread, `language` is activated in the
+    module thread so its messages are translated as in the caller.
+
+    A module holds one of the `semaphore` slots while it runs, until it
+    finishes or is given up on (see `abandon`).
+    """
+
+    def __init__(self, instance, semaphore, language=None):
+        self.instance = instance
+        self.semaphore = semaphore
+        self.language = language
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.abandoned = False
+        self.released = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(
+            target=self._run, name=f'alert-{instance.name}', daemon=True,
+        )
+
+    def _run(self):
+        from django.db import connection
+        if self.language:
+            translation.activate(self.language)
+        self.semaphore.acquire()
+        with self.lock:
+            if self.abandoned:
+                # Given up on before it could start
+                self.released = True
+                self.semaphore.release()
+                self.done.set()
+                return
+            self.started = time.monotonic()
+        try:
+            self.result = self.instance.run()
+        except Exception as e:
+            self.error = e
+            log.debug("Alert module '%s' failed: %s", self.instance, e, exc_info=True)
+        finally:
+            self.finished = time.monotonic()
+            # Every thread gets its own database connection
+            connection.close()
+            self._release()
+            self.done.set()
+
+    def _release(self):
+        with self.lock:
+            if not self.released:
+                self.released = True
+                self.semaphore.release()
+
+    def start(self):
+        self.thread.start()
+
+    def abandon(self):
+        """
+        Give up on the module once `wait` timed out. Its slot goes to the
+        other modules even though a hung module never returns, and it is
+        not run at all if it did not start yet.
+        """
+        with self.lock:
+            self.abandoned = True
+            if self.started is None:
+                return
+        self._release()
+
+    def wait(self, run_deadline):
+        """
+        Wait for the module until its own timeout (counted from the moment
+        it started) or `run_deadline` if it did not start yet.
+        """
+        while not self.done.is_set():
+            now = time.monotonic()
+            if self.started is not None:
+                deadline = self.started + self.instance.timeout
+            else:
+                deadline = run_deadline
+            if now >= deadline:
+                return False
+            self.done.wait(min(deadline - now, 1))
+        return True
+
+    @property
+    def duration(self):
+        if self.started is None:
+            return None
+        return (self.finished or time.monotonic()) - self.started
+
+
 class AlertPlugins(metaclass=HookMetaclass):
 
-    ALERT_FILE = '/var/tmp/alert'
+    ALERT_FILE = '/var/tmp/alert.json'
 
     def __init__(self):
         self.basepath = os.path.abspath(
@@ -190,6 +319,9 @@ class AlertPlugins(metaclass=HookMetaclass):
         )
         self.modspath = os.path.join(self.basepath, 'alertmods/')
         self.mods = []
+        self._semaphore = threading.BoundedSemaphore(ALERT_WORKERS)
+        # module name -> AlertModuleRun still running from a previous run
+        self._running = {}
 
         self.snmp_trap_sender = SnmpTrapSender()
 
@@ -303,6 +435,85 @@ class AlertPlugins(metaclass=HookMetaclass):
             except ClientException as e:
                 log.error(f'Failed to create a support ticket: {e.error}')
 
+    def _load_state(self):
+        if not os.path.exists(self.ALERT_FILE):
+            return None
+        try:
+            with open(self.ALERT_FILE, 'r') as f:
+                state = json.load(f)
+        except Exception:
+            log.debug('Failed to load alert state file', exc_info=True)
+            return None
+        state['alerts'] = [Alert.from_state(a) for a in state['alerts']]
+        for result in state['results'].values():
+            if result['alerts'] is not None:
+                result['alerts'] = [Alert.from_state(a) for a in result['alerts']]
+        return state
+
+    def _save_state(self, alerts, results):
+        state = {
+            'last': time.time(),
+            'alerts': [a.__getstate__() for a in alerts],
+            'results': {
+                name: dict(result, alerts=None if result['alerts'] is None else [
+                    a.__getstate__() for a in result['alerts']
+                ])
+                for name, result in results.items()
+            },
+        }
+        # Readers must never see a partially written file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.ALERT_FILE))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, self.ALERT_FILE)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def _run_modules(self, results):
+        """
+        Run the modules whose results are not cached anymore concurrently.
+
+        Returns a dict of module name -> (status, alerts), status being
+        'OK', 'FAILED' or 'TIMEOUT'.
+        """
+        language = translation.get_language()
+        runs = []
+        for instance in self.mods:
+            result = results.get(instance.name)
+            if result and result.get('status', 'OK') == 'OK':
+                if instance.fire_once:
+                    continue
+                if result['lastrun'] > time.time() - (instance.interval * 60):
+                    continue
+            if instance.name in self._running:
+                if not self._running[instance.name].done.is_set():
+                    # Still hung since a previous run, do not pile up threads
+                    log.warn("Alert module '%s' is still running", instance)
+                    continue
+                del self._running[instance.name]
+            run = AlertModuleRun(instance, self._semaphore, language)
+            run.start()
+            runs.append(run)
+
+        run_deadline = time.monotonic() + ALERT_RUN_TIMEOUT
+        rv = {}
+        for run in runs:
+            name = run.instance.name
+            if not run.wait(run_deadline):
+                log.error("Alert module '%s' timed out", run.instance)
+                run.abandon()
+                self._running[name] = run
+                rv[name] = ('TIMEOUT', None, run.duration)
+            elif run.error is not None:
+                log.error("Alert module '%s' failed: %s", run.instance, run.error)
+                rv[name] = ('FAILED', None, run.duration)
+            else:
+                rv[name] = ('OK', run.result, run.duration)
+        return rv
+
     @lock('/tmp/.alertrun')
     def run(self):
 
@@ -314,60 +525,46 @@ class AlertPlugins(metaclass=HookMetaclass):
         ):
             return []
 
-        obj = None
-        if os.path.exists(self.ALERT_FILE):
-            with open(self.ALERT_FILE, 'rb') as f:
-                try:
-                    obj = pickle.load(f)
-                except Exception:
-                    log.debug('Failed to load alert state file', exc_info=True)
-
+        obj = self._load_state()
         if not obj:
             results = {}
         else:
             results = obj['results']
-        rvs = []
         node = alert_node()
         dismisseds = [a.message_id for a in mAlert.objects.filter(node=node)]
+
+        ran = self._run_modules(results)
+        for name, (status, rv, duration) in ran.items():
+            if status != 'OK':
+                # Keep the alerts of the last successful run, the module will
+                # be run again next time
+                result = results.setdefault(name, {'lastrun': 0, 'alerts': None})
+                result.update({'status': status, 'duration': duration})
+                continue
+
+            alerts = [_f for _f in rv or [] if _f]
+            previous = (results.get(name) or {}).get('alerts') or []
+            for alert in alerts:
+                for i in previous:
+                    if alert == i:
+                        alert.setTimestamp(i.getTimestamp())
+                        break
+            results[name] = {
+                'lastrun': int(time.time()),
+                'alerts': alerts,
+                'status': status,
+                'duration': duration,
+            }
+
+        rvs = []
         ids = []
         for instance in self.mods:
-            try:
-                if instance.name in results:
-                    if instance.fire_once:
-                        continue
-                    if results.get(instance.name).get(
-                        'lastrun'
-                    ) > time.time() - (instance.interval * 60):
-                        if results.get(instance.name).get('alerts'):
-                            for alert in results.get(instance.name).get('alerts'):
-                                ids.append(alert.getId())
-                                rvs.append(alert)
-                        continue
-                rv = instance.run()
-                if rv:
-                    alerts = [_f for _f in rv if _f]
-                    for alert in alerts:
-                        ids.append(alert.getId())
-                        if instance.name in results:
-                            found = False
-                            for i in (results[instance.name]['alerts'] or []):
-                                if alert == i:
-                                    found = i
-                                    break
-                            if found is not False:
-                                alert.setTimestamp(found.getTimestamp())
-
-                        if alert.getId() in dismisseds:
-                            alert.setDismiss(True)
-                    rvs.extend(alerts)
-                results[instance.name] = {
-                    'lastrun': int(time.time()),
-                    'alerts': rv,
-                }
-
-            except Exception as e:
-                log.debug("Alert module '%s' failed: %s", instance, e, exc_info=True)
-                log.error("Alert module '%s' failed: %s", instance, e)
+            if instance.fire_once and instance.name not in ran:
+                continue
+            for alert in (results.get(instance.name) or {}).get('alerts') or []:
+                alert.setDismiss(alert.getId() in dismisseds)
+                ids.append(alert.getId())
+                rvs.append(alert)
 
         qs = mAlert.objects.exclude(message_id__in=ids, node=node)
         if qs.exists():
@@ -410,19 +607,30 @@ class AlertPlugins(metaclass=HookMetaclass):
             if hardware and support.is_enabled():
                 self.ticket(support, hardware)
 
-        with open(self.ALERT_FILE, 'wb') as f:
-            pickle.dump({
-                'last': time.time(),
-                'alerts': rvs,
-                'results': results,
-            }, f)
+        self._save_state(rvs, results)
         return rvs
 
     def get_alerts(self):
-        if not os.path.exists(self.ALERT_FILE):
+        state = self._load_state()
+        if not state:
             return []
-        with open(self.ALERT_FILE, 'rb') as f:
-            return pickle.load(f)['alerts']
+        return state['alerts']
+
+    def get_metrics(self):
+        """
+        Last run time, duration in seconds and status of every module
+        """
+        state = self._load_state()
+        if not state:
+            return {}
+        return {
+            name: {
+                'lastrun': result['lastrun'],
+                'duration': result.get('duration'),
+                'status': result.get('status', 'OK'),
+            }
+            for name, result in state['results'].items()
+        }
 
 
 alertPlugins = AlertPlugins()
@@ -23,14 +23,19 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 #
-from collections import defaultdict
+from collections import defaultdict, deque
 import pickle
 import datetime
+import json
 import logging
+import lzma
 import os
 import re
+import shlex
 import subprocess
 import sys
+import tempfile
+import threading
 
 sys.path.extend([
     '/usr/local/www',
@@ -46,6 +51,7 @@ from freenasUI.freeadmin.apppool import appPool
 from freenasUI.storage.models import Replication, REPL_RESULTFILE
 from freenasUI.common.timesubr import isTimeBetween
 from freenasUI.common.pipesubr import pipeopen
+from freenasUI.common.streampump import Codec, StreamError, StreamPump, TokenBucket
 from freenasUI.common.locks import mntlock
 from freenasUI.common.system import send_mail, get_sw_name
 
@@ -69,93 +75,114 @@ def mapfromdata(input):
     return m
 
 #
-# Return a pair of compression and decompress pipe commands
+# Compression of the replication streams. The parallel compressors keep
+# running as filters, xz is done in process.
 #
-map_compression = {
-    'pigz': ('/usr/local/bin/pigz', '/usr/bin/env pigz -d'),
-    'plzip': ('/usr/local/bin/plzip', '/usr/bin/env plzip -d'),
-    'lz4': ('/usr/local/bin/lz4c', '/usr/bin/env lz4c -d'),
-    'xz': ('/usr/bin/xz', '/usr/bin/env xzdec'),
+codecs = {
+    'pigz': Codec('/usr/bin/env pigz -d', command=['/usr/local/bin/pigz']),
+    'plzip': Codec('/usr/bin/env plzip -d', command=['/usr/local/bin/plzip']),
+    'lz4': Codec('/usr/bin/env lz4c -d', command=['/usr/local/bin/lz4c']),
+    'xz': Codec('/usr/bin/env xzdec', compressor=lzma.LZMACompressor),
 }
 
 is_truenas = not (get_sw_name().lower() == 'freenas')
 
 
-def compress_pipecmds(compression):
-    if compression in map_compression:
-        compress, decompress = map_compression[compression]
-        compress = compress + ' | '
-        decompress = decompress + ' | '
-    else:
-        compress = ''
-        decompress = ''
-    return (compress, decompress)
-
-
 #
 # Attempt to send a snapshot or increamental stream to remote.
 #
-def sendzfs(fromsnap, tosnap, dataset, localfs, remotefs, followdelete, throttle, compression, replication, reached_last):
-    global results
-    global templog
+def sendzfs(fromsnap, tosnap, dataset, localfs, remotefs, followdelete, limiter, codec, replication, sshcmd,
+            intermediate=False, resumable=False, token=None):
+    """
+    Send `dataset`@`tosnap`, incrementally from `fromsnap` if given along
+    with all the snapshots in between if `intermediate`.
 
-    progressfile = '/tmp/.repl_progress_%d' % replication.id
+    With `resumable`, an interrupted stream leaves a receive resume token on
+    the remote side; sending that `token` picks the stream up from there.
+    """
     cmd = ['/sbin/zfs', 'send', '-V']
 
-    # -p switch will send properties for whole dataset, including snapshots
-    # which will result in stale snapshots being delete as well
-    if followdelete:
-        cmd.append('-p')
-
-    if fromsnap is None:
-        cmd.append("%s@%s" % (dataset, tosnap))
-    else:
-        cmd.extend(['-i', "%s@%s" % (dataset, fromsnap), "%s@%s" % (dataset, tosnap)])
-    # subprocess.Popen does not handle large stream of data between
-    # processes very well, do it on our own
-    readfd, writefd = os.pipe()
-    zproc_pid = os.fork()
-    if zproc_pid == 0:
-        os.close(readfd)
-        os.dup2(writefd, 1)
-        os.close(writefd)
-        os.execv('/sbin/zfs', cmd)
-        # NOTREACHED
+    if token is not None:
+        cmd.extend(['-t', token])
+        tosnap = '(resumed)'
     else:
-        with open(progressfile, 'w') as f2:
-            f2.write(str(zproc_pid))
-        os.close(writefd)
+        # -p switch will send properties for whole dataset, including snapshots
+        # which will result in stale snapshots being delete as well
+        if followdelete:
+            cmd.append('-p')
 
-    compress, decompress = compress_pipecmds(compression)
-    replcmd = '%s%s/usr/local/bin/pipewatcher $$ | %s "%s/sbin/zfs receive -F -d \'%s\' && echo Succeeded"' % (compress, throttle, sshcmd, decompress, remotefs)
+        if fromsnap is None:
+            cmd.append("%s@%s" % (dataset, tosnap))
+        else:
+            cmd.extend(['-I' if intermediate else '-i', "%s@%s" % (dataset, fromsnap), "%s@%s" % (dataset, tosnap)])
+    procs = [subprocess.Popen(cmd, stdout=subprocess.PIPE)]
+    compressor = None
+    decompress = ''
+    if codec is not None:
+        if codec.command:
+            procs.append(subprocess.Popen(codec.command, stdin=procs[0].stdout, stdout=subprocess.PIPE))
+            procs[0].stdout.close()
+        else:
+            compressor = codec.compressor()
+        decompress = codec.decompress + ' | '
+    source = procs[-1].stdout
+
+    replcmd = '%s "%s/sbin/zfs receive %s-F -d \'%s\' && echo Succeeded"' % (
+        sshcmd, decompress, '-s ' if resumable else '', remotefs,
+    )
     log.debug('Sending zfs snapshot: %s | %s', ' '.join(cmd), replcmd)
-    with open(templog, 'w+') as f:
-        readobj = os.fdopen(readfd, 'rb', 0)
+    with tempfile.TemporaryFile(mode='w+') as f:
         proc = subprocess.Popen(
-            replcmd,
-            shell=True,
-            stdin=readobj,
+            shlex.split(replcmd),
+            stdin=subprocess.PIPE,
             stdout=f,
             stderr=subprocess.STDOUT,
         )
-        proc.wait()
-        os.waitpid(zproc_pid, os.WNOHANG)
-        readobj.close()
-        os.remove(progressfile)
+        pump = StreamPump(
+            source.fileno(),
+            proc.stdin.fileno(),
+            compressor=compressor,
+            limiter=limiter,
+            progress=lambda pump: write_progress(replication),
+        )
+        set_sending(replication, procs[0].pid, pump, True)
+        aborted = True
+        try:
+            pump.run()
+            aborted = False
+        except StreamError as e:
+            log.warn('Replication of %s@%s aborted: %s', dataset, tosnap, e)
+        finally:
+            if aborted:
+                # The whole pipeline goes, a stalled receiving side included
+                for p in procs + [proc]:
+                    if p.poll() is None:
+                        p.terminate()
+            source.close()
+            proc.stdin.close()
+            # Other streams keep running, do not leave zombies behind. Once
+            # aborted, do not hang on a process ignoring SIGTERM either.
+            for p in [proc] + procs:
+                try:
+                    p.wait(timeout=REPL_PROCESS_EXIT_TIMEOUT if aborted else None)
+                except subprocess.TimeoutExpired:
+                    p.kill()
+                    p.wait()
+            set_sending(replication, procs[0].pid, pump, False)
+        log.info(
+            'Sent %s@%s: %d bytes in %.1f seconds (%.1f KiB/s)',
+            dataset, tosnap, pump.bytes_out, pump.elapsed, pump.rate / 1024,
+        )
         f.seek(0)
         msg = f.read().strip('\n').strip('\r')
-    os.remove(templog)
     msg = msg.replace('WARNING: ENABLED NONE CIPHER', '')
     msg = msg.strip('\r').strip('\n')
     log.debug("Replication result: %s" % (msg))
-    results[replication.id]['msg'] = msg
     # When replicating to a target "container" dataset that doesn't exist on the sending
     # side the target dataset will have to be readonly, however that will preclude
     # creating mountpoints for the datasets that are sent.
     # In that case you'll get back a failed to create mountpoint message, which
     # we'll go ahead and consider a success.
-    if reached_last and ("Succeeded" in msg or "failed to create mountpoint" in msg):
-        results[replication.id]['last_snapshot'] = tosnap
     return ("Succeeded" in msg or "failed to create mountpoint" in msg)
 
 log = logging.getLogger('tools.autorepl')
@@ -163,6 +190,24 @@ log = logging.getLogger('tools.autorepl')
 # Set to True if verbose log desired
 debug = False
 
+# Replication streams running at the same time, overall and to a single
+# remote host
+REPL_MAX_STREAMS = 4
+REPL_MAX_STREAMS_PER_REMOTE = 2
+# Seconds given to the processes of an aborted stream to exit before
+# being killed
+REPL_PROCESS_EXIT_TIMEOUT = 30
+# Remote snapshots destroyed by a single `zfs destroy`
+REPL_DESTROY_BATCH_SIZE = 64
+
+SSH_CONTROL_DIR = '/var/run/autorepl-ssh'
+# Seconds an idle ssh session is kept around
+SSH_CONTROL_PERSIST = 60
+# Whether replication streams go through the shared ssh session as well.
+# They otherwise get a connection and ssh process each so that concurrent
+# streams to a remote do not share the throughput of a single one.
+SSH_MULTIPLEX_STREAMS = False
+
 
 # Detect if another instance is running
 def exit_if_running(pid):
@@ -183,7 +228,6 @@ appPool.hook_tool_run('autorepl')
 MNTLOCK = mntlock()
 
 mypid = os.getpid()
-templog = '/tmp/repl-%d' % (mypid)
 
 start = datetime.datetime.now().replace(microsecond=0)
 if start.second < 30 or start.minute == 59:
@@ -219,7 +263,6 @@ MNTLOCK.unlock()
 # At this point, we are sure that only one autorepl instance is running.
 
 log.debug("Autosnap replication started")
-log.debug("temp log file: %s" % (templog, ))
 
 try:
     with open(REPL_RESULTFILE, 'rb') as f:
@@ -228,300 +271,648 @@ try:
 except:
     results = defaultdict(dict)
 
+# Replication tasks run concurrently, `results` is only changed and saved
+# with this lock held
+results_lock = threading.Lock()
+
 
 def write_results():
-    global results
-    with open(REPL_RESULTFILE, 'wb') as f:
-        f.write(pickle.dumps(results))
+    with results_lock:
+        with open(REPL_RESULTFILE, 'wb') as f:
+            f.write(pickle.dumps(results))
+
+
+def set_result(replication, **kwargs):
+    with results_lock:
+        results.setdefault(replication.id, {}).update(kwargs)
+
+
+def set_dataset_result(replication, dataset, msg):
+    """Status of the replication of `dataset`, see ReplicationTask"""
+    with results_lock:
+        results.setdefault(replication.id, {}).setdefault('datasets', {})[dataset] = msg
+
+
+progress_lock = threading.Lock()
+# replication id -> [(pid of zfs send, StreamPump)]
+sending_streams = defaultdict(list)
+
+
+def write_progress(replication):
+    """
+    Progress file of `replication`, read by Replication.status: the pid of
+    one of its zfs send processes followed by the bytes sent and the
+    current rate of all its streams.
+    """
+    progressfile = '/tmp/.repl_progress_%d' % replication.id
+    with progress_lock:
+        streams = sending_streams[replication.id]
+        if not streams:
+            if os.path.exists(progressfile):
+                os.remove(progressfile)
+            return
+        progress = {
+            'bytes': sum(pump.bytes_out for pid, pump in streams),
+            'rate': int(sum(pump.rate for pid, pump in streams)),
+        }
+        with open(progressfile + '.tmp', 'w') as f2:
+            f2.write('%d\n%s\n' % (streams[0][0], json.dumps(progress)))
+        os.rename(progressfile + '.tmp', progressfile)
+
+
+def set_sending(replication, pid, pump, sending):
+    with progress_lock:
+        streams = sending_streams[replication.id]
+        if sending:
+            streams.append((pid, pump))
+        else:
+            streams.remove((pid, pump))
+    write_progress(replication)
 
 system_re = re.compile('^[^/]+/.system.*')
 
-# Traverse all replication tasks
-replication_tasks = Replication.objects.all()
-for replication in replication_tasks:
-    if not isTimeBetween(now, replication.repl_begin, replication.repl_end):
-        continue
 
-    if not replication.repl_enabled:
-        log.debug("%s replication not enabled" % replication)
-        continue
+class SSHConnections(object):
+    """
+    One multiplexed ssh session (ControlMaster) per remote, shared by the
+    commands of the whole run so the handshake and key exchange happen once
+    per remote instead of once per command. Streams only go through it with
+    SSH_MULTIPLEX_STREAMS.
 
-    remote = replication.repl_remote.ssh_remote_hostname.__str__()
-    remote_port = replication.repl_remote.ssh_remote_port
-    dedicateduser = replication.repl_remote.ssh_remote_dedicateduser
-    cipher = replication.repl_remote.ssh_cipher
-    remotefs = replication.repl_zfs.__str__()
-    localfs = replication.repl_filesystem.__str__()
-    compression = replication.repl_compression.__str__()
-    followdelete = not not replication.repl_followdelete
-    recursive = not not replication.repl_userepl
-
-    if replication.repl_limit != 0:
-        throttle = '/usr/local/bin/throttle -K %d | ' % replication.repl_limit
-    else:
-        throttle = ''
-
-    if cipher == 'fast':
-        sshcmd = (
-            '/usr/local/bin/ssh -c arcfour256,arcfour128,blowfish-cbc,'
-            'aes128-ctr,aes192-ctr,aes256-ctr -i /data/ssh/replication'
-            ' -o BatchMode=yes -o StrictHostKeyChecking=yes'
-            # There's nothing magical about ConnectTimeout, it's an average
-            # of wiliam and josh's thoughts on a Wednesday morning.
-            # It will prevent hunging in the status of "Sending".
-            ' -o ConnectTimeout=7'
-        )
-    elif cipher == 'disabled':
-        sshcmd = ('/usr/local/bin/ssh -ononeenabled=yes -ononeswitch=yes -i /data/ssh/replication -o BatchMode=yes'
-                  ' -o StrictHostKeyChecking=yes'
-                  ' -o ConnectTimeout=7')
-    else:
-        sshcmd = ('/usr/local/bin/ssh -i /data/ssh/replication -o BatchMode=yes'
-                  ' -o StrictHostKeyChecking=yes'
-                  ' -o ConnectTimeout=7')
+    Should the session go away, ssh falls back to a connection of its own.
+    """
 
-    if dedicateduser:
-        sshcmd = "%s -l %s" % (sshcmd, dedicateduser)
+    def __init__(self, directory=SSH_CONTROL_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+        # (ssh command, port, remote) -> [lock, control path]
+        self.sessions = {}
 
-    sshcmd = '%s -p %d %s' % (sshcmd, remote_port, remote)
+    def get(self, sshcmd, port, remote, stream=False):
+        """
+        Returns `sshcmd` for `remote`, going through its session unless it
+        is for a replication `stream`.
+        """
+        if stream and not SSH_MULTIPLEX_STREAMS:
+            return '%s -o ControlPath=none -p %d %s' % (sshcmd, port, remote)
 
-    remotefs_final = "%s%s%s" % (remotefs, localfs.partition('/')[1], localfs.partition('/')[2])
+        key = (sshcmd, port, remote)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                # Other tasks for the same remote wait for the session
+                session = self.sessions[key] = [threading.Lock(), None]
+                session[0].acquire()
+                index = len(self.sessions)
+            else:
+                index = None
 
-    # Examine local list of snapshots, then remote snapshots, and determine if there is any work to do.
-    log.debug("Checking dataset %s" % (localfs))
+        if index is not None:
+            try:
+                session[1] = self.start(sshcmd, port, remote, index)
+            finally:
+                session[0].release()
+        with session[0]:
+            path = session[1]
 
-    # Grab map from local system.
-    if recursive:
-        zfsproc = pipeopen('/sbin/zfs list -H -t snapshot -p -o name,creation -r "%s"' % (localfs), debug)
-    else:
-        zfsproc = pipeopen('/sbin/zfs list -H -t snapshot -p -o name,creation -r -d 1 "%s"' % (localfs), debug)
-
-    output, error = zfsproc.communicate()
-    if zfsproc.returncode:
-        log.warn('Could not determine last available snapshot for dataset %s: %s' % (
-            localfs,
-            error,
-        ))
-        continue
-    if output != '':
-        snaplist = output.split('\n')
-        snaplist = [x for x in snaplist if not system_re.match(x)]
-        map_source = mapfromdata(snaplist)
-
-    rzfscmd = '"zfs list -H -o name,readonly -t filesystem,volume -r %s"' % (remotefs_final.split('/')[0])
-    sshproc = pipeopen('%s %s' % (sshcmd, rzfscmd))
-    output, error = sshproc.communicate()
-    remote_zfslist = {}
-    for i in re.sub(r'[ \t]+', ' ', output, flags=re.M).splitlines():
-        data = i.split()
-        remote_zfslist[data[0]] = {'readonly': data[1] == 'on'}
-
-    # Attempt to create the remote dataset.  If it fails, we don't care at this point.
-    rzfscmd = "zfs create -o readonly=on "
-    ds = ''
-    if "/" not in localfs:
-        localfs_tmp = "%s/%s" % (localfs, localfs)
-    else:
-        localfs_tmp = localfs
-    for direc in (remotefs.partition("/")[2] + "/" + localfs_tmp.partition("/")[2]).split("/"):
-        # If this test fails there is no need to create datasets on the remote side
-        # eg: tank -> tank replication
-        if not direc:
-            continue
-        if '/' in remotefs or '/' in localfs:
-            ds = os.path.join(ds, direc)
-            ds_full = '%s/%s' % (remotefs.split('/')[0], ds)
-            if ds_full in remote_zfslist:
+        if path is None:
+            return '%s -p %d %s' % (sshcmd, port, remote)
+        return '%s -o ControlMaster=no -o ControlPath=%s -p %d %s' % (sshcmd, path, port, remote)
+
+    def start(self, sshcmd, port, remote, index):
+        path = os.path.join(self.directory, str(index))
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            if os.path.exists(path):
+                os.unlink(path)
+        except OSError as e:
+            log.debug('Unable to set up ssh control path %s: %s', path, e)
+            return None
+
+        # -f goes to the background once authenticated, the master closes by
+        # itself if left idle should we not get to close it
+        cmd = '%s -f -N -o ControlMaster=yes -o ControlPath=%s -o ControlPersist=%d -p %d %s' % (
+            sshcmd, path, SSH_CONTROL_PERSIST, port, remote,
+        )
+        with tempfile.TemporaryFile() as f:
+            proc = pipeopen(cmd, stdout=subprocess.DEVNULL, stderr=f)
+            proc.wait()
+            if proc.returncode != 0:
+                f.seek(0)
+                log.debug('Unable to open ssh session to %s: %s', remote, f.read().decode('utf8', 'ignore'))
+                return None
+        return path
+
+    def close(self):
+        with self.lock:
+            sessions, self.sessions = self.sessions, {}
+        for (sshcmd, port, remote), (lock, path) in sessions.items():
+            if path is None:
                 continue
-            log.debug("ds = %s, remotefs = %s" % (ds, remotefs))
-            sshproc = pipeopen('%s %s %s' % (sshcmd, rzfscmd, ds_full), quiet=True)
-            output, error = sshproc.communicate()
-            error = error.strip('\n').strip('\r').replace('WARNING: ENABLED NONE CIPHER', '')
-            # Debugging code
-            if sshproc.returncode:
-                log.debug("Unable to create remote dataset %s: %s" % (
-                    remotefs,
-                    error
-                ))
-
-    if is_truenas:
-        # Bi-directional replication: the remote side indicates that they are
-        # willing to receive snapshots by setting readonly to 'on', which prevents
-        # local writes.
-        #
-        # We expect to see "on" in the output, or cannot open '%s': dataset does not exist
-        # in the error.  To be safe, also check for children's readonly state.
-        may_proceed = False
-        rzfscmd = '"zfs list -H -o readonly -t filesystem,volume -r %s"' % (remotefs_final)
+            proc = pipeopen('%s -o ControlPath=%s -O exit -p %d %s' % (sshcmd, path, port, remote))
+            proc.communicate()
+
+
+def remote_destroy(sshcmd, zfsname, snapshots, defer=False):
+    """
+    Destroy `snapshots` of the remote dataset `zfsname` with as few remote
+    commands as possible, giving `zfs destroy` lists of snapshots.
+
+    Returns:
+        list - snapshots that could not be destroyed
+    """
+    failed = []
+    for i in range(0, len(snapshots), REPL_DESTROY_BATCH_SIZE):
+        batch = snapshots[i:i + REPL_DESTROY_BATCH_SIZE]
+        snapshot = '%s@%s' % (zfsname, ','.join(batch))
+        rzfscmd = '"zfs destroy %s\'%s\'"' % ('-d ' if defer else '', snapshot)
+        sshproc = pipeopen('%s %s' % (sshcmd, rzfscmd))
+        sshproc.communicate()
+        if sshproc.returncode == 0:
+            continue
+        if len(batch) == 1:
+            log.warn("Unable to destroy snapshot %s on remote system" % (snapshot))
+            failed.append(snapshot)
+            continue
+        # A list is destroyed as a whole or not at all, find out which
+        # snapshots are to blame
+        for name in batch:
+            failed.extend(remote_destroy(sshcmd, zfsname, [name], defer=defer))
+    return failed
+
+
+def dataset_depth(dataset):
+    return len(dataset.split('/'))
+
+
+class ReplicationTask(object):
+    """
+    Replication of a Replication task, split in jobs for the
+    ReplicationScheduler: `prepare` finds out what has to be sent, then
+    each dataset is replicated by its own `replicate` job.
+
+    Datasets are replicated once the ones below them are done. This is
+    because in case datasets being remounted we need to make sure tank/foo
+    is mounted after tank/foo/bar and the latter does not get hidden.
+    See #12455
+
+    The state of the jobs is only changed with the scheduler lock held.
+    """
+
+    def __init__(self, replication):
+        self.replication = replication
+        self.remote = replication.repl_remote.ssh_remote_hostname.__str__()
+        # (method, dataset) ready to run
+        self.ready = deque([(self.prepare, None)])
+        self.running = 0
+        # dataset -> number of datasets below it not replicated yet
+        self.waiting = {}
+        self.tasks = None
+        self.failures = {}
+        # Newest snapshot of the root dataset, on both sides once the task
+        # succeeded
+        self.last_snapshot = None
+
+    @property
+    def finished(self):
+        return not self.ready and not self.running and not self.waiting
+
+    def job_done(self, dataset):
+        if dataset is None:
+            if self.tasks:
+                self.schedule()
+            return
+
+        parent = dataset
+        while '/' in parent:
+            parent = parent.rsplit('/', 1)[0]
+            if parent in self.waiting:
+                self.waiting[parent] -= 1
+                if self.waiting[parent] == 0:
+                    del self.waiting[parent]
+                    self.ready.append((self.replicate, parent))
+
+        if self.finished:
+            # Report the failure of the first dataset in replication order
+            for name in self.order:
+                if name in self.failures:
+                    set_result(self.replication, msg=self.failures[name])
+                    break
+            else:
+                set_result(self.replication, msg='Succeeded')
+                # Only once every dataset is done, they are sent concurrently
+                if self.last_snapshot is not None:
+                    set_result(self.replication, last_snapshot=self.last_snapshot)
+            write_results()
+
+    def schedule(self):
+        # Go through datasets in reverse order by level in hierarchy
+        self.order = sorted(list(self.tasks.keys()), key=dataset_depth, reverse=True)
+        waiting = defaultdict(int)
+        for dataset in self.order:
+            parent = dataset
+            while '/' in parent:
+                parent = parent.rsplit('/', 1)[0]
+                if parent in self.tasks:
+                    waiting[parent] += 1
+        for dataset in self.order:
+            if dataset in waiting:
+                self.waiting[dataset] = waiting[dataset]
+            else:
+                self.ready.append((self.replicate, dataset))
+
+    def fail(self, dataset, msg):
+        self.failures[dataset] = msg
+        set_dataset_result(self.replication, dataset, msg)
+
+    def prepare(self):
+        replication = self.replication
+        remote = replication.repl_remote.ssh_remote_hostname.__str__()
+        remote_port = replication.repl_remote.ssh_remote_port
+        dedicateduser = replication.repl_remote.ssh_remote_dedicateduser
+        cipher = replication.repl_remote.ssh_cipher
+        remotefs = replication.repl_zfs.__str__()
+        localfs = replication.repl_filesystem.__str__()
+        compression = replication.repl_compression.__str__()
+        followdelete = not not replication.repl_followdelete
+        recursive = not not replication.repl_userepl
+
+        # The limit is in KiB/s and applies to all the streams of the task
+        if replication.repl_limit != 0:
+            limiter = TokenBucket(replication.repl_limit * 1024)
+        else:
+            limiter = None
+
+        if cipher == 'fast':
+            sshcmd = (
+                '/usr/local/bin/ssh -c arcfour256,arcfour128,blowfish-cbc,'
+                'aes128-ctr,aes192-ctr,aes256-ctr -i /data/ssh/replication'
+                ' -o BatchMode=yes -o StrictHostKeyChecking=yes'
+                # There's nothing magical about ConnectTimeout, it's an average
+                # of wiliam and josh's thoughts on a Wednesday morning.
+                # It will prevent hunging in the status of "Sending".
+                ' -o ConnectTimeout=7'
+            )
+        elif cipher == 'disabled':
+            sshcmd = ('/usr/local/bin/ssh -ononeenabled=yes -ononeswitch=yes -i /data/ssh/replication -o BatchMode=yes'
+                      ' -o StrictHostKeyChecking=yes'
+                      ' -o ConnectTimeout=7')
+        else:
+            sshcmd = ('/usr/local/bin/ssh -i /data/ssh/replication -o BatchMode=yes'
+                      ' -o StrictHostKeyChecking=yes'
+                      ' -o ConnectTimeout=7')
+
+        if dedicateduser:
+            sshcmd = "%s -l %s" % (sshcmd, dedicateduser)
+
+        stream_sshcmd = ssh_connections.get(sshcmd, remote_port, remote, stream=True)
+        sshcmd = ssh_connections.get(sshcmd, remote_port, remote)
+
+        remotefs_final = "%s%s%s" % (remotefs, localfs.partition('/')[1], localfs.partition('/')[2])
+
+        # Examine local list of snapshots, then remote snapshots, and determine if there is any work to do.
+        log.debug("Checking dataset %s" % (localfs))
+
+        # Grab map from local system.
+        map_source = {}
+        if recursive:
+            zfsproc = pipeopen('/sbin/zfs list -H -t snapshot -p -o name,creation -r "%s"' % (localfs), debug)
+        else:
+            zfsproc = pipeopen('/sbin/zfs list -H -t snapshot -p -o name,creation -r -d 1 "%s"' % (localfs), debug)
+
+        output, error = zfsproc.communicate()
+        if zfsproc.returncode:
+            log.warn('Could not determine last available snapshot for dataset %s: %s' % (
+                localfs,
+                error,
+            ))
+            return
+        if output != '':
+            snaplist = output.split('\n')
+            snaplist = [x for x in snaplist if not system_re.match(x)]
+            map_source = mapfromdata(snaplist)
+
+        # Remote systems without resumable receive do not know about
+        # receive_resume_token, list without it then
+        resumable = True
+        rzfscmd = '"zfs list -H -o name,readonly,receive_resume_token -t filesystem,volume -r %s"' % (remotefs_final.split('/')[0])
         sshproc = pipeopen('%s %s' % (sshcmd, rzfscmd))
         output, error = sshproc.communicate()
-        error = error.strip('\n').strip('\r').replace('WARNING: ENABLED NONE CIPHER', '')
         if sshproc.returncode:
-            # Be conservative: only consider it's Okay when we see the expected result.
-            if error != '':
-                if error.split('\n')[0] == ("cannot open '%s': dataset does not exist" % (remotefs_final)):
-                    may_proceed = True
+            resumable = False
+            rzfscmd = '"zfs list -H -o name,readonly -t filesystem,volume -r %s"' % (remotefs_final.split('/')[0])
+            sshproc = pipeopen('%s %s' % (sshcmd, rzfscmd))
+            output, error = sshproc.communicate()
+        remote_zfslist = {}
+        # local dataset -> token of the stream interrupted while receiving it
+        resume_tokens = {}
+        for i in re.sub(r'[ \t]+', ' ', output, flags=re.M).splitlines():
+            data = i.split()
+            remote_zfslist[data[0]] = {'readonly': data[1] == 'on'}
+            if len(data) > 2 and data[2] != '-':
+                if data[0] == remotefs_final or data[0].startswith(remotefs_final + '/'):
+                    resume_tokens[localfs + data[0][len(remotefs_final):]] = data[2]
+
+        # Attempt to create the remote dataset.  If it fails, we don't care at this point.
+        rzfscmd = "zfs create -o readonly=on "
+        ds = ''
+        if "/" not in localfs:
+            localfs_tmp = "%s/%s" % (localfs, localfs)
         else:
-            if output != '':
-                if output.find('off') == -1:
-                    may_proceed = True
-        if not may_proceed:
-            # Report the problem and continue
-            results[replication.id]['msg'] = 'Remote destination must be set readonly'
-            log.debug("dataset %s and it's children must be readonly." % remotefs_final)
-            if ("on" in output or "off" in output) and len(output) > 0:
-                error, errmsg = send_mail(
-                    subject="Replication denied! (%s)" % remote,
-                    text="""
-Hello,
-    The remote system have denied our replication from local ZFS
-    %s to remote ZFS %s.  Please change the 'readonly' property
-    of:
-        %s
-    as well as its children to 'on' to allow receiving replication.
-                    """ % (localfs, remotefs_final, remotefs_final), interval=datetime.timedelta(hours=24), channel='autorepl')
+            localfs_tmp = localfs
+        for direc in (remotefs.partition("/")[2] + "/" + localfs_tmp.partition("/")[2]).split("/"):
+            # If this test fails there is no need to create datasets on the remote side
+            # eg: tank -> tank replication
+            if not direc:
+                continue
+            if '/' in remotefs or '/' in localfs:
+                ds = os.path.join(ds, direc)
+                ds_full = '%s/%s' % (remotefs.split('/')[0], ds)
+                if ds_full in remote_zfslist:
+                    continue
+                log.debug("ds = %s, remotefs = %s" % (ds, remotefs))
+                sshproc = pipeopen('%s %s %s' % (sshcmd, rzfscmd, ds_full), quiet=True)
+                output, error = sshproc.communicate()
+                error = error.strip('\n').strip('\r').replace('WARNING: ENABLED NONE CIPHER', '')
+                # Debugging code
+                if sshproc.returncode:
+                    log.debug("Unable to create remote dataset %s: %s" % (
+                        remotefs,
+                        error
+                    ))
+
+        if is_truenas:
+            # Bi-directional replication: the remote side indicates that they are
+            # willing to receive snapshots by setting readonly to 'on', which prevents
+            # local writes.
+            #
+            # We expect to see "on" in the output, or cannot open '%s': dataset does not exist
+            # in the error.  To be safe, also check for children's readonly state.
+            may_proceed = False
+            rzfscmd = '"zfs list -H -o readonly -t filesystem,volume -r %s"' % (remotefs_final)
+            sshproc = pipeopen('%s %s' % (sshcmd, rzfscmd))
+            output, error = sshproc.communicate()
+            error = error.strip('\n').strip('\r').replace('WARNING: ENABLED NONE CIPHER', '')
+            if sshproc.returncode:
+                # Be conservative: only consider it's Okay when we see the expected result.
+                if error != '':
+                    if error.split('\n')[0] == ("cannot open '%s': dataset does not exist" % (remotefs_final)):
+                        may_proceed = True
             else:
-                if len(output) > 0:
+                if output != '':
+                    if output.find('off') == -1:
+                        may_proceed = True
+            if not may_proceed:
+                # Report the problem and continue
+                set_result(replication, msg='Remote destination must be set readonly')
+                log.debug("dataset %s and it's children must be readonly." % remotefs_final)
+                if ("on" in output or "off" in output) and len(output) > 0:
                     error, errmsg = send_mail(
-                            subject="Replication failed! (%s)" % remote,
-                            text="""
-Hello,
-    Replication of local ZFS %s to remote ZFS %s failed.""" % (localfs, remotefs_final), interval=datetime.timedelta(hours=24), channel='autorepl')
-                    results[replication.id]['msg'] = 'Remote system denied receiving of snapshot on %s' % (remotefs_final)
+                        subject="Replication denied! (%s)" % remote,
+                        text="""
+    Hello,
+        The remote system have denied our replication from local ZFS
+        %s to remote ZFS %s.  Please change the 'readonly' property
+        of:
+            %s
+        as well as its children to 'on' to allow receiving replication.
+                        """ % (localfs, remotefs_final, remotefs_final), interval=datetime.timedelta(hours=24), channel='autorepl')
                 else:
-                    error, errmsg = send_mail(
-                            subject="Replication failed! (%s)" % remote,
-                            text="""
-Hello,
-    Replication of local ZFS %s to remote ZFS %s failed.  The remote system is not responding.""" % (localfs, remotefs_final), interval=datetime.timedelta(hours=24), channel='autorepl')
-                    results[replication.id]['msg'] = 'Remote system not responding.'
-            continue
+                    if len(output) > 0:
+                        error, errmsg = send_mail(
+                                subject="Replication failed! (%s)" % remote,
+                                text="""
+    Hello,
+        Replication of local ZFS %s to remote ZFS %s failed.""" % (localfs, remotefs_final), interval=datetime.timedelta(hours=24), channel='autorepl')
+                        set_result(replication, msg='Remote system denied receiving of snapshot on %s' % (remotefs_final))
+                    else:
+                        error, errmsg = send_mail(
+                                subject="Replication failed! (%s)" % remote,
+                                text="""
+    Hello,
+        Replication of local ZFS %s to remote ZFS %s failed.  The remote system is not responding.""" % (localfs, remotefs_final), interval=datetime.timedelta(hours=24), channel='autorepl')
+                        set_result(replication, msg='Remote system not responding.')
+                return
+
+        # Remote filesystem is the root dataset
+        # Make sure it has no .system dataset over there because zfs receive will try to
+        # remove it and fail (because its mounted and being used)
+        if '/' not in remotefs_final:
+            rzfscmd = '"mount | grep ^%s/.system"' % (remotefs_final)
+            sshproc = pipeopen('%s %s' % (sshcmd, rzfscmd), debug)
+            output = sshproc.communicate()[0].strip()
+            if output != '':
+                set_result(replication, msg='Please move system dataset of remote side to another pool')
+                return
 
-    # Remote filesystem is the root dataset
-    # Make sure it has no .system dataset over there because zfs receive will try to
-    # remove it and fail (because its mounted and being used)
-    if '/' not in remotefs_final:
-        rzfscmd = '"mount | grep ^%s/.system"' % (remotefs_final)
+        # Grab map from remote system
+        if recursive:
+            rzfscmd = '"zfs list -H -t snapshot -p -o name,creation -r \'%s\'"' % (remotefs_final)
+        else:
+            rzfscmd = '"zfs list -H -t snapshot -p -o name,creation -d 1 -r \'%s\'"' % (remotefs_final)
         sshproc = pipeopen('%s %s' % (sshcmd, rzfscmd), debug)
-        output = sshproc.communicate()[0].strip()
+        output, error = sshproc.communicate()
+        error = error.strip('\n').strip('\r').replace('WARNING: ENABLED NONE CIPHER', '')
         if output != '':
-            results[replication.id]['msg'] = 'Please move system dataset of remote side to another pool'
-            continue
-
-    # Grab map from remote system
-    if recursive:
-        rzfscmd = '"zfs list -H -t snapshot -p -o name,creation -r \'%s\'"' % (remotefs_final)
-    else:
-        rzfscmd = '"zfs list -H -t snapshot -p -o name,creation -d 1 -r \'%s\'"' % (remotefs_final)
-    sshproc = pipeopen('%s %s' % (sshcmd, rzfscmd), debug)
-    output, error = sshproc.communicate()
-    error = error.strip('\n').strip('\r').replace('WARNING: ENABLED NONE CIPHER', '')
-    if output != '':
-        snaplist = output.split('\n')
-        snaplist = [x for x in snaplist if not system_re.match(x) and x != '']
-        # Process snaplist so that it matches the desired form of source side
-        l = len(remotefs_final)
-        snaplist = [localfs + x[l:] for x in snaplist]
-        map_target = mapfromdata(snaplist)
-    elif error != '':
-        results[replication.id]['msg'] = 'Failed: %s' % (error)
-        continue
-    else:
-        map_target = {}
+            snaplist = output.split('\n')
+            snaplist = [x for x in snaplist if not system_re.match(x) and x != '']
+            # Process snaplist so that it matches the desired form of source side
+            l = len(remotefs_final)
+            snaplist = [localfs + x[l:] for x in snaplist]
+            map_target = mapfromdata(snaplist)
+        elif error != '':
+            set_result(replication, msg='Failed: %s' % (error))
+            return
+        else:
+            map_target = {}
 
-    tasks = {}
-    delete_tasks = {}
+        tasks = {}
+        delete_tasks = {}
 
-    # Now we have map_source and map_target, which would be used to calculate the replication
-    # path from source to target.
-    for dataset in map_source:
-        if dataset in map_target:
-            # Find out the last common snapshot.
-            #
-            # We have two ordered lists, list_source and list_target
-            # which are ordered by the creation time.  Because they
-            # are ordered, we can have two pointers and scan backward
-            # until we hit one identical item, or hit the end of
-            # either list.
-            list_source = map_source[dataset]
-            list_target = map_target[dataset]
-            i = len(list_source) - 1
-            j = len(list_target) - 1
-            sourcesnap, sourcetime = list_source[i]
-            targetsnap, targettime = list_target[j]
-            while i >= 0 and j >= 0:
-                # found.
-                if sourcesnap == targetsnap and sourcetime == targettime:
-                    break
-                elif sourcetime > targettime:
-                    i -= 1
-                    if i < 0:
+        # Now we have map_source and map_target, which would be used to calculate the replication
+        # path from source to target.
+        for dataset in map_source:
+            if dataset in map_target:
+                # Find out the last common snapshot.
+                #
+                # We have two ordered lists, list_source and list_target
+                # which are ordered by the creation time.  Because they
+                # are ordered, we can have two pointers and scan backward
+                # until we hit one identical item, or hit the end of
+                # either list.
+                list_source = map_source[dataset]
+                list_target = map_target[dataset]
+                i = len(list_source) - 1
+                j = len(list_target) - 1
+                sourcesnap, sourcetime = list_source[i]
+                targetsnap, targettime = list_target[j]
+                while i >= 0 and j >= 0:
+                    # found.
+                    if sourcesnap == targetsnap and sourcetime == targettime:
                         break
-                    sourcesnap, sourcetime = list_source[i]
+                    elif sourcetime > targettime:
+                        i -= 1
+                        if i < 0:
+                            break
+                        sourcesnap, sourcetime = list_source[i]
+                    else:
+                        j -= 1
+                        if j < 0:
+                            break
+                        targetsnap, targettime = list_target[j]
+                if sourcesnap == targetsnap and sourcetime == targettime:
+                    # found: i, j points to the right position.
+                    # we do not care much if j is pointing to the last snapshot
+                    # if source side have new snapshot(s), report it.
+                    if i < len(list_source) - 1:
+                        tasks[dataset] = [m[0] for m in list_source[i:]]
+                    if followdelete:
+                        # All snapshots that do not exist on the source side should
+                        # be deleted when followdelete is requested.
+                        delete_set = set([m[0] for m in list_target]) - set([m[0] for m in list_source])
+                        if len(delete_set) > 0:
+                            delete_tasks[dataset] = delete_set
                 else:
-                    j -= 1
-                    if j < 0:
-                        break
-                    targetsnap, targettime = list_target[j]
-            if sourcesnap == targetsnap and sourcetime == targettime:
-                # found: i, j points to the right position.
-                # we do not care much if j is pointing to the last snapshot
-                # if source side have new snapshot(s), report it.
-                if i < len(list_source) - 1:
-                    tasks[dataset] = [m[0] for m in list_source[i:]]
-                if followdelete:
-                    # All snapshots that do not exist on the source side should
-                    # be deleted when followdelete is requested.
-                    delete_set = set([m[0] for m in list_target]) - set([m[0] for m in list_source])
-                    if len(delete_set) > 0:
-                        delete_tasks[dataset] = delete_set
+                    # no identical snapshot found, nuke and repave.
+                    tasks[dataset] = [None] + [m[0] for m in list_source[i:]]
             else:
-                # no identical snapshot found, nuke and repave.
-                tasks[dataset] = [None] + [m[0] for m in list_source[i:]]
-        else:
-            # New dataset on source side: replicate to the target.
-            tasks[dataset] = [None] + [m[0] for m in map_source[dataset]]
-
-    # Removed dataset(s)
-    for dataset in map_target:
-        if dataset not in map_source:
-            tasks[dataset] = [map_target[dataset][-1][0], None]
-
-    previously_deleted = "/"
-    l = len(localfs)
-    total_datasets = len(list(tasks.keys()))
-    if total_datasets == 0:
-        results[replication.id]['msg'] = 'Up to date'
+                # New dataset on source side: replicate to the target.
+                tasks[dataset] = [None] + [m[0] for m in map_source[dataset]]
+
+        # Removed dataset(s)
+        for dataset in map_target:
+            if dataset not in map_source:
+                tasks[dataset] = [map_target[dataset][-1][0], None]
+
+        self.sshcmd = sshcmd
+        self.stream_sshcmd = stream_sshcmd
+        self.localfs = localfs
+        self.remotefs = remotefs
+        self.remotefs_final = remotefs_final
+        self.codec = codecs.get(compression)
+        self.followdelete = followdelete
+        self.limiter = limiter
+        self.resumable = resumable
+        self.resume_tokens = resume_tokens
+        self.map_target = map_target
+        self.delete_tasks = delete_tasks
+        self.tasks = tasks
+        if localfs in map_source:
+            self.last_snapshot = map_source[localfs][-1][0]
+
+        total_datasets = len(list(tasks.keys()))
+        if total_datasets == 0:
+            set_result(replication, msg='Up to date', datasets={})
+            write_results()
+            return
+
+        set_result(replication, msg='Running', datasets={dataset: 'Waiting' for dataset in tasks})
         write_results()
-        continue
-    current_dataset = 0
-
-    results[replication.id]['msg'] = 'Running'
-    write_results()
-
-    # Go through datasets in reverse order by level in hierarchy
-    # This is because in case datasets being remounted we need to make sure
-    # tank/foo is mounted after tank/foo/bar and the latter does not get hidden.
-    # See #12455
-    for dataset in sorted(list(tasks.keys()), key=lambda y: len(y.split('/')), reverse=True):
-        tasklist = tasks[dataset]
-        current_dataset += 1
-        reached_last = (current_dataset == total_datasets)
+
+    def send(self, dataset, fromsnap, snapshots):
+        """
+        Send `snapshots` of `dataset`, incrementally from `fromsnap` if given.
+
+        All of them but the first full one go in a single stream carrying
+        the intermediate snapshots, instead of a stream per snapshot.
+
+        Returns:
+            tuple(str, str) - fromsnap and tosnap of the stream that failed,
+                              None if all of them were sent
+        """
+        args = (
+            dataset, self.localfs, self.remotefs, self.followdelete, self.limiter, self.codec,
+            self.replication, self.stream_sshcmd,
+        )
+        if fromsnap is None:
+            fromsnap, snapshots = snapshots[0], snapshots[1:]
+            if not sendzfs(None, fromsnap, *args, resumable=self.resumable):
+                return None, fromsnap
+        if snapshots:
+            if not sendzfs(fromsnap, snapshots[-1], *args,
+                           intermediate=len(snapshots) > 1, resumable=self.resumable):
+                return fromsnap, snapshots[-1]
+        return None
+
+    def resume(self, dataset, tasklist):
+        """
+        Finish the stream of `dataset` interrupted during a previous run.
+
+        Returns:
+            list - `tasklist` updated to what is left to send, None if the
+                   stream could not be resumed now
+        """
+        token = self.resume_tokens.get(dataset)
+        if token is None or tasklist[-1] is None:
+            return tasklist
+
+        zfsname = self.remotefs_final + dataset[len(self.localfs):]
+        log.debug('Resuming interrupted stream of %s', dataset)
+        if not sendzfs(
+            None, None, dataset, self.localfs, self.remotefs, self.followdelete, self.limiter, self.codec,
+            self.replication, self.stream_sshcmd, resumable=True, token=token,
+        ):
+            # The stream cannot be resumed once the snapshots it is made of
+            # are gone, the partial state is then dropped so new streams can
+            # be received. Otherwise it is kept for the next run.
+            zfsproc = pipeopen('/sbin/zfs send -n -t %s' % token, debug)
+            zfsproc.communicate()
+            if not zfsproc.returncode:
+                return None
+            log.warn('Discarding stale resume token of %s on remote system', zfsname)
+            sshproc = pipeopen('%s "zfs receive -A \'%s\'"' % (self.sshcmd, zfsname))
+            sshproc.communicate()
+            return tasklist
+
+        # The stream may have been one of several carried by an intermediate
+        # stream, carry on from the newest snapshot the remote side has now.
+        rzfscmd = '"zfs list -H -o name -t snapshot -d 1 \'%s\'"' % (zfsname)
+        sshproc = pipeopen('%s %s' % (self.sshcmd, rzfscmd), debug)
+        output = sshproc.communicate()[0]
+        remote_snapshots = set(x.split('@', 1)[1] for x in output.splitlines() if '@' in x)
+        snapshots = [x for x in tasklist if x is not None]
+        for i in range(len(snapshots) - 1, -1, -1):
+            if snapshots[i] in remote_snapshots:
+                return snapshots[i:]
+        return tasklist
+
+    def replicate(self, dataset):
+        replication = self.replication
+        remote = self.remote
+        sshcmd = self.sshcmd
+        localfs = self.localfs
+        remotefs_final = self.remotefs_final
+        map_target = self.map_target
+        delete_tasks = self.delete_tasks
+        l = len(localfs)
+
+        set_dataset_result(replication, dataset, 'Sending')
+        tasklist = self.resume(dataset, self.tasks[dataset])
+        if tasklist is None:
+            self.fail(dataset, 'Failed: %s (unable to resume interrupted stream)' % (dataset))
+            return
+        if tasklist[-1] is None:
+            # Remove the named dataset. Datasets below it are removed first,
+            # so `-r` only takes care of what autorepl does not know about.
+            zfsname = remotefs_final + dataset[l:]
+            rzfscmd = '"zfs destroy -r \'%s\'"' % (zfsname)
+            sshproc = pipeopen('%s %s' % (sshcmd, rzfscmd))
+            output, error = sshproc.communicate()
+            if sshproc.returncode:
+                log.warn("Unable to destroy dataset %s on remote system" % (zfsname))
+                set_dataset_result(replication, dataset, 'Unable to destroy remote dataset')
+            else:
+                set_dataset_result(replication, dataset, 'Destroyed')
+            return
+
         if tasklist[0] is None:
             # No matching snapshot(s) exist.  If there is any snapshots on the
             # target side, destroy all existing snapshots so we can proceed.
             if dataset in map_target:
                 list_target = map_target[dataset]
-                snaplist = [remotefs_final + dataset[l:] + '@' + x[0] for x in list_target]
-                failed_snapshots = []
+                snaplist = [x[0] for x in list_target]
                 log.debug('Deleting %d snapshot(s) in pull side because not a single matching snapshot was found', len(snaplist))
-                for snapshot in snaplist:
-                    rzfscmd = '"zfs destroy \'%s\'"' % (snapshot)
-                    sshproc = pipeopen('%s %s' % (sshcmd, rzfscmd))
-                    output, error = sshproc.communicate()
-                    if sshproc.returncode:
-                        log.warn("Unable to destroy snapshot %s on remote system" % (snapshot))
-                        failed_snapshots.append(snapshot)
+                failed_snapshots = remote_destroy(sshcmd, remotefs_final + dataset[l:], snaplist)
                 if len(failed_snapshots) > 0:
                     # We can't proceed in this situation, report
                     error, errmsg = send_mail(
@@ -533,76 +924,139 @@ Hello,
     including:
 %s
                         """ % (localfs, failed_snapshots), interval=datetime.timedelta(hours=2), channel='autorepl')
-                    results[replication.id]['msg'] = 'Unable to destroy remote snapshot: %s' % (failed_snapshots)
+                    self.fail(dataset, 'Unable to destroy remote snapshot: %s' % (failed_snapshots))
                     # ## rzfs destroy %s
-            psnap = tasklist[1]
-            success = sendzfs(None, psnap, dataset, localfs, remotefs, followdelete, throttle, compression, replication, reached_last)
-            if success:
-                for nsnap in tasklist[2:]:
-                    success = sendzfs(psnap, nsnap, dataset, localfs, remotefs, followdelete, throttle, compression, replication, reached_last)
-                    if not success:
-                        # Report the situation
-                        error, errmsg = send_mail(
-                            subject="Replication failed at %s@%s -> %s" % (dataset, psnap, nsnap),
-                            text="""
-Hello,
-    The replication failed for the local ZFS %s while attempting to
-    apply incremental send of snapshot %s -> %s to %s
-                            """ % (dataset, psnap, nsnap, remote), interval=datetime.timedelta(hours=2), channel='autorepl')
-                        results[replication.id]['msg'] = 'Failed: %s (%s->%s)' % (dataset, psnap, nsnap)
-                        break
-                    psnap = nsnap
-            else:
-                # Report the situation
-                error, errmsg = send_mail(
-                    subject="Replication failed when sending %s@%s" % (dataset, psnap),
-                    text="""
+            failed = self.send(dataset, None, tasklist[1:])
+        else:
+            failed = self.send(dataset, tasklist[0], tasklist[1:])
+            if failed is None and dataset in delete_tasks:
+                zfsname = remotefs_final + dataset[l:]
+                log.debug('Deleting %d stale snapshot(s) on pull side', len(delete_tasks[dataset]))
+                remote_destroy(sshcmd, zfsname, sorted(delete_tasks[dataset]), defer=True)
+
+        if failed is None:
+            self.failures.pop(dataset, None)
+            set_dataset_result(replication, dataset, 'Succeeded')
+            return
+
+        # Report the situation
+        psnap, nsnap = failed
+        if psnap is None:
+            error, errmsg = send_mail(
+                subject="Replication failed when sending %s@%s" % (dataset, nsnap),
+                text="""
 Hello,
     The replication failed for the local ZFS %s while attempting to
     send snapshot %s to %s
-                    """ % (dataset, psnap, remote), interval=datetime.timedelta(hours=2), channel='autorepl')
-                results[replication.id]['msg'] = 'Failed: %s (%s)' % (dataset, psnap)
-                continue
-        elif tasklist[1] is not None:
-            psnap = tasklist[0]
-            allsucceeded = True
-            for nsnap in tasklist[1:]:
-                success = sendzfs(psnap, nsnap, dataset, localfs, remotefs, followdelete, throttle, compression, replication, reached_last)
-                allsucceeded = allsucceeded and success
-                if not success:
-                    # Report the situation
-                    error, errmsg = send_mail(
-                        subject="Replication failed at %s@%s -> %s" % (dataset, psnap, nsnap),
-                        text="""
+                """ % (dataset, nsnap, remote), interval=datetime.timedelta(hours=2), channel='autorepl')
+            self.fail(dataset, 'Failed: %s (%s)' % (dataset, nsnap))
+        else:
+            error, errmsg = send_mail(
+                subject="Replication failed at %s@%s -> %s" % (dataset, psnap, nsnap),
+                text="""
 Hello,
     The replication failed for the local ZFS %s while attempting to
     apply incremental send of snapshot %s -> %s to %s
-                        """ % (dataset, psnap, nsnap, remote), interval=datetime.timedelta(hours=2), channel='autorepl')
-                    results[replication.id]['msg'] = 'Failed: %s (%s->%s)' % (dataset, psnap, nsnap)
-                    break
-                psnap = nsnap
-            if allsucceeded and dataset in delete_tasks:
-                zfsname = remotefs_final + dataset[l:]
-                log.debug('Deleting %d stale snapshot(s) on pull side', len(delete_tasks[dataset]))
-                for snapshot in delete_tasks[dataset]:
-                    rzfscmd = '"zfs destroy -d \'%s@%s\'"' % (zfsname, snapshot)
-                    sshproc = pipeopen('%s %s' % (sshcmd, rzfscmd))
-                    sshproc.communicate()
-            if allsucceeded:
-                results[replication.id]['msg'] = 'Succeeded'
-        else:
-            # Remove the named dataset.
-            zfsname = remotefs_final + dataset[l:]
-            if zfsname.startswith(previously_deleted):
-                continue
-            else:
-                rzfscmd = '"zfs destroy -r \'%s\'"' % (zfsname)
-                sshproc = pipeopen('%s %s' % (sshcmd, rzfscmd))
-                output, error = sshproc.communicate()
-                if sshproc.returncode:
-                    log.warn("Unable to destroy dataset %s on remote system" % (zfsname))
+                """ % (dataset, psnap, nsnap, remote), interval=datetime.timedelta(hours=2), channel='autorepl')
+            self.fail(dataset, 'Failed: %s (%s->%s)' % (dataset, psnap, nsnap))
+
+class ReplicationScheduler(object):
+    """
+    Run the jobs of the replication tasks on up to `max_streams` threads,
+    no more than `max_streams_per_remote` of them for the same remote host.
+
+    Tasks take turns: a task starting a job goes to the back of the line,
+    so one task with many datasets does not hold back the others.
+    """
+
+    def __init__(self, max_streams=REPL_MAX_STREAMS, max_streams_per_remote=REPL_MAX_STREAMS_PER_REMOTE):
+        self.max_streams = max_streams
+        self.max_streams_per_remote = max_streams_per_remote
+        self.cond = threading.Condition()
+        self.tasks = deque()
+        # remote host -> number of jobs running
+        self.per_remote = defaultdict(int)
+
+    def add(self, task):
+        with self.cond:
+            self.tasks.append(task)
+            self.cond.notify_all()
+
+    def next_job(self):
+        """
+        Wait for a job allowed to run, returns None once all tasks are done.
+        """
+        with self.cond:
+            while self.tasks:
+                task = next((
+                    task for task in self.tasks
+                    if task.ready and self.per_remote[task.remote] < self.max_streams_per_remote
+                ), None)
+                if task is None:
+                    self.cond.wait()
+                    continue
+                self.tasks.remove(task)
+                self.tasks.append(task)
+                self.per_remote[task.remote] += 1
+                task.running += 1
+                method, dataset = task.ready.popleft()
+                return task, method, dataset
+            return None
+
+    def job_done(self, task, dataset):
+        with self.cond:
+            self.per_remote[task.remote] -= 1
+            task.running -= 1
+            task.job_done(dataset)
+            if task.finished:
+                self.tasks.remove(task)
+            self.cond.notify_all()
+
+    def worker(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            task, method, dataset = job
+            try:
+                if dataset is None:
+                    method()
+                else:
+                    method(dataset)
+            except Exception:
+                log.error('Replication of %s failed', task.replication, exc_info=True)
+                if dataset is None:
+                    set_result(task.replication, msg='Failed')
                 else:
-                    previously_deleted = zfsname
+                    task.fail(dataset, 'Failed: %s' % dataset)
+            finally:
+                self.job_done(task, dataset)
+
+    def run(self):
+        threads = [threading.Thread(target=self.worker, daemon=True) for i in range(self.max_streams)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+ssh_connections = SSHConnections()
+scheduler = ReplicationScheduler()
+
+# Traverse all replication tasks
+replication_tasks = Replication.objects.all()
+for replication in replication_tasks:
+    if not isTimeBetween(now, replication.repl_begin, replication.repl_end):
+        continue
+
+    if not replication.repl_enabled:
+        log.debug("%s replication not enabled" % replication)
+        continue
+
+    scheduler.add(ReplicationTask(replication))
+
+scheduler.run()
+ssh_connections.close()
 
 write_results()
 
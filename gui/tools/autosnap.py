@@ -25,14 +25,18 @@
 # SUCH DAMAGE.
 #
 
+import argparse
 import pickle as pickle
 import logging
 import os
-import re
 import sys
 import uuid
 import ssl
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
 from pyVim import connect, task as VimTask
 from pyVmomi import vim
 
@@ -52,10 +56,12 @@ from freenasUI.freeadmin.apppool import appPool
 from freenasUI.storage.models import Task
 from datetime import datetime, time, timedelta
 
+from freenasUI.common.autosnap import RetentionPlan
 from freenasUI.common.locks import mntlock
 from freenasUI.common.pipesubr import pipeopen
 from freenasUI.common.system import send_mail
 from freenasUI.common.timesubr import isTimeBetween
+from freenasUI.middleware.client import client
 from freenasUI.storage.models import Replication, VMWarePlugin
 
 from lockfile import LockFile
@@ -79,40 +85,17 @@ VMWARE_FAILS = '/var/tmp/.vmwaresnap_fails'
 VMWARELOGIN_FAILS = '/var/tmp/.vmwarelogin_fails'
 VMWARESNAPDELETE_FAILS = '/var/tmp/.vmwaresnapdelete_fails'
 
+# Pools whose expired snapshots are destroyed at the same time
+DESTROY_WORKERS = 4
+# Snapshots of a dataset destroyed by a single `zfs destroy`
+DESTROY_BATCH_SIZE = 64
+
 # Set to True if verbose log desired
 # TODO: Most of the debug has left the building over the years
 # Make debug output great again.
 debug = False
 
 
-def snapinfodict2datetime(snapinfo):
-    year = int(snapinfo['year'])
-    month = int(snapinfo['month'])
-    day = int(snapinfo['day'])
-    hour = int(snapinfo['hour'])
-    minute = int(snapinfo['minute'])
-    return datetime(year, month, day, hour, minute)
-
-
-def snap_expired(snapinfo, snaptime):
-    snapinfo_expirationtime = snapinfodict2datetime(snapinfo)
-    snap_ttl_value = int(snapinfo['retcount'])
-    snap_ttl_unit = snapinfo['retunit']
-
-    if snap_ttl_unit == 'h':
-        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(hours=snap_ttl_value)
-    elif snap_ttl_unit == 'd':
-        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(days=snap_ttl_value)
-    elif snap_ttl_unit == 'w':
-        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(days=7 * snap_ttl_value)
-    elif snap_ttl_unit == 'm':
-        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(days=int(30.436875 * snap_ttl_value))
-    elif snap_ttl_unit == 'y':
-        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(days=int(365.2425 * snap_ttl_value))
-
-    return snapinfo_expirationtime <= snaptime
-
-
 def isMatchingTime(task, snaptime):
     curtime = time(snaptime.hour, snaptime.minute)
     repeat_type = task.task_repeat_unit
@@ -157,6 +140,73 @@ def autorepl_running():
         return False
 
 
+def imported_pools():
+    proc = pipeopen('/sbin/zpool list -H -o name', logger=log)
+    return set(proc.communicate()[0].split('\n')) - {''}
+
+
+def list_task_snapshots(tasks):
+    """
+    Names of the snapshots of the filesystems of `tasks`, a list of
+    (filesystem, recursive) tuples, and of their children for recursive ones.
+    """
+    recursive = sorted({fs for fs, r in tasks if r})
+    # Filesystems below a recursive task are listed along with it
+    recursive = [
+        fs for fs in recursive
+        if not any(fs.startswith(other + '/') for other in recursive)
+    ]
+    nonrecursive = sorted({
+        fs for fs, r in tasks
+        if not r and not any(fs == other or fs.startswith(other + '/') for other in recursive)
+    })
+
+    names = []
+    for flag, paths in (('-r', recursive), ('-d 1', nonrecursive)):
+        if not paths:
+            continue
+        zfsproc = pipeopen('/sbin/zfs list -t snapshot -H -o name %s %s' % (
+            flag, ' '.join('"%s"' % path for path in paths),
+        ), debug, logger=log)
+        names.extend(zfsproc.communicate()[0].split('\n'))
+    return [name for name in names if name]
+
+
+def destroy_snapshots(fs, names):
+    # snapshots with clones will have destruction deferred
+    for i in range(0, len(names), DESTROY_BATCH_SIZE):
+        batch = names[i:i + DESTROY_BATCH_SIZE]
+        snapshot = '%s@%s' % (fs, ','.join(batch))
+        proc = pipeopen('/sbin/zfs destroy -r -d "%s"' % snapshot, logger=log)
+        err = proc.communicate()[1]
+        if proc.returncode == 0:
+            continue
+        if len(batch) == 1:
+            log.error("Failed to destroy snapshot '%s': %s", snapshot, err)
+            continue
+        # A list is destroyed as a whole or not at all, do not let one
+        # snapshot keep the others around
+        for name in batch:
+            destroy_snapshots(fs, [name])
+
+
+def destroy_expired(destroys):
+    """
+    Run the destroys of `RetentionPlan.destroys`, one pool per worker.
+    """
+    per_pool = defaultdict(list)
+    for fs, names in destroys:
+        per_pool[fs.split('/', 1)[0]].append((fs, names))
+
+    def destroy_pool(items):
+        for fs, names in items:
+            destroy_snapshots(fs, names)
+
+    with ThreadPoolExecutor(max_workers=DESTROY_WORKERS) as executor:
+        for _ in executor.map(destroy_pool, per_pool.values()):
+            pass
+
+
 # Check if a VM is using a certain datastore
 def doesVMDependOnDataStore(vm, dataStore):
     try:
@@ -209,6 +259,13 @@ def doesVMSnapshotByNameExists(vm, snapshotName):
     return False
 
 
+parser = argparse.ArgumentParser(description='Take and expire periodic snapshots.')
+parser.add_argument(
+    '-n', '--dry-run', action='store_true',
+    help='print the snapshots that would be taken and destroyed and exit',
+)
+args = parser.parse_args()
+
 appPool.hook_tool_run('autosnap')
 
 mypid = os.getpid()
@@ -244,24 +301,22 @@ else:
     snaptime = now.replace(minute=now.minute + 1, second=0)
 
 mp_to_task_map = {}
+timings = []
+started = monotonic()
 
 # Grab all matching tasks into a tree.
 # Since the snapshot we make have the name 'foo@auto-%Y%m%d.%H%M-{expire time}'
 # format, we just keep one task.
 TaskObjects = Task.objects.filter(task_enabled=True)
-taskpath = {'recursive': [], 'nonrecursive': []}
+pools = None
 for task in TaskObjects:
     vol_name = task.task_filesystem.split('/')[0]
     if isMatchingTime(task, snaptime):
-        proc = pipeopen(f'/sbin/zpool list {vol_name}')
-        proc.communicate()
-        if proc.returncode != 0:
+        if pools is None:
+            pools = imported_pools()
+        if vol_name not in pools:
             log.warn(f'Volume {vol_name} not imported, skipping snapshot task #{task.id}')
             continue
-        if task.task_recursive:
-            taskpath['recursive'].append(task.task_filesystem)
-        else:
-            taskpath['nonrecursive'].append(task.task_filesystem)
         fs = task.task_filesystem
         recursive = task.task_recursive
         expire_time = ('%s%s' % (task.task_ret_count, task.task_ret_unit[0])).__str__()
@@ -273,65 +328,31 @@ for task in TaskObjects:
             tasklist = [task]
         mp_to_task_map[(fs, expire_time, recursive)] = tasklist
 
-re_path = re.compile("^((" + '|'.join(taskpath['nonrecursive']) +
-                     ")@|(" + '|'.join(taskpath['recursive']) + ")[@/])")
 # Only proceed further if we are  going to generate any snapshots for this run
 if len(mp_to_task_map) > 0:
 
-    # Grab all existing snapshot and filter out the expiring ones
-    snapshots = {}
-    snapshots_pending_delete = []
-    previous_prefix = '/'
-    # Use -s name because its faster. See #18428
-    zfsproc = pipeopen("/sbin/zfs list -t snapshot -H -o name -s name", debug, logger=log)
-    lines = zfsproc.communicate()[0].split('\n')
-    # Sort it in python to behave the same way as without "-s name"
-    lines = sorted(lines, key=lambda x: x.split('@'))
-
-    reg_autosnap = re.compile('^auto-(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2}).'
-                              '(?P<hour>\d{2})(?P<minute>\d{2})-(?P<retcount>\d+)'
-                              '(?P<retunit>[hdwmy])$')
-    for snapshot_name in lines:
-        if snapshot_name != '':
-            fs, snapname = snapshot_name.split('@')
-            snapname_match = reg_autosnap.match(snapname)
-            if snapname_match is not None:
-                snap_infodict = snapname_match.groupdict()
-                snap_ret_policy = '%s%s' % (snap_infodict['retcount'], snap_infodict['retunit'])
-                if snap_expired(snap_infodict, snaptime):
-                    # Only delete the snapshot if there's a snapshot task enabled that created it.
-                    if re_path:
-                        if re_path.match(snapshot_name):
-                            # Destroy of expired snapshots is recursive, so only request so on the
-                            # toplevel.
-                            if fs.startswith(previous_prefix):
-                                if ('%s@%s' % (previous_prefix[:-1], snapname)) in snapshots_pending_delete:
-                                    continue
-                            else:
-                                previous_prefix = '%s/' % (fs)
-                            snapshots_pending_delete.append(snapshot_name)
-                else:
-                    if (fs, snap_ret_policy, True) in mp_to_task_map:
-                        if (fs, snap_ret_policy, True) in snapshots:
-                            last_snapinfo = snapshots[(fs, snap_ret_policy, True)]
-                            if snapinfodict2datetime(last_snapinfo) < snapinfodict2datetime(snap_infodict):
-                                snapshots[(fs, snap_ret_policy, True)] = snap_infodict
-                        else:
-                            snapshots[(fs, snap_ret_policy, True)] = snap_infodict
-                    if (fs, snap_ret_policy, False) in mp_to_task_map:
-                        if (fs, snap_ret_policy, False) in snapshots:
-                            last_snapinfo = snapshots[(fs, snap_ret_policy, False)]
-                            if snapinfodict2datetime(last_snapinfo) < snapinfodict2datetime(snap_infodict):
-                                snapshots[(fs, snap_ret_policy, False)] = snap_infodict
-                        else:
-                            snapshots[(fs, snap_ret_policy, False)] = snap_infodict
+    timings.append(('tasks', monotonic() - started))
+
+    # Snapshots are only destroyed if there's a snapshot task enabled that
+    # created them, so only list the snapshots of the task filesystems
+    started = monotonic()
+    lines = list_task_snapshots([(mpkey[0], mpkey[2]) for mpkey in mp_to_task_map])
+    timings.append(('list %d snapshots' % len(lines), monotonic() - started))
+
+    # Filter out the expiring ones and find the latest of every task
+    started = monotonic()
+    plan = RetentionPlan(mp_to_task_map, snaptime)
+    plan.add(lines)
+    snapshots = plan.latest
+    destroys = plan.destroys()
+    timings.append(('plan', monotonic() - started))
 
     list_mp = list(mp_to_task_map.keys())
 
     for mpkey in list_mp:
         tasklist = mp_to_task_map[mpkey]
         if mpkey in snapshots:
-            snapshot_time = snapinfodict2datetime(snapshots[mpkey])
+            snapshot_time = snapshots[mpkey]
             for taskindex in range(len(tasklist) - 1, -1, -1):
                 task = tasklist[taskindex]
                 if snapshot_time + timedelta(minutes=task.task_interval) > snaptime:
@@ -370,6 +391,16 @@ if len(mp_to_task_map) > 0:
                     log.warn("Error removing snapshot task: %s" % nr[0])
                 break
 
+    if args.dry_run:
+        for fs, expire, recursive in sorted(mp_to_task_map):
+            print('snapshot%s %s@auto-%s-%s' % (' -r' if recursive else '', fs, snaptime_str, expire))
+        for fs, names in destroys:
+            print('destroy -r -d %s@%s' % (fs, ','.join(names)))
+        for step, seconds in timings:
+            print('%s: %.3fs' % (step, seconds))
+        os.unlink('/var/run/autosnap.pid')
+        sys.exit(0)
+
     for mpkey, tasklist in list(mp_to_task_map.items()):
         fs, expire, recursive = mpkey
         if recursive:
@@ -603,20 +634,27 @@ Hello,
 
     MNTLOCK.lock()
     if not autorepl_running():
-        for snapshot in snapshots_pending_delete:
-            # snapshots with clones will have destruction deferred
-            snapcmd = '/sbin/zfs destroy -r -d "%s"' % (snapshot)
-            proc = pipeopen(snapcmd, logger=log)
-            err = proc.communicate()[1]
-            if proc.returncode != 0:
-                log.error("Failed to destroy snapshot '%s': %s", snapshot, err)
+        destroy_expired(destroys)
     else:
         log.debug("Autorepl running, skip destroying snapshots")
     MNTLOCK.unlock()
 
+    # Let the snapshot index of the middleware pick up the changes
+    try:
+        with client as c:
+            c.call(
+                'zfs.snapshot_index.refresh',
+                [mpkey[0] for mpkey in mp_to_task_map] + [fs for fs, names in destroys],
+            )
+    except Exception:
+        log.debug('Failed to refresh snapshot index', exc_info=True)
+
 
 os.unlink('/var/run/autosnap.pid')
 
+if args.dry_run:
+    sys.exit(0)
+
 if Replication.objects.exists():
     os.execl('/usr/local/bin/python',
              'python',
@@ -231,9 +231,49 @@ def main():
     poolthreshold = {}
     zpoollist = client.call('notifier.zpool_list')
 
+    is_freenas = client.call('notifier.is_freenas')
+
+    extents = [
+        Struct(extent)
+        for extent in client.call('datastore.query', 'services.iSCSITargetExtent')
+    ]
+
+    # Look up the devices and zvols backing the extents in batches instead of
+    # one round trip per extent.
+    disk_extents = [
+        extent for extent in extents
+        if extent.iscsi_target_extent_path and extent.iscsi_target_extent_type == 'Disk'
+    ]
+    disks = {}
+    for extent, disk in zip(disk_extents, client.call_many([
+        ('datastore.query', 'storage.Disk', [('disk_identifier', '=', extent.iscsi_target_extent_path)], {'order_by': ['disk_expiretime']})
+        for extent in disk_extents
+    ])):
+        if disk:
+            disks[extent.id] = Struct(disk[0])
+    devices = dict(zip(
+        [disk.disk_identifier for disk in disks.values() if not disk.disk_multipath_name],
+        client.call_many([
+            ('notifier.identifier_to_device', disk.disk_identifier)
+            for disk in disks.values() if not disk.disk_multipath_name
+        ]),
+    ))
+    zvolnames = sorted(set(
+        extent.iscsi_target_extent_path.split('/', 1)[1]
+        for extent in extents
+        if (
+            extent.iscsi_target_extent_path and extent.iscsi_target_extent_type != 'Disk' and
+            not extent.iscsi_target_extent_path.startswith("/mnt") and
+            extent.iscsi_target_extent_avail_threshold
+        )
+    ))
+    zvols = dict(zip(zvolnames, client.call_many([
+        ('notifier.zfs_list', zvolname, False, False, False, ['volume'])
+        for zvolname in zvolnames
+    ])))
+
     # Generate the LUN section
-    for extent in client.call('datastore.query', 'services.iSCSITargetExtent'):
-        extent = Struct(extent)
+    for extent in extents:
         path = extent.iscsi_target_extent_path
         if not path:
             log.warn('Path for extent id %d is null, skipping', extent.id)
@@ -242,14 +282,13 @@ def main():
         poolname = None
         lunthreshold = None
         if extent.iscsi_target_extent_type == 'Disk':
-            disk = client.call('datastore.query', 'storage.Disk', [('disk_identifier', '=', path)], {'order_by': ['disk_expiretime']})
+            disk = disks.get(extent.id)
             if not disk:
                 continue
-            disk = Struct(disk[0])
             if disk.disk_multipath_name:
                 path = "/dev/multipath/%s" % disk.disk_multipath_name
             else:
-                path = "/dev/%s" % client.call('notifier.identifier_to_device', disk.disk_identifier)
+                path = "/dev/%s" % devices[disk.disk_identifier]
         else:
             if not path.startswith("/mnt"):
                 poolname = path.split('/', 2)[1]
@@ -262,7 +301,7 @@ def main():
                         )
                 if extent.iscsi_target_extent_avail_threshold:
                     zvolname = path.split('/', 1)[1]
-                    zfslist = client.call('notifier.zfs_list', zvolname, False, False, False, ['volume'])
+                    zfslist = zvols.get(zvolname)
                     if zfslist:
                         lunthreshold = int(zfslist[zvolname]['volsize'] *
                                            (extent.iscsi_target_extent_avail_threshold / 100.0))
@@ -299,7 +338,7 @@ def main():
         if extent.iscsi_target_extent_legacy is True:
             addline('\toption vendor "FreeBSD"\n')
         else:
-            if client.call('notifier.is_freenas'):
+            if is_freenas:
                 addline('\toption vendor "FreeNAS"\n')
             else:
                 addline('\toption vendor "TrueNAS"\n')
@@ -326,11 +365,26 @@ def main():
 
     # Generate the target section
     target_basename = gconf.iscsi_basename
-    for target in client.call('datastore.query', 'services.iSCSITarget'):
-        target = Struct(target)
+    targets = [
+        Struct(target)
+        for target in client.call('datastore.query', 'services.iSCSITarget')
+    ]
+    # Fetch the groups, ports and LUN mappings of every target at once
+    targets_rels = client.call_many([
+        call
+        for target in targets
+        for call in (
+            ('datastore.query', 'services.iscsitargetgroups', [('iscsi_target', '=', target.id)]),
+            ('datastore.query', 'services.fibrechanneltotarget', [('fc_target', '=', target.id)]),
+            ('datastore.query', 'services.iscsitargettoextent', [('iscsi_target', '=', target.id), ('iscsi_lunid', '!=', None)]),
+            ('datastore.query', 'services.iscsitargettoextent', [('iscsi_target', '=', target.id)], {'extra': {'select': {'null_first': 'iscsi_lunid IS NULL'}}, 'order_by': ['null_first', 'iscsi_lunid']}),
+        )
+    ])
+    for i, target in enumerate(targets):
+        groups, fcports, used_t2e, t2es = targets_rels[i * 4:(i + 1) * 4]
 
         authgroups = {}
-        for grp in client.call('datastore.query', 'services.iscsitargetgroups', [('iscsi_target', '=', target.id)]):
+        for grp in groups:
             grp = Struct(grp)
             if grp.iscsi_target_authgroup:
                 auth_list = [
@@ -356,11 +410,11 @@ def main():
         elif target.iscsi_target_name:
             addline("\talias \"%s\"\n" % target.iscsi_target_name)
 
-        for fctt in client.call('datastore.query', 'services.fibrechanneltotarget', [('fc_target', '=', target.id)]):
+        for fctt in fcports:
             fctt = Struct(fctt)
             addline("\tport %s\n" % fctt.fc_port)
 
-        for grp in client.call('datastore.query', 'services.iscsitargetgroups', [('iscsi_target', '=', target.id)]):
+        for grp in groups:
             grp = Struct(grp)
             agname = authgroups.get(grp.id) or 'no-authentication'
             if gconf.iscsi_alua:
@@ -371,10 +425,10 @@ def main():
         addline("\n")
         used_lunids = [
             o['iscsi_lunid']
-            for o in client.call('datastore.query', 'services.iscsitargettoextent', [('iscsi_target', '=', target.id), ('iscsi_lunid', '!=', None)])
+            for o in used_t2e
         ]
         cur_lunid = 0
-        for t2e in client.call('datastore.query', 'services.iscsitargettoextent', [('iscsi_target', '=', target.id)], {'extra': {'select': {'null_first': 'iscsi_lunid IS NULL'}}, 'order_by': ['null_first', 'iscsi_lunid']}):
+        for t2e in t2es:
             t2e = Struct(t2e)
 
             if t2e.iscsi_lunid is None:
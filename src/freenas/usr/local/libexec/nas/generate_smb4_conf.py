@@ -3,6 +3,7 @@
 from middlewared.client import Client
 from middlewared.client.utils import Struct
 
+import bsd
 import os
 import pwd
 import re
@@ -50,6 +51,69 @@ from freenasUI.common.freenassysctl import freenas_sysctl as fs
 
 log = logging.getLogger('generate_smb4_conf')
 
+_mount_table = None
+
+
+class RunClient(object):
+    """
+    Middleware client caching, for the whole run, the directory service
+    lookups otherwise repeated for every share.
+    """
+
+    CACHED_CALLS = (
+        ('notifier.common', 'system', 'activedirectory_enabled'),
+        ('notifier.common', 'system', 'domaincontroller_enabled'),
+        ('notifier.common', 'system', 'ldap_enabled'),
+        ('notifier.common', 'system', 'ldap_has_samba_schema'),
+        ('notifier.directoryservice', 'AD'),
+    )
+
+    def __init__(self, client):
+        self.client = client
+        self.cache = {}
+
+    def call(self, method, *params, **kwargs):
+        key = (method, ) + params
+        if kwargs or key not in self.CACHED_CALLS:
+            return self.client.call(method, *params, **kwargs)
+        if key not in self.cache:
+            self.cache[key] = self.client.call(method, *params)
+        return self.cache[key]
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class MountTable(object):
+    """
+    Type of the filesystems mounted when the run started, by st_dev, read
+    once through getmntinfo(3).
+    """
+
+    def __init__(self):
+        self.fstypes = {}
+        # Later mounts hide the earlier ones on the same mount point
+        for mnt in bsd.getmntinfo():
+            try:
+                st = os.stat(mnt.dest)
+            except OSError:
+                continue
+            self.fstypes[st.st_dev] = mnt.fstype
+
+    def fstype(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return self.fstypes.get(st.st_dev)
+
+
+def get_mount_table():
+    global _mount_table
+    if _mount_table is None:
+        _mount_table = MountTable()
+    return _mount_table
+
 
 def qw(w):
     return '"%s"' % w.replace('"', '\\"')
@@ -300,41 +364,7 @@ def extend_vfs_objects_for_zfs(path, vfs_objects):
 
 
 def is_within_zfs(mountpoint):
-    try:
-        st = os.stat(mountpoint)
-    except:
-        return False
-
-    share_dev = st.st_dev
-
-    p = pipeopen("mount")
-
-    mount_out = p.communicate()
-    if p.returncode != 0:
-        return False
-    if mount_out:
-        mount_out = mount_out[0]
-
-    zfs_regex = re.compile("^(.*) on (/.*) \(zfs, .*\)$")
-
-    # The reversed is important as we would like the code to use
-    # the most specific (and therefore relevant) mount point.
-    for line in reversed(mount_out.split('\n')):
-        match = zfs_regex.match(line.strip())
-        if not match:
-            continue
-
-        mp = match.group(2)
-
-        try:
-            st = os.stat(mp)
-        except:
-            continue
-
-        if st.st_dev == share_dev:
-            return True
-
-    return False
+    return get_mount_table().fstype(mountpoint) == 'zfs'
 
 
 def get_sysctl(name):
@@ -1599,7 +1629,7 @@ def restore_secrets_database():
 
 
 def main():
-    client = Client()
+    client = RunClient(Client())
     smb_conf_path = "/usr/local/etc/smb4.conf"
 
     smb4_tdb = []
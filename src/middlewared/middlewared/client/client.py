@@ -322,6 +322,17 @@ class Client(object):
 
     def on_close(self, code, reason=None):
         self._closed.set()
+        # Wake up any caller still waiting for a result so a dropped
+        # connection fails fast instead of waiting for the call timeout.
+        for call in list(self._calls.values()):
+            call.errno = errno.ECONNABORTED
+            call.error = 'Connection closed'
+            call.returned.set()
+        self._calls.clear()
+
+    @property
+    def closed(self):
+        return self._closed.is_set()
 
     def _register_call(self, call):
         self._calls[call.id] = call
@@ -358,23 +369,30 @@ class Client(object):
         self._jobs_watching = True
         self.subscribe('core.get_jobs', self._jobs_callback)
 
-    def call(self, method, *params, **kwargs):
-        timeout = kwargs.pop('timeout', CALL_TIMEOUT)
-        job = kwargs.pop('job', False)
-
-        # We need to make sure we are subscribed to receive job updates
-        if job and not self._jobs_watching:
-            self._jobs_subscribe()
-
-        c = Call(method, params)
-        self._register_call(c)
-        self._send({
+    def _call_message(self, c):
+        return {
             'msg': 'method',
             'method': c.method,
             'id': c.id,
             'params': c.params,
-        })
+        }
 
+    def call_async(self, method, *params):
+        """
+        Send a method call without waiting for it to return.
+
+        Returns the pending `Call`, to be collected later with `wait_call`.
+        Any number of calls can be in flight over the same connection.
+        """
+        c = Call(method, params)
+        self._register_call(c)
+        self._send(self._call_message(c))
+        return c
+
+    def wait_call(self, c, timeout=CALL_TIMEOUT):
+        """
+        Wait for a call issued by `call_async` and return its result.
+        """
         if not c.returned.wait(timeout):
             self._unregister_call(c)
             raise CallTimeout("Call timeout")
@@ -384,6 +402,54 @@ class Client(object):
                 raise ValidationErrors(c.extra)
             raise ClientException(c.error, c.errno, c.trace, c.extra)
 
+        return c.result
+
+    def call_many(self, calls, timeout=CALL_TIMEOUT):
+        """
+        Pipeline many method calls in a single `batch` message.
+
+        Arguments:
+           :calls(list): list of (method, *params) tuples
+           :timeout(int): time to wait for all the calls to return
+
+        Returns the list of results in the same order as `calls`.
+        The first call to fail raises its exception.
+        """
+        pending = []
+        for method, *params in calls:
+            c = Call(method, params)
+            self._register_call(c)
+            pending.append(c)
+
+        if not pending:
+            return []
+
+        self._send({
+            'msg': 'batch',
+            'calls': [self._call_message(c) for c in pending],
+        })
+
+        endtime = time.monotonic() + timeout
+        try:
+            return [
+                self.wait_call(c, max(endtime - time.monotonic(), 0.001))
+                for c in pending
+            ]
+        finally:
+            for c in pending:
+                self._unregister_call(c)
+
+    def call(self, method, *params, **kwargs):
+        timeout = kwargs.pop('timeout', CALL_TIMEOUT)
+        job = kwargs.pop('job', False)
+
+        # We need to make sure we are subscribed to receive job updates
+        if job and not self._jobs_watching:
+            self._jobs_subscribe()
+
+        c = self.call_async(method, *params)
+        c.result = self.wait_call(c, timeout)
+
         if job:
             job_id = c.result
             # If a job event has been received already then we must set an Event
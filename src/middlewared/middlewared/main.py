@@ -1,6 +1,6 @@
 from .apidocs import app as apidocs_app
 from .client import ejson as json
-from .job import Job, JobsQueue
+from .job import Job, JobsQueue, State
 from .restful import RESTfulAPI
 from .schema import ResolverError, Error as SchemaError
 from .service import CallError, CallException, ValidationError, ValidationErrors
@@ -25,6 +25,7 @@ import select
 import setproctitle
 import signal
 import sys
+import tempfile
 import threading
 import time
 import traceback
@@ -255,6 +256,14 @@ class Application(object):
         if message['msg'] == 'method':
             asyncio.ensure_future(self.call_method(message))
             return
+        elif message['msg'] == 'batch':
+            # Many method calls in a single frame. Each one is dispatched
+            # concurrently and answered with its own `result` message.
+            for call in message.get('calls') or []:
+                if call.get('msg', 'method') != 'method' or 'id' not in call:
+                    continue
+                asyncio.ensure_future(self.call_method(call))
+            return
         elif message['msg'] == 'ping':
             pong = {'msg': 'pong'}
             if 'id' in message:
@@ -272,6 +281,10 @@ class Application(object):
             self.unsubscribe(message['id'])
 
 
+# Size of the chunks streamed between HTTP requests and job pipes
+FILE_CHUNK_SIZE = 1024 * 1024
+
+
 class FileApplication(object):
 
     def __init__(self, middleware):
@@ -319,24 +332,55 @@ class FileApplication(object):
         })
         await resp.prepare(request)
 
-        f = None
+        reader, transport = await self._pipe_reader(job.read_fd)
         try:
-            def read_write():
-                f = os.fdopen(job.read_fd, 'rb')
-                while True:
-                    read = f.read(1024)
-                    if read == b'':
-                        break
-                    resp.write(read)
-                    #await web.drain()
-            await self.middleware.threaded(read_write)
-            await resp.drain()
-
+            while True:
+                read = await reader.read(FILE_CHUNK_SIZE)
+                if read == b'':
+                    break
+                resp.write(read)
+                # Do not read faster than the client downloads
+                await resp.drain()
         finally:
-            if f:
-                f.close()
+            transport.close()
         return resp
 
+    async def _pipe_reader(self, fd):
+        loop = asyncio.get_event_loop()
+        reader = asyncio.StreamReader(limit=FILE_CHUNK_SIZE)
+        transport, protocol = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb'),
+        )
+        return reader, transport
+
+    async def _pipe_writer(self, fd):
+        loop = asyncio.get_event_loop()
+        transport, protocol = await loop.connect_write_pipe(
+            asyncio.streams.FlowControlMixin, os.fdopen(fd, 'wb'),
+        )
+        return asyncio.StreamWriter(transport, protocol, None, loop)
+
+    async def _abort_upload(self, job, writer):
+        # The job must not take the end of what was received for the end of
+        # the file, so it is aborted before its input gets closed. A job
+        # still waiting for its lock has to start to be aborted.
+        try:
+            while job.future is None and job.state == State.WAITING:
+                await asyncio.sleep(0.5)
+            job.abort()
+            await job.wait()
+        finally:
+            writer.close()
+
+    async def _copy_part(self, part, writer):
+        while True:
+            read = await part.read_chunk(FILE_CHUNK_SIZE)
+            if read == b'':
+                break
+            writer.write(read)
+            # Wait for the job to consume what was written so far
+            await writer.drain()
+
     async def upload(self, request):
 
         denied = True
@@ -364,42 +408,81 @@ class FileApplication(object):
             resp.set_status(401)
             return resp
 
-        form = {}
-        reader = await request.multipart()
-        while True:
-            part = await reader.next()
-            if part is None:
-                break
-            form[part.name] = await part.read()  # FIXME: handle big files
-
-        if 'data' not in form or 'file' not in form:
-            resp = web.Response(status=405, reason='Expected data not on payload')
-            resp.set_status(405)
-            return resp
-
-        try:
-            data = json.loads(form['data'])
-            job = await self.middleware.call(data['method'], *(data.get('params') or []))
-        except Exception:
-            resp = web.Response()
-            resp.set_status(405)
-            return resp
+        # The file is streamed to the job as it is received. The job is only
+        # started once the "file" part shows up, with the "data" part known:
+        # should the file come first it is spooled to disk until then.
+        data = None
+        spool = None
+        job = None
+        writer = None
+        complete = False
+
+        async def start_job():
+            nonlocal job, writer
+            try:
+                job = await self.middleware.call(data['method'], *(data.get('params') or []))
+            except Exception:
+                return False
+            writer = await self._pipe_writer(job.write_fd)
+            return True
 
-        f = None
+        reader = await request.multipart()
         try:
-            def read_write():
-                f = os.fdopen(job.write_fd, 'wb')
-                i = 0
+            while True:
+                part = await reader.next()
+                if part is None:
+                    break
+                if part.name == 'data':
+                    try:
+                        data = json.loads(await part.text())
+                    except Exception:
+                        resp = web.Response()
+                        resp.set_status(405)
+                        return resp
+                elif part.name == 'file' and job is None:
+                    if data is not None:
+                        if not await start_job():
+                            resp = web.Response()
+                            resp.set_status(405)
+                            return resp
+                        await self._copy_part(part, writer)
+                    else:
+                        spool = tempfile.TemporaryFile()
+                        while True:
+                            read = await part.read_chunk(FILE_CHUNK_SIZE)
+                            if read == b'':
+                                break
+                            await self.middleware.threaded(spool.write, read)
+                else:
+                    await part.release()
+
+            if job is None and data is not None and spool is not None:
+                if not await start_job():
+                    resp = web.Response()
+                    resp.set_status(405)
+                    return resp
+                spool.seek(0)
                 while True:
-                    read = form['file'][i* 1024:(i + 1) * 1024]
+                    read = await self.middleware.threaded(spool.read, FILE_CHUNK_SIZE)
                     if read == b'':
                         break
-                    f.write(read)
-                    i += 1
-            await self.middleware.threaded(read_write)
+                    writer.write(read)
+                    await writer.drain()
+            complete = True
         finally:
-            if f:
-                f.close()
+            if spool is not None:
+                spool.close()
+            if writer is not None:
+                if complete:
+                    writer.close()
+                else:
+                    # Client gone or bad request body in the middle of the file
+                    asyncio.ensure_future(self._abort_upload(job, writer))
+
+        if job is None:
+            resp = web.Response(status=405, reason='Expected data not on payload')
+            resp.set_status(405)
+            return resp
 
         resp = web.Response(
             status=200,
@@ -4,12 +4,215 @@ from middlewared.utils import Popen
 
 import asyncio
 import boto3
+import concurrent.futures
 import os
 import subprocess
 import re
+import stat
 import tempfile
+import threading
+
+# Smallest part S3 accepts but for the last one, and most parts in an upload
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+# Largest part of an upload of unknown size, i.e. several hundred GiB in
+# MAX_PARTS parts
+MAX_STREAM_PART_SIZE = 128 * 1024 * 1024
+# Size of the ranges of a download
+DOWNLOAD_PART_SIZE = 16 * 1024 * 1024
+# Parts transferred at the same time for a single object
+TRANSFER_WORKERS = 4
+# Memory the parts of a single transfer may use. With parts larger than a
+# share of it fewer are transferred at once, down to one at a time.
+TRANSFER_MEMORY = 256 * 1024 * 1024
+
+
+def part_size_for(size):
+    """
+    Part size fitting an object of `size` bytes in MAX_PARTS parts, in
+    whole MiB.
+    """
+    mib = 1024 * 1024
+    part_size = -(-size // MAX_PARTS)
+    part_size = -(-part_size // mib) * mib
+    return min(max(part_size, MIN_PART_SIZE), MAX_PART_SIZE)
+
+
+def part_sizes(size=None):
+    """
+    Sizes of the parts of an upload of `size` bytes or, if it is not known,
+    growing sizes doubling every thousand parts up to MAX_STREAM_PART_SIZE
+    so that small streams use small parts.
+    """
+    if size is not None:
+        part_size = part_size_for(size)
+        while True:
+            yield part_size
+    idx = 0
+    while True:
+        yield min(MIN_PART_SIZE << (idx // 1000), MAX_STREAM_PART_SIZE)
+        idx += 1
+
+
+class MemoryBudget(object):
+    """
+    Bytes of memory held by the parts of a transfer. A part larger than the
+    whole budget is let through on its own.
+    """
+
+    def __init__(self, size=TRANSFER_MEMORY):
+        self.size = size
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, amount):
+        with self.cond:
+            while self.used and self.used + amount > self.size:
+                self.cond.wait()
+            self.used += amount
+
+    def release(self, amount):
+        with self.cond:
+            self.used -= amount
+            self.cond.notify_all()
+
+
+def read_full(f, size):
+    """
+    Read `size` bytes from `f` unless it ends first, pipes returning short
+    reads.
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    read = 0
+    while read < size:
+        n = f.readinto(view[read:])
+        if not n:
+            break
+        read += n
+    view.release()
+    if read < size:
+        del buf[read:]
+    return buf
+
+
+def upload(client, bucket, key, f, size=None, workers=TRANSFER_WORKERS):
+    """
+    Upload the content of file object `f` to `key` as a multipart upload,
+    `workers` parts at a time within TRANSFER_MEMORY, read sequentially so
+    `f` may be a pipe.
+
+    The upload is aborted on failure so no orphaned parts are left behind.
+    """
+    sizes = part_sizes(size)
+    part_size = next(sizes)
+    chunk = read_full(f, part_size)
+    if len(chunk) < MIN_PART_SIZE:
+        # Fits a single request
+        client.put_object(Bucket=bucket, Key=key, Body=chunk)
+        return
+
+    mp = client.create_multipart_upload(Bucket=bucket, Key=key)
+    upload_id = mp['UploadId']
+    budget = MemoryBudget()
+    budget.acquire(part_size)
+
+    def upload_part(idx, chunk, reserved):
+        try:
+            resp = client.upload_part(
+                Bucket=bucket,
+                Key=key,
+                PartNumber=idx,
+                UploadId=upload_id,
+                ContentLength=len(chunk),
+                Body=chunk,
+            )
+            return {'ETag': resp['ETag'], 'PartNumber': idx}
+        finally:
+            budget.release(reserved)
+
+    futures = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            idx = 1
+            while chunk:
+                if idx > MAX_PARTS:
+                    budget.release(part_size)
+                    raise ValueError('{} is too large for a multipart upload'.format(key))
+                futures.append(executor.submit(upload_part, idx, chunk, part_size))
+                chunk = None
+                # Stop reading as soon as a part failed
+                failed = next((fut for fut in futures if fut.done() and fut.exception()), None)
+                if failed is not None:
+                    failed.result()
+                part_size = next(sizes)
+                # Memory for the next part is reserved before reading it
+                budget.acquire(part_size)
+                chunk = read_full(f, part_size)
+                if not chunk:
+                    budget.release(part_size)
+                idx += 1
+            parts = [fut.result() for fut in futures]
+
+        client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={
+                'Parts': parts
+            }
+        )
+    except BaseException:
+        for fut in futures:
+            fut.cancel()
+        client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+
+def download(client, bucket, key, f, workers=TRANSFER_WORKERS):
+    """
+    Download `key` to file object `f` in ranges fetched `workers` at a time
+    and written in order, so `f` may be a pipe.
+    """
+    head = client.head_object(Bucket=bucket, Key=key)
+    size = head['ContentLength']
+    part_size = DOWNLOAD_PART_SIZE
+    if size <= part_size:
+        body = client.get_object(Bucket=bucket, Key=key)['Body']
+        while True:
+            chunk = body.read(MIN_PART_SIZE)
+            if chunk == b'':
+                break
+            f.write(chunk)
+        return
+
+    def get_range(start):
+        end = min(start + part_size, size) - 1
+        # IfMatch makes sure all the ranges come from the same object
+        obj = client.get_object(
+            Bucket=bucket,
+            Key=key,
+            Range='bytes={}-{}'.format(start, end),
+            IfMatch=head['ETag'],
+        )
+        return obj['Body'].read()
 
-CHUNK_SIZE = 5 * 1024 * 1024
+    # Ranges fetched but not written yet
+    inflight = max(1, min(workers + 1, TRANSFER_MEMORY // part_size))
+    pending = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for start in range(0, size, part_size):
+                pending.append(executor.submit(get_range, start))
+                if len(pending) >= inflight:
+                    f.write(pending.pop(0).result())
+            for fut in pending:
+                f.write(fut.result())
+        except BaseException:
+            for fut in pending:
+                fut.cancel()
+            raise
 
 
 class BackupCredentialService(CRUDService):
@@ -281,64 +484,26 @@ region = {region}
         client = await self.get_client(backup['id'])
         folder = backup['attributes']['folder'] or ''
         key = os.path.join(folder, filename)
-        parts = []
-        idx = 1
 
-        try:
+        def do_upload():
             with os.fdopen(read_fd, 'rb') as f:
-                mp = client.create_multipart_upload(
-                    Bucket=backup['attributes']['bucket'],
-                    Key=key
-                )
+                st = os.fstat(f.fileno())
+                size = st.st_size if stat.S_ISREG(st.st_mode) else None
+                upload(client, backup['attributes']['bucket'], key, f, size=size)
 
-                while True:
-                    chunk = f.read(CHUNK_SIZE)
-                    if chunk == b'':
-                        break
-
-                    resp = client.upload_part(
-                        Bucket=backup['attributes']['bucket'],
-                        Key=key,
-                        PartNumber=idx,
-                        UploadId=mp['UploadId'],
-                        ContentLength=CHUNK_SIZE,
-                        Body=chunk
-                    )
-
-                    parts.append({
-                        'ETag': resp['ETag'],
-                        'PartNumber': idx
-                    })
-
-                    idx += 1
-
-                client.complete_multipart_upload(
-                    Bucket=backup['attributes']['bucket'],
-                    Key=key,
-                    UploadId=mp['UploadId'],
-                    MultipartUpload={
-                        'Parts': parts
-                    }
-                )
-        finally:
-            pass
+        await self.middleware.threaded(do_upload)
 
     @private
     async def get(self, backup, filename, write_fd):
         client = await self.get_client(backup['id'])
         folder = backup['attributes']['folder'] or ''
         key = os.path.join(folder, filename)
-        obj = client.get_object(
-            Bucket=backup['attributes']['bucket'],
-            Key=key
-        )
 
-        with os.fdopen(write_fd, 'wb') as f:
-            while True:
-                chunk = obj['Body'].read(CHUNK_SIZE)
-                if chunk == b'':
-                    break
-                f.write(chunk)
+        def do_download():
+            with os.fdopen(write_fd, 'wb') as f:
+                download(client, backup['attributes']['bucket'], key, f)
+
+        await self.middleware.threaded(do_download)
 
     @private
     async def ls(self, cred_id, bucket, path):
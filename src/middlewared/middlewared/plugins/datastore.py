@@ -13,7 +13,7 @@ if not apps.ready:
     django.setup()
 
 from django.apps import apps
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import Q
 from django.db.models.fields.related import ForeignKey
 
@@ -94,6 +94,8 @@ class DatastoreService(Service):
             List('order_by'),
             Bool('count'),
             Bool('get'),
+            Int('offset'),
+            Int('limit'),
             Str('prefix'),
             register=True,
         ),
@@ -110,6 +112,9 @@ class DatastoreService(Service):
             OPERATOR: ('=' | '!=' | '>' | '>=' | '<' | '<=' | '~' | 'in' | 'nin')
             CONJUNCTION: 'OR'
 
+        `options` may also contain `offset` and `limit` to return a range of
+        the (sorted) result.
+
         e.g.
 
         `['OR', [ ['username', '=', 'root' ], ['uid', '=', 0] ] ]`
@@ -162,6 +167,11 @@ class DatastoreService(Service):
         if options.get('count') is True:
             return qs.count()
 
+        offset = options.get('offset') or 0
+        limit = options.get('limit')
+        if offset or limit is not None:
+            qs = qs[offset:None if limit is None else offset + limit]
+
         result = []
         async for i in self.__queryset_serialize(
             qs, extend=options.get('extend'), field_prefix=options.get('prefix')
@@ -246,6 +256,55 @@ class DatastoreService(Service):
         await self.middleware.threaded(lambda oid: model.objects.get(pk=oid).delete(), id)
         return True
 
+    @private
+    @accepts(Str('name'), List('operations'), Dict('options', Str('prefix')))
+    def bulk(self, name, operations, options=None):
+        """
+        Apply many `operations` to `name` within a single transaction.
+
+        Each operation is a list in the form of [type, id, data] where
+        type is one of "insert", "update" or "delete" (id is ignored for
+        inserts and data for deletes).
+
+        Returns the list of primary keys of the affected entries.
+        """
+        options = options or {}
+        prefix = options.get('prefix') or ''
+        model = self.__get_model(name)
+        fks = {
+            field.name: field
+            for field in model._meta.fields
+            if isinstance(field, ForeignKey)
+        }
+
+        def to_fields(data):
+            fields = {}
+            for k, v in data.items():
+                k = f'{prefix}{k}'
+                if k in fks and v is not None and not isinstance(v, fks[k].rel.to):
+                    v = fks[k].rel.to.objects.get(pk=v)
+                fields[k] = v
+            return fields
+
+        pks = []
+        with transaction.atomic():
+            for op, oid, data in operations:
+                if op == 'insert':
+                    obj = model(**to_fields(data))
+                elif op == 'update':
+                    obj = model.objects.get(pk=oid)
+                    for k, v in to_fields(data).items():
+                        setattr(obj, k, v)
+                elif op == 'delete':
+                    model.objects.get(pk=oid).delete()
+                    pks.append(oid)
+                    continue
+                else:
+                    raise ValueError(f'Invalid operation: {op}')
+                obj.save()
+                pks.append(obj.pk)
+        return pks
+
     @private
     def sql(self, query, params=None):
         cursor = connection.cursor()
@@ -260,6 +319,23 @@ class DatastoreService(Service):
             cursor.close()
         return rv
 
+    @private
+    def sql_batch(self, queries):
+        """
+        Execute a list of [query, params] within a single transaction,
+        used to replicate writes from the other node.
+        """
+        with transaction.atomic():
+            cursor = connection.cursor()
+            try:
+                for query, params in queries:
+                    if params is None:
+                        cursor.executelocal(query)
+                    else:
+                        cursor.executelocal(query, params)
+            finally:
+                cursor.close()
+
     @private
     @accepts(List('queries'))
     def restore(self, queries):
@@ -278,3 +354,13 @@ class DatastoreService(Service):
         # FIXME: This could return a few hundred KB of data,
         # we need to investigate a way of doing that in chunks.
         return connection.dump()
+
+
+async def _event_carp(middleware, event_type, args):
+    sqlite3_ha_base.invalidate_failover_status()
+
+
+def setup(middleware):
+    # Replication of writes depends on the failover status, which changes
+    # along with CARP
+    middleware.event_subscribe('devd.carp', _event_carp)
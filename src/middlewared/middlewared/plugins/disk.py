@@ -18,6 +18,7 @@ from middlewared.utils import Popen, run
 # in middlewared
 if '/usr/local/www' not in sys.path:
     sys.path.insert(0, '/usr/local/www')
+from freenasUI.middleware import geom as geom_topology
 from freenasUI.services.utils import SmartAlert
 
 DISK_EXPIRECACHE_DAYS = 7
@@ -116,9 +117,10 @@ class DiskService(CRUDService):
             units[int(unit)] = int(port)
         return units
 
-    async def __get_smartctl_args(self, devname):
+    async def __get_smartctl_args(self, devname, camcontrol=None):
         args = [f'/dev/{devname}']
-        camcontrol = await self.__camcontrol_list()
+        if camcontrol is None:
+            camcontrol = await self.__camcontrol_list()
         info = camcontrol.get(devname)
         if info is not None:
             if info.get('drv') == 'rr274x_3x':
@@ -170,8 +172,8 @@ class DiskService(CRUDService):
         await run('/usr/local/sbin/smartctl', '--smart=on', *args, check=False)
 
     @private
-    async def serial_from_device(self, name):
-        args = await self.__get_smartctl_args(name)
+    async def serial_from_device(self, name, camcontrol=None):
+        args = await self.__get_smartctl_args(name, camcontrol=camcontrol)
         p1 = await Popen(['smartctl', '-i'] + args, stdout=subprocess.PIPE)
         output = (await p1.communicate())[0].decode()
         search = re.search(r'Serial Number:\s+(?P<serial>.+)', output, re.I)
@@ -292,6 +294,9 @@ class DiskService(CRUDService):
     async def sync_all(self):
         """
         Synchronyze all disks with the cache in database.
+
+        The target state of every disk is computed in memory from a single
+        GEOM snapshot and all changes are written in one transaction.
         """
         # Skip sync disks on backup node
         if (
@@ -301,43 +306,80 @@ class DiskService(CRUDService):
         ):
             return
 
-        sys_disks = list((await self.middleware.call('device.get_info', 'DISK')).keys())
-
+        geom_topology.invalidate()
+        topology = await self.middleware.threaded(geom_topology.get_topology)
+        sys_disks = [name for name in topology.geom_names('DISK') if not name.startswith('cd')]
+
+        smart_serials = None
+
+        async def get_smart_serials():
+            """
+            Serials of the disks not reporting one to GEOM, only asked to
+            the disks the first time it is needed.
+            """
+            nonlocal smart_serials
+            if smart_serials is None:
+                smart_serials = await self.__serials_from_devices([
+                    name for name in sys_disks if not (topology.disk_info(name) or {}).get('ident')
+                ])
+            return smart_serials
+
+        def update_from_geom(disk, name):
+            """
+            Update `disk` with information from GEOM and return its
+            serial (with lunid) to spot multipath disks.
+            """
+            reg = RE_DSKNAME.search(name)
+            if reg:
+                disk['disk_subsystem'] = reg.group(1)
+                disk['disk_number'] = int(reg.group(2))
+            serial = ''
+            info = topology.disk_info(name)
+            if info:
+                if info['ident']:
+                    serial = disk['disk_serial'] = info['ident']
+                serial += info['lunid']
+                if info['mediasize']:
+                    disk['disk_size'] = str(info['mediasize'])
+            return serial
+
+        now = datetime.utcnow()
+        expiretime = now + timedelta(days=DISK_EXPIRECACHE_DAYS)
+        operations = []
+        extra = []
+        db_disks = {}
         seen_disks = {}
         serials = []
-        await self.middleware.threaded(geom.scan)
         for disk in (await self.middleware.call('datastore.query', 'storage.disk', [], {'order_by': ['disk_expiretime']})):
-
-            name = await self.middleware.call('notifier.identifier_to_device', disk['disk_identifier'])
+            original = disk.copy()
+            db_disks[disk['disk_identifier']] = disk
+
+            name = topology.identifier_to_device(disk['disk_identifier'])
+            if not name and disk['disk_identifier'].startswith('{serial}'):
+                serial = disk['disk_identifier'][len('{serial}'):]
+                for devname, smart_serial in (await get_smart_serials()).items():
+                    if smart_serial == serial:
+                        name = devname
+                        break
             if not name or name in seen_disks:
                 # If we cant translate the indentifier to a device, give up
                 # If name has already been seen once then we are probably
                 # dealing with with multipath here
                 if not disk['disk_expiretime']:
-                    disk['disk_expiretime'] = datetime.utcnow() + timedelta(days=DISK_EXPIRECACHE_DAYS)
-                    await self.middleware.call('datastore.update', 'storage.disk', disk['disk_identifier'], disk)
-                elif disk['disk_expiretime'] < datetime.utcnow():
+                    disk['disk_expiretime'] = expiretime
+                    operations.append(['update', disk['disk_identifier'], disk])
+                elif disk['disk_expiretime'] < now:
                     # Disk expire time has surpassed, go ahead and remove it
-                    await self.middleware.call('datastore.delete', 'storage.disk', disk['disk_identifier'])
+                    operations.append(['delete', disk['disk_identifier'], None])
+                    db_disks.pop(disk['disk_identifier'])
                 continue
             else:
                 disk['disk_expiretime'] = None
                 disk['disk_name'] = name
 
-            reg = RE_DSKNAME.search(name)
-            if reg:
-                disk['disk_subsystem'] = reg.group(1)
-                disk['disk_number'] = int(reg.group(2))
-            serial = ''
-            g = geom.geom_by_name('DISK', name)
-            if g:
-                if g.provider.config['ident']:
-                    serial = disk['disk_serial'] = g.provider.config['ident']
-                serial += g.provider.config.get('lunid') or ''
-                if g.provider.mediasize:
-                    disk['disk_size'] = g.provider.mediasize
+            serial = update_from_geom(disk, name)
             if not disk.get('disk_serial'):
-                serial = disk['disk_serial'] = await self.serial_from_device(name) or ''
+                serial = disk['disk_serial'] = (await get_smart_serials()).get(name) or ''
 
             if serial:
                 serials.append(serial)
@@ -345,51 +387,69 @@ class DiskService(CRUDService):
             # If for some reason disk is not identified as a system disk
             # mark it to expire.
             if name not in sys_disks and not disk['disk_expiretime']:
-                    disk['disk_expiretime'] = datetime.utcnow() + timedelta(days=DISK_EXPIRECACHE_DAYS)
-            await self.middleware.call('datastore.update', 'storage.disk', disk['disk_identifier'], disk)
+                    disk['disk_expiretime'] = expiretime
+            if disk != original:
+                operations.append(['update', disk['disk_identifier'], disk])
 
-            # FIXME: use a truenas middleware plugin
-            await self.middleware.call('notifier.sync_disk_extra', disk['disk_identifier'], False)
+            extra.append((disk['disk_identifier'], False))
             seen_disks[name] = disk
 
         for name in sys_disks:
-            if name not in seen_disks:
-                disk_identifier = await self.device_to_identifier(name)
-                qs = await self.middleware.call('datastore.query', 'storage.disk', [('disk_identifier', '=', disk_identifier)])
-                if qs:
-                    new = False
-                    disk = qs[0]
+            if name in seen_disks:
+                continue
+            if (topology.disk_info(name) or {}).get('ident'):
+                disk_identifier = topology.device_to_identifier(name)
+            else:
+                disk_identifier = topology.device_to_identifier(
+                    name, serial=(await get_smart_serials()).get(name)
+                )
+            disk = db_disks.get(disk_identifier)
+            if disk is not None:
+                new = False
+            else:
+                new = True
+                disk = {'disk_identifier': disk_identifier}
+            disk['disk_name'] = name
+            serial = update_from_geom(disk, name)
+            if not disk.get('disk_serial'):
+                serial = disk['disk_serial'] = (await get_smart_serials()).get(name) or ''
+            if serial:
+                if serial in serials:
+                    # Probably dealing with multipath here, do not add another
+                    continue
                 else:
-                    new = True
-                    disk = {'disk_identifier': disk_identifier}
-                disk['disk_name'] = name
-                serial = ''
-                g = geom.geom_by_name('DISK', name)
-                if g:
-                    if g.provider.config['ident']:
-                        serial = disk['disk_serial'] = g.provider.config['ident']
-                    serial += g.provider.config.get('lunid') or ''
-                    if g.provider.mediasize:
-                        disk['disk_size'] = g.provider.mediasize
-                if not disk.get('disk_serial'):
-                    serial = disk['disk_serial'] = await self.serial_from_device(name) or ''
-                if serial:
-                    if serial in serials:
-                        # Probably dealing with multipath here, do not add another
-                        continue
-                    else:
-                        serials.append(serial)
-                reg = RE_DSKNAME.search(name)
-                if reg:
-                    disk['disk_subsystem'] = reg.group(1)
-                    disk['disk_number'] = int(reg.group(2))
+                    serials.append(serial)
 
-                if not new:
-                    await self.middleware.call('datastore.update', 'storage.disk', disk['disk_identifier'], disk)
-                else:
-                    disk['disk_identifier'] = await self.middleware.call('datastore.insert', 'storage.disk', disk)
-                # FIXME: use a truenas middleware plugin
-                await self.middleware.call('notifier.sync_disk_extra', disk['disk_identifier'], True)
+            if not new:
+                operations.append(['update', disk['disk_identifier'], disk])
+            else:
+                operations.append(['insert', None, disk])
+                db_disks[disk_identifier] = disk
+            extra.append((disk['disk_identifier'], True))
+
+        if operations:
+            await self.middleware.call('datastore.bulk', 'storage.disk', operations)
+
+        for disk_identifier, add in extra:
+            # FIXME: use a truenas middleware plugin
+            await self.middleware.call('notifier.sync_disk_extra', disk_identifier, add)
+
+    async def __serials_from_devices(self, names, concurrency=8):
+        """
+        Ask the serial of every disk in `names` through smartctl, running
+        at most `concurrency` processes at once.
+
+        Returns:
+            dict(devname) = serial
+        """
+        camcontrol = await self.__camcontrol_list()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def serial(name):
+            async with semaphore:
+                return await self.serial_from_device(name, camcontrol=camcontrol)
+
+        return dict(zip(names, await asyncio.gather(*[serial(name) for name in names])))
 
     async def __multipath_create(self, name, consumers, mode=None):
         """
@@ -823,6 +883,14 @@ async def _event_devfs(middleware, event_type, args):
                 pass
 
 
+async def _event_geom(middleware, event_type, args):
+    geom_topology.invalidate()
+
+
 def setup(middleware):
+    # GEOM topology cache is kept up to date using devd events
+    geom_topology.watch()
+    middleware.event_subscribe('devd.geom', _event_geom)
+    middleware.event_subscribe('devd.devfs', _event_geom)
     # Listen to DEVFS events so we can sync on disk attach/detach
     middleware.event_subscribe('devd.devfs', _event_devfs)
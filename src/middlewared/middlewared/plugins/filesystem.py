@@ -1,10 +1,18 @@
 from middlewared.schema import Bool, Dict, Int, Ref, Str, accepts
-from middlewared.service import private, CallError, Service
+from middlewared.service import job, private, CallError, Service
 from middlewared.utils import filter_list
 
 import binascii
 import errno
 import os
+import sys
+import time
+
+if '/usr/local/www' not in sys.path:
+    sys.path.append('/usr/local/www')
+
+from freenasUI.common.acl import ACL_APPLY_BATCH_SIZE, ACL_APPLY_WORKERS
+from freenasUI.common.freenasacl import ACL_Hierarchy
 
 
 class FilesystemService(Service):
@@ -138,3 +146,54 @@ class FilesystemService(Service):
                 f.seek(options['offset'])
             data = binascii.b2a_base64(f.read(options.get('maxlen'))).decode().strip()
         return data
+
+    @accepts(
+        Str('path'),
+        Dict(
+            'acl-defaults',
+            Bool('dry_run', default=False),
+            Int('workers', default=ACL_APPLY_WORKERS),
+            Int('batch_size', default=ACL_APPLY_BATCH_SIZE),
+        ),
+    )
+    @job(lock=lambda args: f'acl_defaults:{args[0]}')
+    def acl_defaults(self, job, path, options):
+        """
+        Recursively reset the ACL of `path` and everything below it to the
+        Windows or Unix defaults, depending on the `.windows` file in `path`.
+
+        `dry_run` only walks the tree, which tells how long the walk itself
+        takes.
+
+        Returns the number of paths and the time it took.
+        """
+        if not os.path.isdir(path):
+            raise CallError(f'Path {path} is not a directory', errno.ENOTDIR)
+
+        # Inodes used in the filesystem, which is the whole tree for the root
+        # of a dataset, to give some idea of how far we are
+        st = os.statvfs(path)
+        total = max(st.f_files - st.f_ffree, 1)
+
+        last_update = [0]
+
+        def progress(done):
+            now = time.monotonic()
+            if now - last_update[0] < 1:
+                return
+            last_update[0] = now
+            job.set_progress(
+                min(int(done * 100 / total), 99), f'{done} paths done', extra={'paths': done},
+            )
+
+        job.set_progress(0, 'Computing target ACLs' if not options['dry_run'] else 'Walking')
+        acl = ACL_Hierarchy(path)
+        try:
+            result = acl.apply_defaults(
+                workers=options['workers'], batch_size=options['batch_size'],
+                dry_run=options['dry_run'], progress=progress,
+            )
+        finally:
+            acl.close()
+        job.set_progress(100, f'{result["paths"]} paths done', extra={'paths': result['paths']})
+        return result
@@ -6,12 +6,11 @@ import subprocess
 import sysctl
 
 import bsd
-import libzfs
 
 from middlewared.job import JobProgressBuffer
 from middlewared.schema import accepts, Int, Str
 from middlewared.service import filterable, item_method, job, private, CRUDService
-from middlewared.utils import Popen, run
+from middlewared.utils import Popen, parse_rsync_progress, read_lines, run
 
 logger = logging.getLogger(__name__)
 
@@ -115,14 +114,10 @@ class PoolService(CRUDService):
         If pool is encrypted we need to check if the pool is imported
         or if all geli providers exist.
         """
-        try:
-            zpool = libzfs.ZFS().get(pool['name'])
-        except libzfs.ZFSException:
-            zpool = None
-
+        zpool = await self.middleware.call('zfs.state.pools', [('name', '=', pool['name'])])
         if zpool:
-            pool['status'] = zpool.status
-            pool['scan'] = zpool.scrub.__getstate__()
+            pool['status'] = zpool[0]['status']
+            pool['scan'] = zpool[0]['scan']
         else:
             pool.update({
                 'status': 'OFFLINE',
@@ -226,40 +221,40 @@ class PoolService(CRUDService):
                     rsync_proc = await Popen(
                         line, stdout=subprocess.PIPE, bufsize=0, preexec_fn=os.setsid,
                     )
-                    stdout = b""
+                    log = []
+                    # Last file being copied along with the parsed rsync transfer status
+                    extra = {'file': None}
                     try:
                         progress_buffer = JobProgressBuffer(job)
-                        while True:
-                            line = await rsync_proc.stdout.readline()
-                            if line:
-                                stdout += line
-                                try:
-                                    proc_output = line.decode("utf-8", "ignore").strip()
-                                    prog_out = proc_output.split(' ')
-                                    progress = [x for x in prog_out if '%' in x]
-                                    if len(progress):
-                                        progress_buffer.set_progress(int(progress[0][:-1]))
-                                    elif not proc_output.endswith('/'):
-                                        if (
-                                            proc_output not in ['sending incremental file list'] and
-                                            'xfr#' not in proc_output
-                                        ):
-                                            progress_buffer.set_progress(None, extra=proc_output)
-                                except Exception:
-                                    logger.warning('Parsing error in rsync task', exc_info=True)
-                            else:
-                                break
+                        async for proc_output in read_lines(rsync_proc.stdout):
+                            try:
+                                progress = parse_rsync_progress(proc_output)
+                                if progress is not None:
+                                    extra.update(progress)
+                                    progress_buffer.set_progress(progress['percent'], extra=dict(extra))
+                                    continue
+                                log.append(proc_output)
+                                proc_output = proc_output.strip()
+                                if (
+                                    proc_output and not proc_output.endswith('/') and
+                                    proc_output not in ['sending incremental file list']
+                                ):
+                                    extra['file'] = proc_output
+                                    progress_buffer.set_progress(None, extra=dict(extra))
+                            except Exception:
+                                logger.warning('Parsing error in rsync task', exc_info=True)
 
                         progress_buffer.flush()
                         await rsync_proc.wait()
                         if rsync_proc.returncode != 0:
                             raise Exception("rsync failed with exit code %r" % rsync_proc.returncode)
                     except asyncio.CancelledError:
+                        progress_buffer.cancel()
                         rsync_proc.kill()
                         raise
 
-                    job.set_progress(100, description="Done", extra="")
-                    return stdout.decode("utf-8", "ignore")
+                    job.set_progress(100, description="Done", extra={'file': None})
+                    return '\n'.join(log)
         finally:
             os.rmdir(src)
 
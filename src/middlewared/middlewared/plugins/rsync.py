@@ -24,17 +24,19 @@
 #
 #####################################################################
 
+import asyncio
 import os
 import errno
 import pwd
 import tempfile
 import subprocess
-import threading
 import shutil
 from collections import defaultdict
+from middlewared.job import JobProgressBuffer
 from middlewared.schema import accepts, Bool, Dict, Str, Int
 from middlewared.service import Service, job, CallError
 from middlewared.logger import Logger
+from middlewared.utils import Popen, parse_rsync_progress, read_lines
 
 
 logger = Logger('rsync').getLogger()
@@ -59,60 +61,45 @@ def demote(user):
 
 class RsyncService(Service):
 
-    def __rsync_worker(self, line, user, job):
-        proc_stdout = tempfile.TemporaryFile(mode='w+b', buffering=0)
+    async def __rsync_worker(self, line, user, job):
+        proc = await Popen(
+            line,
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            preexec_fn=demote(user)
+        )
+        # Drain stderr alongside stdout so rsync never blocks on a full pipe
+        stderr = asyncio.ensure_future(proc.stderr.read())
+        progress_buffer = JobProgressBuffer(job)
         try:
-            rsync_proc = subprocess.Popen(
-                line,
-                shell=True,
-                stdout=proc_stdout.fileno(),
-                stderr=subprocess.PIPE,
-                bufsize=0,
-                preexec_fn=demote(user)
-            )
-            seek = 0
-            old_seek = 0
-            progress = 0
-            message = 'Starting rsync copy job...'
-            while rsync_proc.poll() is None:
-                job.set_progress(progress, message)
-                proc_op = ''
-                proc_stdout.seek(seek)
+            job.set_progress(0, 'Starting rsync copy job...')
+            async for proc_op in read_lines(proc.stdout):
                 try:
-                    while True:
-                        op_byte = proc_stdout.read(1).decode('utf8')
-                        if op_byte == '':
-                            # In this case break before incrementing `seek`
-                            break
-                        seek += 1
-                        if op_byte == '\r':
-                            break
-                        proc_op += op_byte
-                        seek += 1
-                    if old_seek != seek:
-                        old_seek = seek
-                        message = proc_op.strip()
-                        try:
-                            progress = int([x for x in message.split(' ') if '%' in x][0][:-1])
-                        except (IndexError, ValueError):
-                            pass
-                except BaseException as err:
-                    # Catch IOERROR Errno 9 which usually arises because
-                    # of already closed fileobject being used here therby
-                    # raising Bad File Descriptor error. In this case break
-                    # and the outer while loop will check for rsync_proc.poll()
-                    # to be None or not and DTRT
-                    if hasattr(err, 'errno') and err.errno == 9:
-                        break
+                    progress = parse_rsync_progress(proc_op)
+                except ValueError:
                     logger.debug('Error whilst parsing rsync progress', exc_info=True)
-
-        except BaseException as e:
+                    continue
+                if progress is not None:
+                    progress_buffer.set_progress(progress['percent'], proc_op.strip(), extra=progress)
+            progress_buffer.flush()
+            await proc.wait()
+            stderr = (await stderr).decode('utf8', 'ignore')
+        except asyncio.CancelledError:
+            progress_buffer.cancel()
+            stderr.cancel()
+            proc.kill()
+            raise
+        except Exception as e:
+            progress_buffer.cancel()
+            stderr.cancel()
+            proc.kill()
             raise CallError(f'Rsync copy job id: {job.id} failed due to: {e}', errno.EIO)
 
-        if rsync_proc.returncode != 0:
+        if proc.returncode != 0:
             job.set_progress(None, 'Rsync copy job failed')
             raise CallError(
-                f'Rsync copy job id: {job.id} returned non-zero exit code. Command used was: {line}. Error: {rsync_proc.stderr.read()}'
+                f'Rsync copy job id: {job.id} returned non-zero exit code. Command used was: {line}. Error: {stderr}'
             )
 
     @accepts(Dict(
@@ -141,11 +128,14 @@ class RsyncService(Service):
         required=True
     ))
     @job()
-    def copy(self, job, rcopy):
+    async def copy(self, job, rcopy):
         """
         Starts an rsync copy task between current freenas machine
         and specified remote host (or local copy too). It reports
         the progress of the copy task.
+
+        Progress `extra` holds the `transferred` bytes, transfer `rate` in
+        bytes per second and `eta` in seconds as parsed from rsync.
         """
 
         # Assigning variables and such
@@ -240,9 +230,7 @@ class RsyncService(Service):
 
         logger.debug(f'Executing rsync job id: {job.id} with the following command {line}')
         try:
-            t = threading.Thread(target=self.__rsync_worker, args=(line, user, job), daemon=True)
-            t.start()
-            t.join()
+            await self.__rsync_worker(line, user, job)
         finally:
             if password_file:
                 password_file.close()
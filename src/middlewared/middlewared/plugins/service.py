@@ -1,15 +1,23 @@
 import asyncio
+import errno
 import inspect
 import os
+import re
 import signal
 import threading
 import time
-from subprocess import DEVNULL, PIPE
+from subprocess import DEVNULL
+
+import psutil
 
 from middlewared.schema import accepts, Bool, Dict, Int, Ref, Str
-from middlewared.service import filterable, CRUDService
+from middlewared.service import filterable, private, CRUDService
 from middlewared.utils import Popen, filter_list
 
+# How long a service status is trusted without a start/stop/restart/reload
+# or a process event going through the middleware
+SERVICE_STATUS_TTL = 5
+
 
 class StartNotify(threading.Thread):
 
@@ -47,6 +55,64 @@ class StartNotify(threading.Thread):
             tries += 1
 
 
+class ProcessTable(object):
+    """
+    Snapshot of the names of every running process, taken without forking.
+    """
+
+    def __init__(self):
+        self.created = time.monotonic()
+        self.names = {}
+        for proc in psutil.process_iter():
+            try:
+                self.names[proc.pid] = proc.name()
+            except psutil.Error:
+                # Process exited while walking the table
+                continue
+
+    def pgrep(self, procname):
+        """
+        pids of the processes matching `procname`, as pgrep(1) would
+        """
+        pattern = re.compile(procname)
+        mypid = os.getpid()
+        return sorted(
+            pid for pid, name in self.names.items()
+            if pid != mypid and pattern.search(name)
+        )
+
+    def pgrep_pidfile(self, pidfile, procname=None):
+        """
+        pid read from `pidfile` if it is alive and, given `procname`, its
+        name matches, as pgrep -F would
+        """
+        try:
+            with open(pidfile, 'r') as f:
+                pid = int(f.read().split()[0])
+        except (OSError, ValueError, IndexError):
+            return []
+
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return []
+        except OSError as e:
+            if e.errno != errno.EPERM:
+                return []
+
+        if procname:
+            name = self.names.get(pid)
+            # Started after the snapshot has been taken
+            if name is None:
+                try:
+                    name = psutil.Process(pid).name()
+                except psutil.Error:
+                    return []
+            if not re.search(procname, name):
+                return []
+        return [pid]
+
+
 class ServiceService(CRUDService):
 
     SERVICE_DEFS = {
@@ -70,6 +136,16 @@ class ServiceService(CRUDService):
         'netdata': ('netdata', '/var/db/netdata/netdata.pid')
     }
 
+    def __init__(self, middleware):
+        super().__init__(middleware)
+        # service -> (time, (running, pids))
+        self.__status = {}
+        # Bumped on every invalidation so statuses computed meanwhile are
+        # not cached
+        self.__status_generation = 0
+        self.__process_table = None
+        self.__process_table_lock = None
+
     @filterable
     async def query(self, filters=None, options=None):
         if options is None:
@@ -141,7 +217,10 @@ class ServiceService(CRUDService):
         If the method does not exist, it would fallback using service(8)."""
         await self.middleware.call_hook('service.pre_start', service)
         sn = self._started_notify("start", service)
-        await self._simplecmd("start", service, options)
+        try:
+            await self._simplecmd("start", service, options)
+        finally:
+            self.status_invalidate()
         return await self.started(service, sn)
 
     async def started(self, service, sn=None):
@@ -151,6 +230,9 @@ class ServiceService(CRUDService):
         if sn:
             await self.middleware.threaded(sn.join)
 
+        # A query made while the service was starting or stopping may have
+        # cached its previous status, check it again
+        self.status_invalidate()
         try:
             svc = await self.query([('service', '=', service)], {'get': True})
             self.middleware.send_event('service.query', 'CHANGED', fields=svc)
@@ -176,7 +258,10 @@ class ServiceService(CRUDService):
         If the method does not exist, it would fallback using service(8)."""
         await self.middleware.call_hook('service.pre_stop', service)
         sn = self._started_notify("stop", service)
-        await self._simplecmd("stop", service, options)
+        try:
+            await self._simplecmd("stop", service, options)
+        finally:
+            self.status_invalidate()
         return await self.started(service, sn)
 
     @accepts(
@@ -191,7 +276,10 @@ class ServiceService(CRUDService):
         If the method does not exist, it would fallback using service(8)."""
         await self.middleware.call_hook('service.pre_restart', service)
         sn = self._started_notify("restart", service)
-        await self._simplecmd("restart", service, options)
+        try:
+            await self._simplecmd("restart", service, options)
+        finally:
+            self.status_invalidate()
         return await self.started(service, sn)
 
     @accepts(
@@ -210,17 +298,60 @@ class ServiceService(CRUDService):
             await self._simplecmd("reload", service, options)
         except:
             await self.restart(service, options)
+        finally:
+            self.status_invalidate()
         return await self.started(service)
 
+    @private
+    def status_invalidate(self):
+        """
+        Forget the cached status of every service, it will be checked again
+        on the next query.
+        """
+        self.__status = {}
+        self.__status_generation += 1
+        self.__process_table = None
+
+    async def _get_process_table(self):
+        """
+        Process table snapshot shared by every status check of a refresh.
+        """
+        if self.__process_table_lock is None:
+            self.__process_table_lock = asyncio.Lock()
+        async with self.__process_table_lock:
+            table = self.__process_table
+            if table is None or time.monotonic() - table.created > 1:
+                table = self.__process_table = await self.middleware.threaded(ProcessTable)
+            return table
+
+    @private
+    async def is_running(self, service, fresh=False):
+        """
+        Whether `service` is running, from its cached status when still
+        fresh unless `fresh` is set.
+        """
+        if fresh:
+            self.__status.pop(service, None)
+        status = await self._get_status({'service': service, 'enable': False})
+        return status['state'] == 'RUNNING'
+
     async def _get_status(self, service):
-        f = getattr(self, '_started_' + service['service'], None)
-        if callable(f):
-            if inspect.iscoroutinefunction(f):
-                running, pids = await f()
-            else:
-                running, pids = f()
+        name = service['service']
+        cached = self.__status.get(name)
+        if cached is not None and time.monotonic() - cached[0] < SERVICE_STATUS_TTL:
+            running, pids = cached[1]
         else:
-            running, pids = await self._started(service['service'])
+            generation = self.__status_generation
+            f = getattr(self, '_started_' + name, None)
+            if callable(f):
+                if inspect.iscoroutinefunction(f):
+                    running, pids = await f()
+                else:
+                    running, pids = f()
+            else:
+                running, pids = await self._started(name)
+            if generation == self.__status_generation:
+                self.__status[name] = (time.monotonic(), (running, pids))
 
         if running:
             state = 'RUNNING'
@@ -309,7 +440,7 @@ class ServiceService(CRUDService):
         """
         This is the second step::
         Wait for the StartNotify thread to finish and then check for the
-        status of pidfile/procname using pgrep
+        status of pidfile/procname against the process table
 
         Returns:
             True whether the service is alive, False otherwise
@@ -320,21 +451,14 @@ class ServiceService(CRUDService):
             if notify:
                 await self.middleware.threaded(notify.join)
 
+            table = await self._get_process_table()
             if pidfile:
-                pgrep = "/bin/pgrep -F {}{}".format(
-                    pidfile,
-                    ' ' + procname if procname else '',
-                )
+                pids = table.pgrep_pidfile(pidfile, procname)
             else:
-                pgrep = "/bin/pgrep {}".format(procname)
-            proc = await Popen(pgrep, shell=True, stdout=PIPE, stderr=PIPE, close_fds=True)
-            data = (await proc.communicate())[0].decode()
-
-            if proc.returncode == 0:
-                return True, [
-                    int(i)
-                    for i in data.strip().split('\n') if i.isdigit()
-                ]
+                pids = table.pgrep(procname)
+
+            if pids:
+                return True, pids
         return False, []
 
     async def _start_webdav(self, **kwargs):
@@ -898,3 +1022,14 @@ class ServiceService(CRUDService):
             # benefit in waiting for it since even if it fails it wont
             # tell the user anything useful.
             asyncio.ensure_future(self.restart("collectd", kwargs))
+
+
+async def _event_kernel(middleware, event_type, args):
+    data = args['data']
+    # A daemon dumping core is gone, do not wait for its status to expire
+    if data.get('subsystem') == 'signal' and data.get('type') == 'coredump':
+        await middleware.call('service.status_invalidate')
+
+
+def setup(middleware):
+    middleware.event_subscribe('devd.kernel', _event_kernel)
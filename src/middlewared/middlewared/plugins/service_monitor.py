@@ -1,207 +1,308 @@
 import asyncio
-import os
-import socket
+import heapq
 import random
 import sys
-import threading
 import time
 
-from middlewared.service import Service, private
+from middlewared.schema import accepts
+from middlewared.service import Service
 
 if '/usr/local/www' not in sys.path:
     sys.path.append('/usr/local/www')
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'freenasUI.settings')
-
-import django
-from django.apps import apps
-if not apps.ready:
-    django.setup()
 
 from freenasUI.common.freenassysctl import freenas_sysctl as _fs
 
-
-class ServiceMonitorThread(threading.Thread):
-    def __init__(self, **kwargs):
-        super(ServiceMonitorThread, self).__init__()
-        self.setDaemon(False)
-
-        self.id = kwargs.get('id')
-        self.frequency = kwargs.get('frequency')
-        self.retry = kwargs.get('retry')
-        self.host = kwargs.get('host')
-        self.port = kwargs.get('port')
-        self.name = kwargs.get('name')
-        self.logger = kwargs.get('logger')
-        self.middleware = kwargs.get('middleware')
-        self.finished = threading.Event()
-
-        self.logger.debug("[ServiceMonitorThread] name={0} frequency={1} retry={2}".format(self.name, self.frequency, self.retry))
-
-    @private
-    def alert(self, message):
-        _random = str(random.randint(1, 1000))
-        file_error = '/tmp/.' + _random + self.name + '.service_monitor'
-        with open(file_error, 'w') as _file:
-            _file.write(message)
-
-    @private
-    def isEnabled(self, service):
-        enabled = False
-
-        # XXX yet another hack. We need a generic mechanism/interface that we can use that tells
-        # use if a service is enabled or not. When the service monitor starts up, it assumes 
-        # self.connected is True. If the service is down, but enabled, and we restart the middleware,
-        # and the service becomes available, we do not see a transition occur and therefore do not
-        # start the service.
-        if service in ('activedirectory', 'ldap', 'nis'):
-            try:
-                ds = self.middleware.call_sync('datastore.query', 'directoryservice.%s' % service)[0]
-                if service == 'activedirectory':
-                    service = 'ad'
-                enabled = ds["%s_enable" % service]
-
-            except Exception as e:
-                self.logger.debug("[ServiceMonitorThread] ERROR: isEnabled: {}".format(e))
-
+# Checks are spread by up to this fraction of their frequency so monitors
+# configured alike do not all probe at the same time
+CHECK_JITTER = 0.1
+# Number of connection attempts before an endpoint is considered down
+CONNECT_TRIES = 3
+# Number of times a service not running is checked again, a second apart
+STARTED_TRIES = 3
+# How long the enable flags read from the database are shared by the checks
+ENABLED_CACHE_TTL = 30
+# Upper bounds (milliseconds) of the probe latency histogram buckets
+LATENCY_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+DIRECTORY_SERVICES = {
+    'activedirectory': ('directoryservice.activedirectory', 'ad_enable'),
+    'ldap': ('directoryservice.ldap', 'ldap_enable'),
+    'nis': ('directoryservice.nis', 'nis_enable'),
+}
+
+
+class LatencyHistogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # Last bucket counts everything above the highest bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.failures = 0
+
+    def add(self, latency):
+        """Record a successful probe taking `latency` milliseconds"""
+        for i, bound in enumerate(self.buckets):
+            if latency <= bound:
+                break
         else:
-            try:
-                services = self.middleware.call_sync('datastore.query', 'services.services')
-                for s in services:
-                    if s['srv_service'] == 'cifs':
-                        enabled = s['srv_enable']
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += latency
+
+    def add_failure(self):
+        self.failures += 1
+
+    def __getstate__(self):
+        return {
+            'buckets': list(self.buckets) + [None],
+            'counts': list(self.counts),
+            'count': self.count,
+            'sum': self.sum,
+            'failures': self.failures,
+        }
+
+
+class ServiceMonitor(object):
+    """State of a monitored endpoint (services.servicemonitor entry)"""
+
+    def __init__(self, id, name, host, port, frequency, retry):
+        self.id = id
+        self.name = name
+        self.host = host
+        self.port = port
+        self.frequency = frequency
+        self.retry = retry
+        self.ntries = 0
+        self.connected = None
+        self.started = None
+        self.enabled = None
+        self.alerts = []
+        self.latency = LatencyHistogram()
+
+    def next_check(self, now):
+        return now + self.frequency * (1 + random.uniform(-CHECK_JITTER, CHECK_JITTER))
 
-            except Exception as e:
-                self.logger.debug("[ServiceMonitorThread] ERROR: isEnabled: {}".format(e))
-
-        return enabled
-
-    @private
-    def tryConnect(self, host, port):
-        max_tries = 3
-        timeout = _fs().middlewared.plugins.service_monitor.socket_timeout
-        connected = False
 
-        i = 0
-        while i < max_tries:
+class ServiceMonitorService(Service):
+    """
+    Main-Class for service monitoring.
 
-            # XXX What about UDP?
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(timeout)
+    Every monitored endpoint is checked by the same asyncio scheduler, no
+    thread is used and no call blocks the middleware threadpool, so the
+    number of endpoints is only bound by their probes.
+    """
 
-            try:
-                s.connect((host, port))
-                connected = True
+    def __init__(self, *args):
+        super(ServiceMonitorService, self).__init__(*args)
+        self.monitors = {}
+        # (due time, sequence, monitor) heap
+        self.queue = []
+        self.sequence = 0
+        self.scheduler = None
+        self.wakeup = asyncio.Event()
+        self.checks = set()
+        self.socket_timeout = None
+        self.enabled = None
+        self.enabled_updated = 0
+        self.enabled_lock = asyncio.Lock()
 
-            except Exception as e:
-                self.logger.debug("[ServiceMonitorThread] Cannot connect: {0}:{1} with error: {2}".format(host, port, e))
-                connected = False
+    async def start(self):
+        if self.scheduler is not None:
+            return
 
-            finally:
-                s.settimeout(None)
-                s.close()
+        services = await self.middleware.call('datastore.query', 'services.servicemonitor')
+        self.socket_timeout = _fs().middlewared.plugins.service_monitor.socket_timeout
+        self.enabled = None
 
-            i += 1
+        loop = asyncio.get_event_loop()
+        for s in services:
+            name = s['sm_name']
 
-        return connected
+            if not s['sm_enable']:
+                self.logger.debug("[ServiceMonitorService] skipping {}".format(name))
+                continue
 
-    @private
-    def getStarted(self, service):
-        max_tries = 3
+            self.logger.debug("[ServiceMonitorService] monitoring {} frequency={} retry={}".format(
+                name, s['sm_frequency'], s['sm_retry'],
+            ))
 
-        started = self.middleware.call_sync('service.started', self.name)
-        if started is True:
-            return started
+            monitor = ServiceMonitor(
+                id=s['id'], name=name, host=s['sm_host'], port=s['sm_port'],
+                frequency=s['sm_frequency'], retry=s['sm_retry'],
+            )
+            self.monitors[name] = monitor
+            self._schedule(monitor, monitor.next_check(loop.time()))
 
-        i = 0
-        while i < max_tries:
-            time.sleep(1)
-            started = self.middleware.call_sync('service.started', self.name)
-            i += 1
+        if self.monitors:
+            self.scheduler = asyncio.ensure_future(self._run())
 
-        return started
+    async def stop(self):
+        if self.scheduler is not None:
+            self.scheduler.cancel()
+            self.scheduler = None
+        for check in list(self.checks):
+            check.cancel()
+        self.checks = set()
+        self.queue = []
+        self.monitors = {}
 
-    def run(self):
-        ntries = 0
+    async def restart(self):
+        await self.stop()
+        await self.start()
 
+    @accepts()
+    async def alerts(self):
+        """Messages about the monitored services failing to recover"""
+        return [alert for monitor in self.monitors.values() for alert in monitor.alerts]
+
+    @accepts()
+    async def stats(self):
+        """
+        Status of every monitored service along with a histogram of its
+        connection probes latency, in milliseconds.
+        """
+        return {
+            name: {
+                'host': monitor.host,
+                'port': monitor.port,
+                'connected': monitor.connected,
+                'started': monitor.started,
+                'enabled': monitor.enabled,
+                'checks': monitor.ntries,
+                'latency': monitor.latency.__getstate__(),
+            }
+            for name, monitor in self.monitors.items()
+        }
+
+    def _schedule(self, monitor, due):
+        self.sequence += 1
+        heapq.heappush(self.queue, (due, self.sequence, monitor))
+        self.wakeup.set()
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
         while True:
-            self.finished.wait(self.frequency)
-
-            #
-            # We should probably have a configurable threshold for number of
-            # failures before starting or stopping the service
-            #
-            connected = self.tryConnect(self.host, self.port)
-            started = self.getStarted(self.name)
-            enabled = self.isEnabled(self.name)
-
-            self.logger.debug("[ServiceMonitorThread] connected={0} started={1} enabled={2}".format(connected, started, enabled))
-
-            if (connected is False):
-                self.alert("attempt %d to recover service %s\n" % (ntries + 1, self.name))
-
-            if (connected is True) and (started is False):
-                self.logger.debug("[ServiceMonitorThread] enabling service {}".format(self.name))
-                try:
-                    self.middleware.call_sync('service.start', self.name)
-                except Exception:
-                    pass
-
-            elif (connected is False) and (enabled is True):
-                self.logger.debug("[ServiceMonitorThread] disabling service {}".format(self.name))
-                try:
-                    self.middleware.call_sync('service.stop', self.name)
-                except Exception:
-                    pass
-
-            if self.finished.is_set():
-                break
-
-            ntries += 1
-            if self.retry == 0:
-                continue
-            if ntries >= self.retry:
-                break
-
-        if not ((connected is True) and (enabled is True) and (started is True)):
-            self.alert("tried %d attempts to recover service %s" % (self.retry, self.name))
-
-    def cancel(self):
-        self.finished.set()
-
+            now = loop.time()
+            while self.queue and self.queue[0][0] <= now:
+                due, seq, monitor = heapq.heappop(self.queue)
+                check = asyncio.ensure_future(self._check(monitor))
+                self.checks.add(check)
+                check.add_done_callback(self.checks.discard)
+
+            self.wakeup.clear()
+            timeout = self.queue[0][0] - now if self.queue else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _check(self, monitor):
+        #
+        # We should probably have a configurable threshold for number of
+        # failures before starting or stopping the service
+        #
+        try:
+            connected, started, enabled = await asyncio.gather(
+                self._try_connect(monitor),
+                self._is_started(monitor),
+                self._is_enabled(monitor.name),
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.logger.debug("[ServiceMonitorService] failed to check {}".format(monitor.name), exc_info=True)
+            connected, started, enabled = monitor.connected, monitor.started, monitor.enabled
+
+        monitor.connected, monitor.started, monitor.enabled = connected, started, enabled
+        self.logger.debug("[ServiceMonitorService] {} connected={} started={} enabled={}".format(
+            monitor.name, connected, started, enabled,
+        ))
+
+        if connected is False:
+            # Only the latest attempt is reported, monitors may retry forever
+            monitor.alerts = ["attempt %d to recover service %s\n" % (monitor.ntries + 1, monitor.name)]
+        elif started and enabled:
+            # Recovered
+            monitor.alerts = []
+
+        if connected is True and started is False:
+            self.logger.debug("[ServiceMonitorService] enabling service {}".format(monitor.name))
+            try:
+                await self.middleware.call('service.start', monitor.name)
+            except Exception:
+                pass
 
-class ServiceMonitorService(Service):
-    """Main-Class for service monitoring."""
+        elif connected is False and enabled is True:
+            self.logger.debug("[ServiceMonitorService] disabling service {}".format(monitor.name))
+            try:
+                await self.middleware.call('service.stop', monitor.name)
+            except Exception:
+                pass
 
-    def __init__(self, *args):
-        super(ServiceMonitorService, self).__init__(*args)
-        self.threads = {}
+        monitor.ntries += 1
+        if monitor.retry and monitor.ntries >= monitor.retry:
+            if not (connected is True and enabled is True and started is True):
+                monitor.alerts.append("tried %d attempts to recover service %s" % (monitor.retry, monitor.name))
+            return
 
-    async def start(self):
-        services = await self.middleware.call('datastore.query', 'services.servicemonitor')
-        for s in services:
-            thread_name = s['sm_name']
+        self._schedule(monitor, monitor.next_check(asyncio.get_event_loop().time()))
 
-            if not s['sm_enable']:
-                self.logger.debug("[ServiceMonitorService] skipping {}".format(thread_name))
+    async def _try_connect(self, monitor):
+        loop = asyncio.get_event_loop()
+        for i in range(CONNECT_TRIES):
+            # XXX What about UDP?
+            start = loop.time()
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(monitor.host, monitor.port), self.socket_timeout,
+                )
+            except (OSError, asyncio.TimeoutError) as e:
+                monitor.latency.add_failure()
+                self.logger.debug("[ServiceMonitorService] Cannot connect: {0}:{1} with error: {2}".format(
+                    monitor.host, monitor.port, e,
+                ))
                 continue
+            monitor.latency.add((loop.time() - start) * 1000)
+            writer.close()
+            return True
+        return False
+
+    async def _is_started(self, monitor):
+        # A service being (re)started may take a moment to show up as
+        # running, do not tell it is down right away
+        started = await self.middleware.call('service.is_running', monitor.name)
+        for i in range(STARTED_TRIES):
+            if started:
+                break
+            await asyncio.sleep(1)
+            started = await self.middleware.call('service.is_running', monitor.name, True)
+        return started
 
-            self.logger.debug("[ServiceMonitorService] monitoring {}".format(thread_name))
+    async def _is_enabled(self, service):
+        async with self.enabled_lock:
+            if self.enabled is None or time.monotonic() - self.enabled_updated > ENABLED_CACHE_TTL:
+                self.enabled = await self._load_enabled()
+                self.enabled_updated = time.monotonic()
+        return self.enabled.get(service, False)
 
-            thread = ServiceMonitorThread(id=s['id'], frequency=s['sm_frequency'], retry=s['sm_retry'],
-                host=s['sm_host'], port=s['sm_port'], name=thread_name, logger=self.logger, middleware=self.middleware)
-            self.threads[thread_name] = thread
-            thread.start()
+    async def _load_enabled(self):
+        enabled = {}
+        for s in await self.middleware.call('datastore.query', 'services.services'):
+            enabled[s['srv_service']] = s['srv_enable']
 
-    async def stop(self):
-        for thread in self.threads.copy():
-            thread = self.threads.get(thread)
-            await self.middleware.threaded(thread.cancel)
-            del self.threads[thread.name]
-        self.threads = {}
+        for service, (table, field) in DIRECTORY_SERVICES.items():
+            if service not in self.monitors:
+                continue
+            try:
+                ds = await self.middleware.call('datastore.query', table)
+                enabled[service] = bool(ds and ds[0][field])
+            except Exception as e:
+                self.logger.debug("[ServiceMonitorService] ERROR: isEnabled: {}".format(e))
 
-    async def restart(self):
-        await self.stop()
-        await self.start()
+        return enabled
 
 
 def setup(middleware):
@@ -1,9 +1,9 @@
 from middlewared.client import ejson as json
 from middlewared.schema import Dict, Int, List, Str, accepts
+from middlewared.rrd import RRDError, open_rrd, xport
 from middlewared.service import Service
 from middlewared.utils import Popen
 
-import glob
 import os
 import re
 import subprocess
@@ -17,22 +17,49 @@ RE_LAST_UPDATE = re.compile(r'last_update = (\d+)')
 
 class StatsService(Service):
 
+    def __init__(self, middleware):
+        super().__init__(middleware)
+        # source -> (directory mtime, [metric])
+        self.__sources = {}
+
     @accepts()
     def get_sources(self):
         """
         Returns an object with all available sources tried with metric datasets.
         """
-        sources = {}
         if not os.path.exists(RRD_PATH):
+            self.__sources = {}
             return {}
-        for i in glob.glob('{}/*/*.rrd'.format(RRD_PATH)):
-            source, metric = i.replace(RRD_PATH, '').split('/', 1)
-            if metric.endswith('.rrd'):
-                metric = metric[:-4]
-            if source not in sources:
-                sources[source] = []
-            sources[source].append(metric)
-        return sources
+
+        # Metrics of a source are only listed again once its directory
+        # changed, i.e. a rrd file was added or removed
+        sources = {}
+        with os.scandir(RRD_PATH) as it:
+            for entry in it:
+                if entry.name.startswith('.') or not entry.is_dir():
+                    continue
+                try:
+                    mtime = entry.stat().st_mtime_ns
+                except OSError:
+                    continue
+                cached = self.__sources.get(entry.name)
+                if cached is None or cached[0] != mtime:
+                    try:
+                        cached = (mtime, self.__list_metrics(entry.path))
+                    except OSError:
+                        continue
+                sources[entry.name] = cached
+        self.__sources = sources
+
+        return {source: list(metrics) for source, (mtime, metrics) in sources.items() if metrics}
+
+    def __list_metrics(self, path):
+        metrics = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if not entry.name.startswith('.') and entry.name.endswith('.rrd'):
+                    metrics.append(entry.name[:-4])
+        return metrics
 
     @accepts(Str('source'), Str('type'))
     async def get_dataset_info(self, source, _type):
@@ -40,6 +67,15 @@ class StatsService(Service):
         Returns info about a given dataset from some source.
         """
         rrdfile = '{}/{}/{}.rrd'.format(RRD_PATH, source, _type)
+        try:
+            rrd = await self.middleware.threaded(open_rrd, rrdfile)
+        except (OSError, RRDError) as e:
+            self.logger.debug('Falling back to rrdtool info: %s', e)
+        else:
+            info = rrd.info()
+            info.update({'source': source, 'type': _type})
+            return info
+
         proc = await Popen(
             ['/usr/local/bin/rrdtool', 'info', rrdfile],
             stdout=subprocess.PIPE,
@@ -89,10 +125,26 @@ class StatsService(Service):
         Get data points from rrd files.
         """
 
+        series = [
+            (
+                '{}/{}/{}.rrd'.format(RRD_PATH, data['source'], data['type']),
+                data['dataset'], data['cf'], '{}/{}'.format(data['source'], data['type']),
+            )
+            for data in data_list
+        ]
+        try:
+            data = await self.middleware.threaded(xport, series, stats['start'], stats['end'], stats.get('step'))
+        except (OSError, RRDError) as e:
+            self.logger.debug('Falling back to rrdtool xport: %s', e)
+            data = await self.__xport_rrdtool(data_list, stats)
+
+        # Custom about property
+        data['about'] = 'Data for ' + ','.join([s[3] for s in series])
+        return data
+
+    async def __xport_rrdtool(self, data_list, stats):
         defs = []
-        names_pair = []
         for i, data in enumerate(data_list):
-            names_pair.append([data['source'], data['type']])
             rrdfile = '{}/{}/{}.rrd'.format(RRD_PATH, data['source'], data['type'])
             defs.extend([
                 'DEF:xxx{}={}:{}:{}'.format(i, rrdfile, data['dataset'], data['cf']),
@@ -109,8 +161,4 @@ class StatsService(Service):
         data, err = await proc.communicate()
         if proc.returncode != 0:
             raise ValueError('rrdtool failed: {}'.format(err.decode()))
-        data = json.loads(data.decode())
-
-        # Custom about property
-        data['about'] = 'Data for ' + ','.join(['/'.join(i) for i in names_pair])
-        return data
+        return json.loads(data.decode())
@@ -1,16 +1,45 @@
+import asyncio
 import os
 import errno
 import socket
+import subprocess
+import sys
 import textwrap
 import threading
 import time
 
-from bsd import geom
 import humanfriendly
 import libzfs
 
 from middlewared.schema import Dict, List, Str, Bool, Int, accepts
-from middlewared.service import CallError, CRUDService, Service, job, periodic, private
+from middlewared.service import CallError, CRUDService, Service, filterable, job, periodic, private
+from middlewared.utils import IndexedList, filter_list
+
+if '/usr/local/www' not in sys.path:
+    sys.path.insert(0, '/usr/local/www')
+from freenasUI.middleware import geom as geom_topology
+
+
+# Dataset properties kept in the zfs.state snapshot
+STATE_DATASET_PROPERTIES = (
+    'available', 'compression', 'compressratio', 'mountpoint', 'origin',
+    'quota', 'readonly', 'refquota', 'refreservation', 'referenced',
+    'reservation', 'used', 'volsize',
+)
+# Usage figures change without any ZFS event, do not trust them forever.
+# It is longer than the 60 seconds between quota checks so that at most
+# every other check walks all datasets.
+STATE_MAX_AGE = 120
+# Pools are cheap to walk and their status and scan progress are polled,
+# so they are not kept as long as datasets
+POOL_STATE_MAX_AGE = 5
+# Snapshots taken or destroyed outside of the middleware show up after that
+SNAPSHOT_INDEX_MAX_AGE = 600
+# Seconds ZFS history events are collected for before refreshing the index,
+# recursive snapshots and destroys posting one event per dataset
+SNAPSHOT_INDEX_EVENT_DELAY = 5
+# Snapshot lists of replication remotes are fetched over ssh at most that often
+REMOTE_SNAPSHOTS_TTL = 60
 
 
 def find_vdev(pool, vname):
@@ -36,6 +65,141 @@ def find_vdev(pool, vname):
         children += list(child.children)
 
 
+class ZFSStateService(Service):
+    """
+    Long lived libzfs handle keeping a snapshot of pools and datasets.
+
+    Walking every dataset with a new libzfs handle costs seconds of CPU on
+    systems with tens of thousands of datasets, so consumers query this
+    snapshot instead. It is thrown away after any change made through the
+    middleware (see `invalidate`) and once it is older than STATE_MAX_AGE
+    seconds, POOL_STATE_MAX_AGE for pools which are walked on their own.
+    ZFS devd events only reload the datasets they are about.
+    """
+
+    class Config:
+        namespace = 'zfs.state'
+        private = True
+
+    def __init__(self, middleware):
+        super().__init__(middleware)
+        self.__lock = threading.Lock()
+        self.__zfs = None
+        self.__pools = None
+        self.__pools_updated = 0
+        self.__datasets = None
+        self.__datasets_updated = 0
+        # Datasets to reload before the snapshot is used again
+        self.__stale = set()
+
+    def __handle(self):
+        if self.__zfs is None:
+            self.__zfs = libzfs.ZFS()
+        return self.__zfs
+
+    def __refresh_pools(self):
+        with self.__lock:
+            if self.__pools is not None and time.monotonic() - self.__pools_updated < POOL_STATE_MAX_AGE:
+                return self.__pools
+
+            pools = []
+            for pool in self.__handle().pools:
+                pools.append({
+                    'name': pool.name,
+                    'guid': str(pool.guid),
+                    'status': pool.status,
+                    'scan': pool.scrub.__getstate__(),
+                })
+
+            self.__pools = IndexedList(pools, keys=('name',))
+            self.__pools_updated = time.monotonic()
+            return self.__pools
+
+    def __dataset(self, ds):
+        properties = ds.properties
+        return {
+            'name': ds.name,
+            'pool': ds.name.split('/', 1)[0],
+            'type': ds.type.name,
+            'properties': {
+                k: {'value': properties[k].value, 'rawvalue': properties[k].rawvalue}
+                for k in STATE_DATASET_PROPERTIES if k in properties
+            },
+        }
+
+    def __reload_stale(self):
+        # Must be called with the lock held
+        names = set()
+        for name in self.__stale:
+            names.add(name)
+            # Their usage changes along with the usage of their children
+            while '/' in name:
+                name = name.rsplit('/', 1)[0]
+                names.add(name)
+        self.__stale = set()
+
+        reloaded = {}
+        for name in names:
+            try:
+                reloaded[name] = self.__dataset(self.__handle().get_dataset(name))
+            except libzfs.ZFSException:
+                # Destroyed
+                pass
+
+        datasets = [
+            reloaded.pop(ds['name'], ds) for ds in self.__datasets
+            if ds['name'] not in names or ds['name'] in reloaded
+        ]
+        # Created
+        datasets.extend(reloaded.values())
+        self.__datasets = IndexedList(datasets, keys=('name', 'pool', 'type'))
+
+    def __refresh_datasets(self):
+        with self.__lock:
+            if self.__datasets is not None and time.monotonic() - self.__datasets_updated < STATE_MAX_AGE:
+                if self.__stale:
+                    self.__reload_stale()
+                return self.__datasets
+
+            datasets = [self.__dataset(ds) for ds in self.__handle().datasets]
+
+            self.__datasets = IndexedList(datasets, keys=('name', 'pool', 'type'))
+            self.__datasets_updated = time.monotonic()
+            self.__stale = set()
+            return self.__datasets
+
+    def invalidate(self, datasets=True):
+        """
+        Discard the snapshot, to be called after changing pools or datasets.
+        Datasets are kept when `datasets` is False, e.g. for a scrub. When it
+        is a list of dataset names only these datasets and their parents are
+        reloaded, and pools are kept.
+        """
+        with self.__lock:
+            if datasets is True:
+                self.__pools = None
+                self.__datasets = None
+            elif datasets:
+                self.__stale.update(datasets)
+            else:
+                self.__pools = None
+
+    @filterable
+    def pools(self, filters=None, options=None):
+        """
+        Query imported pools: name, guid, status and scan.
+        """
+        return filter_list(self.__refresh_pools(), filters, options)
+
+    @filterable
+    def datasets(self, filters=None, options=None):
+        """
+        Query filesystems and volumes: name, pool, type and a selection of
+        their properties (`STATE_DATASET_PROPERTIES`) as value/rawvalue.
+        """
+        return filter_list(self.__refresh_datasets(), filters, options)
+
+
 class ZFSPoolService(Service):
 
     class Config:
@@ -50,20 +214,11 @@ class ZFSPoolService(Service):
         except libzfs.ZFSException as e:
             raise CallError(str(e), errno.ENOENT)
 
-        await self.middleware.threaded(geom.scan)
-        labelclass = geom.class_by_name('LABEL')
+        topology = await self.middleware.threaded(geom_topology.get_topology)
         for absdev in zpool.disks:
             dev = absdev.replace('/dev/', '').replace('.eli', '')
-            find = labelclass.xml.findall(f".//provider[name='{dev}']/../consumer/provider")
-            name = None
-            if find:
-                name = geom.provider_by_id(find[0].get('ref')).geom.name
-            else:
-                g = geom.geom_by_name('DEV', dev)
-                if g:
-                    name = g.consumer.provider.geom.name
-
-            if name and geom.geom_by_name('DISK', name):
+            name = topology.label_to_disk(dev)
+            if name and topology.geom_by_name('DISK', name) is not None:
                 yield name
             else:
                 self.logger.debug(f'Could not find disk for {dev}')
@@ -110,6 +265,8 @@ class ZFSPoolService(Service):
 
         except libzfs.ZFSException as e:
             raise CallError(str(e), e.code)
+        finally:
+            self.middleware.call_sync('zfs.state.invalidate')
 
     @accepts(Str('pool'), Str('label'))
     def detach(self, name, label):
@@ -125,6 +282,8 @@ class ZFSPoolService(Service):
             target.detach()
         except libzfs.ZFSException as e:
             raise CallError(str(e), e.code)
+        finally:
+            self.middleware.call_sync('zfs.state.invalidate')
 
     @accepts(Str('pool'), Str('label'), Str('dev'))
     def replace(self, name, label, dev):
@@ -143,6 +302,8 @@ class ZFSPoolService(Service):
             target.replace(newvdev)
         except libzfs.ZFSException as e:
             raise CallError(str(e), e.code)
+        finally:
+            self.middleware.call_sync('zfs.state.invalidate')
 
     @accepts(Str('name'))
     @job(lock=lambda i: i[0])
@@ -156,6 +317,7 @@ class ZFSPoolService(Service):
             pool.start_scrub()
         except libzfs.ZFSException as e:
             raise CallError(str(e), e.code)
+        self.middleware.call_sync('zfs.state.invalidate', False)
 
         def watch():
             while True:
@@ -179,6 +341,282 @@ class ZFSPoolService(Service):
         t.join()
 
 
+class ZFSSnapshotIndexService(Service):
+    """
+    Index of all snapshots, grouped per dataset and sorted by creation.
+
+    Listing every snapshot with `zfs list` for each page of the Snapshots
+    view does not scale to hundreds of thousands of snapshots. The index is
+    loaded once, kept up to date for the datasets passed to `refresh` after
+    snapshots are taken or destroyed through the middleware or, through
+    `refresh_later`, reported by ZFS history devd events, and fully reloaded
+    once older than SNAPSHOT_INDEX_MAX_AGE seconds to catch any other change.
+    """
+
+    class Config:
+        namespace = 'zfs.snapshot_index'
+        private = True
+
+    def __init__(self, middleware):
+        super().__init__(middleware)
+        self.__lock = threading.Lock()
+        # dataset name -> [snapshot], oldest first
+        self.__datasets = None
+        self.__names = []
+        # tuple(order_by) -> [snapshot]
+        self.__sorted = {}
+        self.__updated = 0
+        # dataset name -> monotonic time of its last refresh
+        self.__refreshed = {}
+        self.__refreshed_lock = threading.Lock()
+        # dataset name -> monotonic time it was queued by refresh_later
+        self.__pending = {}
+        self.__flush_task = None
+        self.__remote_lock = threading.Lock()
+        # (hostname, port, user) -> (monotonic time, [snapshot name])
+        self.__remote = {}
+
+    def __list(self, path=None):
+        """
+        List snapshots of `path` (recursively) or of the whole system.
+        """
+        parent_types = {}
+        proc = subprocess.Popen(
+            ['/sbin/zfs', 'list', '-H', '-o', 'name,type', '-t', 'filesystem,volume'] +
+            (['-r', path] if path else []),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf8',
+        )
+        for line in proc.stdout:
+            name, _type = line.rstrip('\n').split('\t')
+            parent_types[name] = _type
+        proc.wait()
+
+        datasets = {}
+        proc = subprocess.Popen(
+            ['/sbin/zfs', 'list', '-H', '-p', '-t', 'snapshot', '-s', 'creation',
+             '-o', 'name,used,referenced,creation,freenas:vmsynced'] +
+            (['-r', path] if path else []),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf8',
+        )
+        for line in proc.stdout:
+            name, used, referenced, creation, vmsynced = line.rstrip('\n').split('\t')
+            dataset, snapshot = name.split('@', 1)
+            datasets.setdefault(dataset, []).append({
+                'name': name,
+                'dataset': dataset,
+                'snapshot': snapshot,
+                'pool': dataset.split('/', 1)[0],
+                'used': int(used) if used.isdigit() else None,
+                'referenced': int(referenced) if referenced.isdigit() else None,
+                'creation': int(creation) if creation.isdigit() else None,
+                'vmsynced': vmsynced == 'Y',
+                'parent_type': parent_types.get(dataset, 'filesystem'),
+                'mostrecent': False,
+            })
+        proc.wait()
+        for snapshots in datasets.values():
+            snapshots[-1]['mostrecent'] = True
+        return datasets
+
+    def __get(self):
+        # Must be called with the lock held
+        if self.__datasets is None or time.monotonic() - self.__updated > SNAPSHOT_INDEX_MAX_AGE:
+            self.__datasets = self.__list()
+            self.__names = sorted(self.__datasets)
+            self.__sorted = {}
+            self.__updated = time.monotonic()
+        return self.__datasets
+
+    def refresh(self, names):
+        """
+        Reload snapshots of the given datasets and their children, after
+        snapshots have been taken or destroyed. Snapshot names are accepted
+        as well and stand for their dataset.
+        """
+        paths = sorted({name.split('@', 1)[0] for name in names})
+        now = time.monotonic()
+        with self.__refreshed_lock:
+            for path in paths:
+                self.__refreshed[path] = now
+        with self.__lock:
+            if self.__datasets is None:
+                return
+            for path in paths:
+                datasets = self.__list(path)
+                for dataset in list(self.__datasets):
+                    if dataset == path or dataset.startswith(path + '/'):
+                        del self.__datasets[dataset]
+                self.__datasets.update(datasets)
+            self.__names = sorted(self.__datasets)
+            self.__sorted = {}
+
+    async def refresh_later(self, names):
+        """
+        Queue datasets to `refresh` all at once SNAPSHOT_INDEX_EVENT_DELAY
+        seconds later. Datasets refreshed in the meantime, e.g. by autosnap,
+        or below another queued dataset are left out then.
+        """
+        now = time.monotonic()
+        for name in names:
+            self.__pending.setdefault(name.split('@', 1)[0], now)
+        if self.__flush_task is None:
+            self.__flush_task = asyncio.ensure_future(self.__flush())
+
+    async def __flush(self):
+        await asyncio.sleep(SNAPSHOT_INDEX_EVENT_DELAY)
+        pending, self.__pending = self.__pending, {}
+        self.__flush_task = None
+        with self.__refreshed_lock:
+            # Nothing queued from now on can be older than these refreshes
+            refreshed, self.__refreshed = self.__refreshed, {}
+
+        def ancestors(path):
+            yield path
+            while '/' in path:
+                path = path.rsplit('/', 1)[0]
+                yield path
+
+        names = [
+            name for name, queued in pending.items()
+            if not any(refreshed.get(path, 0) >= queued for path in ancestors(name))
+        ]
+        queued = set(names)
+        # Children are listed along with their parents
+        names = [name for name in names if not any(path in queued for path in list(ancestors(name))[1:])]
+        if not names:
+            return
+        try:
+            await self.middleware.threaded(self.refresh, names)
+        except Exception:
+            self.logger.warning('Failed to refresh snapshot index', exc_info=True)
+
+    def invalidate(self):
+        with self.__lock:
+            self.__datasets = None
+
+    def query(self, options=None):
+        """
+        Query the index. `options` may contain:
+
+            dataset: only snapshots of this dataset
+            recursive: include children of `dataset`
+            name: only the snapshot with this full name
+            pools: only snapshots of these pools
+            exclude: skip these datasets and their children
+            order_by: list of fields, prefixed with `-` for descending order,
+                      datasets sorted by name and snapshots by creation
+                      otherwise
+            offset, limit: range of snapshots to return
+
+        Returns a dict with the number of matching snapshots (`total`) and
+        the requested range of them (`snapshots`).
+
+        Snapshots taken, destroyed or received outside of the middleware
+        without a ZFS history devd event to tell about it (e.g. on systems
+        not posting them) are only seen once the index is reloaded, up to
+        SNAPSHOT_INDEX_MAX_AGE seconds later.
+        """
+        options = options or {}
+        dataset = options.get('dataset')
+        name = options.get('name')
+        if name:
+            dataset = name.split('@', 1)[0]
+        pools = options.get('pools')
+        exclude = options.get('exclude') or []
+        order_by = tuple(options.get('order_by') or ())
+        offset = options.get('offset') or 0
+        limit = options.get('limit')
+
+        def wanted(ds):
+            if dataset and ds != dataset and not (
+                options.get('recursive') and ds.startswith(dataset + '/')
+            ):
+                return False
+            if pools is not None and ds.split('/', 1)[0] not in pools:
+                return False
+            for path in exclude:
+                if ds == path or ds.startswith(path + '/'):
+                    return False
+            return True
+
+        with self.__lock:
+            datasets = self.__get()
+            if dataset and not options.get('recursive'):
+                names = [dataset] if dataset in datasets else []
+            else:
+                names = self.__names
+            names = [ds for ds in names if wanted(ds)]
+
+            if name:
+                snapshots = [s for s in datasets[names[0]] if s['name'] == name] if names else []
+                return {'total': len(snapshots), 'snapshots': snapshots}
+
+            total = sum(len(datasets[ds]) for ds in names)
+            end = None if limit is None else offset + limit
+
+            if not order_by:
+                # Walk datasets and only copy the requested range
+                snapshots = []
+                for ds in names:
+                    if end is not None and end <= 0:
+                        break
+                    items = datasets[ds]
+                    if offset >= len(items):
+                        offset -= len(items)
+                        if end is not None:
+                            end -= len(items)
+                        continue
+                    snapshots.extend(items[offset:end])
+                    if end is not None:
+                        end -= len(items)
+                    offset = 0
+                return {'total': total, 'snapshots': snapshots}
+
+            key = (order_by, dataset, options.get('recursive'), tuple(pools or ()), tuple(exclude))
+            ordered = self.__sorted.get(key)
+            if ordered is None:
+                ordered = [s for ds in names for s in datasets[ds]]
+                # Stable sort, least significant field first
+                for field in reversed(order_by):
+                    reverse = field.startswith('-')
+                    field = field.lstrip('-')
+                    ordered.sort(
+                        key=lambda s: (0,) if s.get(field) is None else (1, s[field]),
+                        reverse=reverse,
+                    )
+                self.__sorted = {key: ordered}
+            return {'total': total, 'snapshots': ordered[offset:end]}
+
+    def remote_snapshots(self, hostname, port, user):
+        """
+        Names of the snapshots of a replication remote, cached for
+        REMOTE_SNAPSHOTS_TTL seconds per remote.
+        """
+        key = (hostname, port, user)
+        with self.__remote_lock:
+            cached = self.__remote.get(key)
+            if cached and time.monotonic() - cached[0] < REMOTE_SNAPSHOTS_TTL:
+                return cached[1]
+
+        proc = subprocess.Popen([
+            '/usr/local/bin/ssh', '-i', '/data/ssh/replication',
+            '-o', 'ConnectTimeout=3', '-o', 'BatchMode=yes', '-o', 'StrictHostKeyChecking=yes',
+            '-p', str(port), f'{user}@{hostname}', 'zfs list -Ht snapshot -o name',
+        ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf8')
+        stdout = proc.communicate()[0]
+        snapshots = stdout.strip('\n').split('\n') if proc.returncode == 0 else []
+
+        with self.__remote_lock:
+            self.__remote[key] = (time.monotonic(), snapshots)
+        return snapshots
+
+    def remote_invalidate(self, hostname=None):
+        with self.__remote_lock:
+            for key in list(self.__remote):
+                if hostname is None or key[0] == hostname:
+                    del self.__remote[key]
+
+
 class ZFSSnapshot(CRUDService):
 
     class Config:
@@ -224,6 +662,7 @@ class ZFSSnapshot(CRUDService):
                 ds.properties['freenas:vmsynced'] = libzfs.ZFSUserProperty('Y')
 
             self.logger.info("Snapshot taken: {0}@{1}".format(dataset, name))
+            await self.middleware.call('zfs.snapshot_index.refresh', [dataset])
             return True
         except libzfs.ZFSException as err:
                 self.logger.error("{0}".format(err))
@@ -261,6 +700,7 @@ class ZFSSnapshot(CRUDService):
                 if snap.name == __snap_name:
                     ds.destroy_snapshot(snapshot_name)
                     self.logger.info("Destroyed snapshot: {0}".format(__snap_name))
+                    await self.middleware.call('zfs.snapshot_index.refresh', [dataset])
                     return True
             self.logger.error("There is no snapshot {0} on dataset {1}".format(snapshot_name, dataset))
             return False
@@ -297,6 +737,7 @@ class ZFSSnapshot(CRUDService):
         try:
             snp.clone(dataset_dst)
             self.logger.info("Cloned snapshot {0} to dataset {1}".format(snapshot, dataset_dst))
+            await self.middleware.call('zfs.state.invalidate')
             return True
         except libzfs.ZFSException as err:
             self.logger.error("{0}".format(err))
@@ -386,14 +827,14 @@ class ZFSQuoteService(Service):
 
     async def __get_quota_excess(self):
         excess = []
-        zfs = libzfs.ZFS()
-        for properties in await self.middleware.threaded(lambda: [i.properties for i in zfs.datasets]):
+        for dataset in await self.middleware.call('zfs.state.datasets'):
+            properties = dataset['properties']
             quota = properties.get("quota")
             # zvols do not have a quota property in libzfs
-            if quota is None or quota.value == "none":
+            if quota is None or quota['value'] == "none":
                 continue
-            used = int(properties["used"].rawvalue)
-            available = used + int(properties["available"].rawvalue)
+            used = int(properties["used"]['rawvalue'])
+            available = used + int(properties["available"]['rawvalue'])
             try:
                 percent_used = 100 * used / available
             except ZeroDivisionError:
@@ -406,11 +847,11 @@ class ZFSQuoteService(Service):
             else:
                 continue
 
-            stat_info = await self.middleware.threaded(os.stat, properties["mountpoint"].value)
+            stat_info = await self.middleware.threaded(os.stat, properties["mountpoint"]['value'])
             uid = stat_info.st_uid
 
             excess.append({
-                "dataset_name": properties["name"].value,
+                "dataset_name": dataset["name"],
                 "level": level,
                 "used": used,
                 "available": available,
@@ -426,3 +867,30 @@ class ZFSQuoteService(Service):
         if self.excesses is not None:
             for excess in self.excesses.values():
                 await self.middleware.call('datastore.insert', 'storage.quotaexcess', excess)
+
+
+async def _event_zfs(middleware, event_type, args):
+    data = args['data']
+    _type = data.get('type', '')
+    dsname = data.get('history_dsname')
+    if _type.endswith('history_event') and dsname and data.get('history_internal_name') != 'rename':
+        await middleware.call('zfs.state.invalidate', [dsname.split('@', 1)[0].split('%', 1)[0]])
+    elif _type.endswith('history_event') or _type.endswith('config_sync'):
+        # Renames and pools imported, exported or extended
+        await middleware.call('zfs.state.invalidate')
+    else:
+        await middleware.call('zfs.state.invalidate', False)
+
+    # History events name the dataset a snapshot was taken, destroyed or
+    # received on, e.g. by `zfs snapshot` run by hand or a replication
+    # stream received from another system.
+    if _type.endswith('history_event') and data.get('history_internal_name') in (
+        'snapshot', 'destroy', 'receive', 'finish receiving', 'rename',
+    ):
+        if dsname:
+            await middleware.call('zfs.snapshot_index.refresh_later', [dsname.split('@', 1)[0].split('%', 1)[0]])
+
+
+def setup(middleware):
+    # Pools and datasets changed outside of the middleware
+    middleware.event_subscribe('devd.zfs', _event_zfs)
@@ -40,9 +40,12 @@ class Connection(object):
         self.ws = WSClient(f'ws://{self.conf.target_hostname()}/websocket')
         self.ws.call('auth.login', self.conf.target_username(), self.conf.target_password())
 
-connection = Connection()
+# Only connect once a test needs the target, unit tests do not
+connection = None
 
 @pytest.fixture
 def conn():
     global connection
+    if connection is None:
+        connection = Connection()
     return connection
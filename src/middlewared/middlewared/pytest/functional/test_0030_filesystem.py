@@ -1,3 +1,6 @@
+import pytest
+
+
 def test_filesystem_listdir(conn):
     req = conn.rest.post('filesystem/listdir', data=['/boot'])
 
@@ -23,3 +26,16 @@ def test_filesystem_stat(conn):
     assert req.status_code == 200
     stat = req.json()
     assert isinstance(stat, dict) is True
+
+
+def test_filesystem_acl_defaults_dry_run(conn):
+    req = conn.rest.get('pool')
+    assert req.status_code == 200
+
+    pools = req.json()
+    if len(pools) == 0:
+        pytest.skip('No pool found')
+    path = f'/mnt/{pools[0]["name"]}'
+
+    result = conn.ws.call('filesystem.acl_defaults', path, {'dry_run': True}, job=True)
+    assert result['paths'] > 0
@@ -0,0 +1,42 @@
+import pytest
+
+
+def test_snapshot_index_query(conn):
+    index = conn.ws.call('zfs.snapshot_index.query')
+
+    assert isinstance(index['total'], int) is True
+    assert len(index['snapshots']) == index['total']
+    for snapshot in index['snapshots']:
+        assert snapshot['name'] == f'{snapshot["dataset"]}@{snapshot["snapshot"]}'
+
+
+def test_snapshot_index_query_range(conn):
+    index = conn.ws.call('zfs.snapshot_index.query')
+    names = [s['name'] for s in index['snapshots']]
+
+    page = conn.ws.call('zfs.snapshot_index.query', {'offset': 1, 'limit': 2})
+    assert page['total'] == index['total']
+    assert [s['name'] for s in page['snapshots']] == names[1:3]
+
+
+def test_snapshot_index_query_order_by(conn):
+    index = conn.ws.call('zfs.snapshot_index.query', {'order_by': ['-creation', 'name']})
+    creation = [s['creation'] or 0 for s in index['snapshots']]
+    assert creation == sorted(creation, reverse=True)
+
+    page = conn.ws.call('zfs.snapshot_index.query', {'order_by': ['-creation', 'name'], 'limit': 3})
+    assert page['snapshots'] == index['snapshots'][:3]
+
+
+def test_snapshot_index_query_dataset(conn):
+    index = conn.ws.call('zfs.snapshot_index.query')
+    if not index['snapshots']:
+        pytest.skip('No snapshot found')
+    dataset = index['snapshots'][0]['dataset']
+
+    rv = conn.ws.call('zfs.snapshot_index.query', {'dataset': dataset})
+    assert rv['total'] == len([s for s in index['snapshots'] if s['dataset'] == dataset])
+
+    name = index['snapshots'][0]['name']
+    rv = conn.ws.call('zfs.snapshot_index.query', {'name': name})
+    assert [s['name'] for s in rv['snapshots']] == [name]
@@ -0,0 +1,17 @@
+def test_servicemonitor_stats(conn):
+    stats = conn.ws.call('servicemonitor.stats')
+
+    assert isinstance(stats, dict) is True
+    for name, monitor in stats.items():
+        assert isinstance(monitor['connected'], bool) is True
+        assert isinstance(monitor['checks'], int) is True
+        latency = monitor['latency']
+        assert len(latency['counts']) == len(latency['buckets'])
+        assert sum(latency['counts']) == latency['count']
+
+
+def test_servicemonitor_alerts(conn):
+    alerts = conn.ws.call('servicemonitor.alerts')
+
+    assert isinstance(alerts, list) is True
+    assert all(isinstance(alert, str) for alert in alerts)
@@ -0,0 +1,210 @@
+import io
+import os
+import threading
+import time
+
+import pytest
+
+from middlewared.plugins import backup
+
+
+class FakeS3(object):
+    """
+    In-memory stand-in for the boto3 S3 client calls used by upload and
+    download, keeping track of the parts in flight.
+    """
+
+    def __init__(self, fail_part=None, delay=0.01):
+        self.objects = {}
+        self.uploads = {}
+        self.aborted = []
+        self.fail_part = fail_part
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.active = 0
+        self.active_bytes = 0
+        self.peak = 0
+        self.peak_bytes = 0
+
+    def _transfer(self, size):
+        with self.lock:
+            self.active += 1
+            self.active_bytes += size
+            self.peak = max(self.peak, self.active)
+            self.peak_bytes = max(self.peak_bytes, self.active_bytes)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+            self.active_bytes -= size
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = bytes(Body)
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = str(len(self.uploads))
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, ContentLength, Body):
+        assert ContentLength == len(Body)
+        self._transfer(len(Body))
+        if PartNumber == self.fail_part:
+            raise IOError('Part {} failed'.format(PartNumber))
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': '"{}"'.format(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = MultipartUpload['Parts']
+        assert [p['PartNumber'] for p in parts] == list(range(1, len(parts) + 1))
+        self.objects[Key] = b''.join(self.uploads[UploadId][p['PartNumber']] for p in parts)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(UploadId)
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.objects[Key]), 'ETag': '"etag"'}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        data = self.objects[Key]
+        if Range is not None:
+            assert IfMatch == '"etag"'
+            start, end = map(int, Range[len('bytes='):].split('-'))
+            data = data[start:end + 1]
+            self._transfer(len(data))
+        return {'Body': io.BytesIO(data)}
+
+
+@pytest.fixture
+def small_parts(monkeypatch):
+    monkeypatch.setattr(backup, 'MIN_PART_SIZE', 1024)
+    monkeypatch.setattr(backup, 'MAX_STREAM_PART_SIZE', 4096)
+    monkeypatch.setattr(backup, 'DOWNLOAD_PART_SIZE', 1000)
+
+
+def pipe(data):
+    """
+    Reading end of a pipe fed with `data` in small writes, which makes for
+    short reads.
+    """
+    r, w = os.pipe()
+
+    def feed():
+        for i in range(0, len(data), 700):
+            os.write(w, data[i:i + 700])
+        os.close(w)
+
+    threading.Thread(target=feed, daemon=True).start()
+    return os.fdopen(r, 'rb')
+
+
+def test_part_size_for():
+    mib = 1024 * 1024
+    assert backup.part_size_for(0) == backup.MIN_PART_SIZE
+    assert backup.part_size_for(10 * mib) == backup.MIN_PART_SIZE
+    # 200 GiB need parts larger than 5 MiB, rounded up to whole MiB
+    size = 200 * 1024 * mib
+    part_size = backup.part_size_for(size)
+    assert part_size % mib == 0
+    assert part_size * backup.MAX_PARTS >= size
+    assert (part_size - mib) * backup.MAX_PARTS < size
+    assert backup.part_size_for(100 * 1024 ** 4) == backup.MAX_PART_SIZE
+
+
+def test_part_sizes():
+    sizes = backup.part_sizes(30 * 1024 ** 3)
+    assert [next(sizes) for i in range(3)] == [backup.part_size_for(30 * 1024 ** 3)] * 3
+
+    sizes = [size for size, i in zip(backup.part_sizes(), range(backup.MAX_PARTS))]
+    assert sizes[0] == sizes[999] == backup.MIN_PART_SIZE
+    assert sizes[1000] == 2 * backup.MIN_PART_SIZE
+    assert sorted(sizes) == sizes
+    # Capped for memory, while still allowing large streams
+    assert max(sizes) == backup.MAX_STREAM_PART_SIZE
+    assert sum(sizes) > 500 * 1024 ** 3
+
+
+def test_read_full():
+    data = os.urandom(5000)
+    f = pipe(data)
+    assert backup.read_full(f, 3000) == data[:3000]
+    assert backup.read_full(f, 3000) == data[3000:]
+    assert backup.read_full(f, 3000) == b''
+
+
+def test_memory_budget():
+    budget = backup.MemoryBudget(100)
+    budget.acquire(60)
+    acquired = threading.Event()
+
+    def acquire():
+        budget.acquire(60)
+        acquired.set()
+
+    thread = threading.Thread(target=acquire, daemon=True)
+    thread.start()
+    assert not acquired.wait(0.1)
+    budget.release(60)
+    assert acquired.wait(1)
+    thread.join()
+    budget.release(60)
+
+    # Larger than the whole budget, on its own
+    budget.acquire(500)
+    assert budget.used == 500
+
+
+def test_upload_small(small_parts):
+    client = FakeS3()
+    backup.upload(client, 'bucket', 'key', io.BytesIO(b'data'))
+    assert client.objects['key'] == b'data'
+    assert client.uploads == {}
+
+
+def test_upload_multipart(small_parts, monkeypatch):
+    memory_budget = backup.MemoryBudget
+    monkeypatch.setattr(backup, 'MemoryBudget', lambda: memory_budget(3 * 4096))
+    data = os.urandom(300 * 1024 + 17)
+    client = FakeS3()
+    backup.upload(client, 'bucket', 'key', pipe(data), workers=4)
+    assert client.objects['key'] == data
+    assert len(client.uploads['0']) > 1
+    assert client.peak > 1
+    # Parts in flight stay within the memory budget
+    assert client.peak_bytes <= 3 * 4096
+    assert client.aborted == []
+
+
+def test_upload_known_size(monkeypatch):
+    mib = 1024 * 1024
+    monkeypatch.setattr(backup, 'MIN_PART_SIZE', mib)
+    data = os.urandom(3 * mib + 17)
+    client = FakeS3()
+    backup.upload(client, 'bucket', 'key', io.BytesIO(data), size=len(data))
+    assert client.objects['key'] == data
+    assert sorted(len(part) for part in client.uploads['0'].values()) == [17, mib, mib, mib]
+
+
+def test_upload_failure(small_parts):
+    client = FakeS3(fail_part=2)
+    with pytest.raises(IOError):
+        backup.upload(client, 'bucket', 'key', io.BytesIO(os.urandom(20 * 1024)))
+    assert 'key' not in client.objects
+    assert client.aborted == ['0']
+
+
+def test_download(small_parts):
+    data = os.urandom(20 * 1000 + 1)
+    client = FakeS3()
+    client.objects['key'] = data
+    out = io.BytesIO()
+    backup.download(client, 'bucket', 'key', out, workers=3)
+    assert out.getvalue() == data
+    assert 1 < client.peak <= 3
+
+
+def test_download_small(small_parts):
+    client = FakeS3()
+    client.objects['key'] = b'data'
+    out = io.BytesIO()
+    backup.download(client, 'bucket', 'key', out)
+    assert out.getvalue() == b'data'
@@ -0,0 +1,91 @@
+import operator
+import types
+
+import pytest
+
+from middlewared.utils import IndexedList, _order, filter_list
+
+
+data = [
+    {'id': 1, 'name': 'tank', 'pool': 'tank', 'used': 30, 'tags': ['a']},
+    {'id': 2, 'name': 'tank/a', 'pool': 'tank', 'used': None, 'tags': ['b']},
+    {'id': 3, 'name': 'tank/b', 'pool': 'tank', 'used': 10, 'tags': []},
+    {'id': 4, 'name': 'data', 'pool': 'data', 'used': 20, 'tags': ['a']},
+    {'id': 5, 'name': 'data/c', 'pool': 'data', 'used': 10, 'tags': ['c']},
+]
+
+
+def ids(rows):
+    return [row['id'] for row in rows]
+
+
+@pytest.mark.parametrize('filters,expected', [
+    ([('pool', '=', 'tank')], [1, 2, 3]),
+    ([('pool', '!=', 'tank')], [4, 5]),
+    ([('used', '>', 10)], [1, 4]),
+    ([('used', '>=', 10)], [1, 3, 4, 5]),
+    ([('used', '<', 20)], [3, 5]),
+    ([('used', '<=', 20)], [3, 4, 5]),
+    ([('name', '~', '^tank/')], [2, 3]),
+    ([('id', 'in', [2, 4, 6])], [2, 4]),
+    ([('id', 'nin', [2, 4])], [1, 3, 5]),
+    ([('pool', '=', 'tank'), ('used', '=', 10)], [3]),
+    ([('OR', [('id', '=', 1), ('name', '=', 'data/c')])], [1, 5]),
+])
+def test_filter_list_operators(filters, expected):
+    assert ids(filter_list(data, filters)) == expected
+    assert ids(filter_list(IndexedList(data, keys=('id', 'pool', 'name')), filters)) == expected
+
+
+def test_filter_list_invalid_filter():
+    with pytest.raises(ValueError):
+        filter_list(data, [('id', 'like', 1)])
+    with pytest.raises(ValueError):
+        filter_list(data, [('AND', [('id', '=', 1)])])
+    with pytest.raises(ValueError):
+        filter_list(data, ['id'])
+
+
+def test_filter_list_options():
+    assert ids(filter_list(data, options={'offset': 1, 'limit': 2})) == [2, 3]
+    assert ids(filter_list(data, [('pool', '=', 'tank')], {'offset': 1, 'limit': 1})) == [2]
+    assert filter_list(data, [('pool', '=', 'data')], {'count': True}) == 2
+    assert filter_list(data, [('pool', '=', 'data')], {'get': True})['id'] == 4
+    assert filter_list(data, [('pool', '=', 'data')], {'get': True, 'offset': 1})['id'] == 5
+    with pytest.raises(IndexError):
+        filter_list(data, [('pool', '=', 'none')], {'get': True})
+
+
+def test_filter_list_order_by():
+    assert ids(filter_list(data, options={'order_by': ['name']})) == [4, 5, 1, 2, 3]
+    assert ids(filter_list(data, options={'order_by': ['-name']})) == [3, 2, 1, 5, 4]
+    assert ids(filter_list(data, options={'order_by': ['pool', '-id']})) == [5, 4, 3, 2, 1]
+    assert ids(filter_list(data, options={'order_by': ['-pool', 'used', 'id']})) == [2, 3, 1, 5, 4]
+    # Sorted before slicing
+    assert ids(filter_list(data, options={'order_by': ['-id'], 'limit': 2})) == [5, 4]
+
+
+def test_order_none_first():
+    # Mixing None with values falls back to sorting None first
+    assert ids(_order(data, ['used'], operator.itemgetter)) == [2, 3, 5, 4, 1]
+    assert ids(_order(data, ['-used', 'id'], operator.itemgetter)) == [1, 4, 3, 5, 2]
+
+
+def test_filter_list_objects():
+    objects = [types.SimpleNamespace(**row) for row in data]
+    rv = filter_list(objects, [('pool', '=', 'data')], {'order_by': ['-used']})
+    assert [o.id for o in rv] == [4, 5]
+
+
+def test_indexed_list_lookup():
+    rows = IndexedList(data, keys=('pool', 'id', 'tags'))
+    # Lists cannot be hashed, their key is not indexed
+    assert set(rows.indexes) == {'pool', 'id'}
+    assert rows.lookup([('pool', '=', 'tank')]) == [0, 1, 2]
+    assert rows.lookup([('id', 'in', [5, 1])]) == [0, 4]
+    assert rows.lookup([('pool', '=', 'tank'), ('id', 'in', [1, 4])]) == [0]
+    assert rows.lookup([('pool', '=', 'none')]) == []
+    # No index for these
+    assert rows.lookup([('used', '=', 10)]) is None
+    assert rows.lookup([('pool', '!=', 'tank')]) is None
+    assert rows.lookup([('OR', [('pool', '=', 'tank')])]) is None
@@ -0,0 +1,217 @@
+import math
+import os
+import struct
+
+import pytest
+
+from middlewared import rrd
+
+
+LAST_UPDATE = 1700000003
+STEP = 10
+# cf, pdp_cnt, rows
+ARCHIVES = (('AVERAGE', 1, 360), ('AVERAGE', 6, 100), ('MAX', 6, 100))
+DATASOURCES = ('value', 'other')
+
+
+def value(t, ds):
+    if t % 700 == 0:
+        return math.nan
+    return t / 10.0 + ds * 1000
+
+
+def make_rrd(path, last_update=LAST_UPDATE):
+    """
+    Write a rrdtool 1.4 (version 0003) file whose row ending at `t` holds
+    value(t, ds) in every archive, the ring buffers having wrapped.
+    """
+    data = bytearray()
+    data += struct.pack('=4s5s7xdQQQ', b'RRD\0', b'0003\0', rrd.RRD_FLOAT_COOKIE, len(DATASOURCES),
+                        len(ARCHIVES), STEP)
+    data += bytes(rrd.STAT_HEAD_SIZE - rrd.STAT_HEAD.size)
+    for name in DATASOURCES:
+        data += rrd.DS_DEF.pack(name.encode(), b'GAUGE') + bytes(rrd.DS_DEF_SIZE - rrd.DS_DEF.size)
+    for cf, pdp_cnt, rows in ARCHIVES:
+        data += rrd.RRA_DEF.pack(cf.encode(), rows, pdp_cnt, 0.5) + bytes(rrd.RRA_DEF_SIZE - rrd.RRA_DEF.size)
+    data += struct.pack('=qq', last_update, 0)
+    data += bytes(rrd.PDP_PREP_SIZE * len(DATASOURCES) + rrd.CDP_PREP_SIZE * len(DATASOURCES) * len(ARCHIVES))
+    cur_rows = [rows * 2 // 3 for cf, pdp_cnt, rows in ARCHIVES]
+    for cur_row in cur_rows:
+        data += rrd.RRA_PTR.pack(cur_row)
+    for (cf, pdp_cnt, rows), cur_row in zip(ARCHIVES, cur_rows):
+        step = STEP * pdp_cnt
+        cal_end = last_update - last_update % step
+        values = [0.0] * (rows * len(DATASOURCES))
+        for back in range(rows):
+            pos = (cur_row - back) % rows
+            for ds in range(len(DATASOURCES)):
+                values[pos * len(DATASOURCES) + ds] = value(cal_end - back * step, ds)
+        data += struct.pack('=%dd' % len(values), *values)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def same(a, b):
+    return (math.isnan(a) and math.isnan(b)) or a == b
+
+
+@pytest.fixture
+def rrd_path(tmpdir):
+    return make_rrd(tmpdir.join('test.rrd'))
+
+
+def test_rrd_info(rrd_path):
+    f = rrd.RRDFile(rrd_path)
+    assert f.info() == {
+        'step': STEP,
+        'last_update': LAST_UPDATE,
+        'datasets': {'value': {'type': 'GAUGE'}, 'other': {'type': 'GAUGE'}},
+    }
+    assert [(a.cf, a.step, a.rows) for a in f.archives] == [
+        ('AVERAGE', 10, 360), ('AVERAGE', 60, 100), ('MAX', 60, 100),
+    ]
+
+
+def test_rrd_invalid(tmpdir):
+    path = tmpdir.join('invalid.rrd')
+    path.write_binary(b'\0' * 256)
+    with pytest.raises(rrd.RRDError):
+        rrd.RRDFile(str(path))
+
+    path.write_binary(b'RRD')
+    with pytest.raises(rrd.RRDError):
+        rrd.RRDFile(str(path))
+
+    # Truncated archives
+    data = open(make_rrd(tmpdir.join('truncated.rrd')), 'rb').read()
+    path.write_binary(data[:-8])
+    with pytest.raises(rrd.RRDError):
+        rrd.RRDFile(str(path))
+
+
+def test_rrd_fetch(rrd_path):
+    f = rrd.RRDFile(rrd_path)
+    start, step, values = f.fetch('other', 'AVERAGE', LAST_UPDATE - 3000, LAST_UPDATE, 10)
+    assert step == 10
+    assert start % step == 0
+    assert len(values) == 301
+    for k, v in enumerate(values):
+        t = start + step * (k + 1)
+        # The row being filled is not known yet
+        expected = value(t, 1) if t <= LAST_UPDATE - LAST_UPDATE % step else math.nan
+        assert same(v, expected), t
+
+
+def test_rrd_fetch_coarse_archive(rrd_path):
+    f = rrd.RRDFile(rrd_path)
+    # Older than the 10 seconds archive goes
+    start, step, values = f.fetch('value', 'AVERAGE', LAST_UPDATE - 86400, LAST_UPDATE, 10)
+    assert step == 60
+    cal_end = LAST_UPDATE - LAST_UPDATE % step
+    for k, v in enumerate(values):
+        t = start + step * (k + 1)
+        expected = value(t, 0) if cal_end - 100 * step < t <= cal_end else math.nan
+        assert same(v, expected), t
+
+    start, step, values = f.fetch('value', 'MAX', cal_end - 600, cal_end, 60)
+    assert (start, step) == (cal_end - 600, 60)
+    assert values == [value(start + 60 * (k + 1), 0) for k in range(10)]
+
+
+def test_rrd_fetch_unknown(rrd_path):
+    f = rrd.RRDFile(rrd_path)
+    with pytest.raises(rrd.RRDError):
+        f.fetch('missing', 'AVERAGE', LAST_UPDATE - 600, LAST_UPDATE, 10)
+    with pytest.raises(rrd.RRDError):
+        f.fetch('value', 'LAST', LAST_UPDATE - 600, LAST_UPDATE, 10)
+
+
+def test_xport(rrd_path):
+    start = LAST_UPDATE - 1800 + 15
+    end = LAST_UPDATE - LAST_UPDATE % 60
+    out = rrd.xport([
+        (rrd_path, 'value', 'AVERAGE', 'test/value'),
+        (rrd_path, 'other', 'AVERAGE', 'test/other'),
+    ], str(start), str(end), 20)
+
+    meta = out['meta']
+    assert meta['step'] == 20
+    assert meta['legend'] == ['test/value', 'test/other']
+    assert meta['start'] <= start and meta['start'] % 20 == 0
+    assert meta['end'] == end
+    assert len(out['data']) == (meta['end'] - meta['start']) // 20
+
+    for k, row in enumerate(out['data']):
+        t = meta['start'] + 20 * (k + 1)
+        for ds, v in enumerate(row):
+            # Every row consolidates both 10 seconds rows it is made of,
+            # the first one included
+            known = [x for x in (value(t - 10, ds), value(t, ds)) if not math.isnan(x)]
+            if known:
+                assert v == sum(known) / len(known), (t, ds)
+            else:
+                assert v is None, (t, ds)
+
+
+def test_xport_common_step(rrd_path):
+    out = rrd.xport([
+        (rrd_path, 'value', 'AVERAGE', 'fine'),
+        (rrd_path, 'value', 'MAX', 'coarse'),
+    ], str(LAST_UPDATE - 1200), str(LAST_UPDATE), None)
+    # Least common multiple of the steps of both archives
+    assert out['meta']['step'] == 60
+    assert all(len(row) == 2 for row in out['data'])
+
+
+@pytest.mark.parametrize('start,end,expected', [
+    ('1000', '2000', (1000, 2000)),
+    ('now-1h', 'now', (96400, 100000)),
+    ('end-2d+30min', 'now-1d', (100000 - 3 * 86400 + 1800, 100000 - 86400)),
+    ('now-10min', 'start+5min', (99400, 99700)),
+    ('N', '100600', (100000, 100600)),
+])
+def test_parse_range(start, end, expected):
+    assert rrd.parse_range(start, end, now=100000) == expected
+
+
+@pytest.mark.parametrize('start,end', [
+    ('now-1m', 'now'),
+    ('yesterday', 'now'),
+    ('now', 'now-1h'),
+])
+def test_parse_range_invalid(start, end):
+    with pytest.raises(rrd.RRDError):
+        rrd.parse_range(start, end, now=100000)
+
+
+def test_consolidate():
+    values = [1.0, 3.0, math.nan, 5.0, math.nan, math.nan]
+    assert rrd.consolidate(values, 2, 'AVERAGE') == [2.0, 5.0, pytest.approx(math.nan, nan_ok=True)]
+    assert rrd.consolidate(values, 3, 'MIN') == [1.0, 5.0]
+    assert rrd.consolidate(values, 3, 'MAX') == [3.0, 5.0]
+    assert rrd.consolidate(values, 3, 'LAST') == [3.0, 5.0]
+    assert rrd.consolidate(values, 1, 'AVERAGE') is values
+
+
+def test_open_rrd(rrd_path, tmpdir, monkeypatch):
+    monkeypatch.setattr(rrd, '_files', rrd.OrderedDict())
+    monkeypatch.setattr(rrd, 'RRD_CACHE_SIZE', 2)
+
+    f = rrd.open_rrd(rrd_path)
+    assert rrd.open_rrd(rrd_path) is f
+
+    # Replaced by rrdtool
+    os.unlink(rrd_path)
+    make_rrd(rrd_path, LAST_UPDATE + 10)
+    assert rrd.open_rrd(rrd_path) is not f
+
+    others = [make_rrd(tmpdir.join('%d.rrd' % i)) for i in range(2)]
+    for path in others:
+        rrd.open_rrd(path)
+    assert list(rrd._files) == others
+
+    os.unlink(others[0])
+    with pytest.raises(OSError):
+        rrd.open_rrd(others[0])
+    assert list(rrd._files) == others[1:]
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from middlewared.utils import parse_rsync_progress, read_lines
+
+
+@pytest.mark.parametrize('line,expected', [
+    ('          1,238,099 100%  146.38MB/s    0:00:00 (xfr#1, to-chk=0/1)', {
+        'percent': 100, 'transferred': 1238099, 'rate': 146380000, 'eta': 0,
+    }),
+    ('     32,768   0%    0.00kB/s    0:00:00', {
+        'percent': 0, 'transferred': 32768, 'rate': 0, 'eta': 0,
+    }),
+    ('      1.05G  42%   10.50MB/s    1:02:03', {
+        'percent': 42, 'transferred': 1050000000, 'rate': 10500000, 'eta': 3723,
+    }),
+    ('    512  12%  100.00B/s    0:00:10  ', {
+        'percent': 12, 'transferred': 512, 'rate': 100, 'eta': 10,
+    }),
+])
+def test_parse_rsync_progress(line, expected):
+    assert parse_rsync_progress(line) == expected
+
+
+@pytest.mark.parametrize('line', [
+    'sending incremental file list',
+    'data/file.txt',
+    'sent 1,238,526 bytes  received 35 bytes  825,707.33 bytes/sec',
+    'total size is 1,238,099  speedup is 1.00',
+    '',
+])
+def test_parse_rsync_progress_other_lines(line):
+    assert parse_rsync_progress(line) is None
+
+
+def test_read_lines():
+    async def read(chunks, chunk_size):
+        stream = asyncio.StreamReader()
+        for chunk in chunks:
+            stream.feed_data(chunk)
+        stream.feed_eof()
+        return [line async for line in read_lines(stream, chunk_size)]
+
+    chunks = [b'file\n  1  0%\r  2  5', b'0%\r\n', b'\n\xc3\xa9t\xc3', b'\xa9\rlast']
+    expected = ['file', '  1  0%', '  2  50%', 'été', 'last']
+    loop = asyncio.new_event_loop()
+    try:
+        # Lines split across reads are put back together
+        for chunk_size in (1, 3, 65536):
+            assert loop.run_until_complete(read(chunks, chunk_size)) == expected
+    finally:
+        loop.close()
@@ -0,0 +1,372 @@
+"""
+Reader of the round robin databases written by collectd.
+
+The files are memory mapped and their archives exposed as strided views of
+doubles, so slicing a time range out of a data source and consolidating it
+is done without spawning `rrdtool` nor copying the whole archive.
+
+Only the native layout of the platform (LP64, host byte order) of the
+formats written by rrdtool 1.x is understood, anything else raises
+`RRDError` and callers are expected to fall back to `rrdtool` itself.
+"""
+from collections import OrderedDict
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+RRD_COOKIE = b'RRD\0'
+RRD_FLOAT_COOKIE = 8.642135E130
+RRD_VERSIONS = (b'0001', b'0002', b'0003', b'0004')
+
+# Sizes and offsets of rrd_format.h structures, unsigned long and time_t
+# being 8 bytes and unival a double
+STAT_HEAD = struct.Struct('=4s5s7xdQQQ')
+STAT_HEAD_SIZE = 128
+DS_DEF = struct.Struct('=20s20s')
+DS_DEF_SIZE = 120
+RRA_DEF = struct.Struct('=20s4xQQd')
+RRA_DEF_SIZE = 120
+PDP_PREP_SIZE = 112
+CDP_PREP_SIZE = 80
+LIVE_HEAD = struct.Struct('=q')
+RRA_PTR = struct.Struct('=Q')
+
+RE_TIME = re.compile(
+    r'^(?P<ref>now|start|end)?(?P<offsets>(?:[+-]\d+(?:s|sec|seconds?|min|minutes?|h|hours?|d|days?|w|weeks?))*)$'
+)
+RE_TIME_OFFSET = re.compile(r'([+-]\d+)([a-z]+)')
+TIME_UNITS = {
+    's': 1, 'sec': 1, 'second': 1, 'seconds': 1,
+    'min': 60, 'minute': 60, 'minutes': 60,
+    'h': 3600, 'hour': 3600, 'hours': 3600,
+    'd': 86400, 'day': 86400, 'days': 86400,
+    'w': 604800, 'week': 604800, 'weeks': 604800,
+}
+
+# Number of RRD files kept mapped, each holding a mapping and a descriptor
+RRD_CACHE_SIZE = 128
+
+_lock = threading.Lock()
+# path -> RRDFile, least recently used first
+_files = OrderedDict()
+
+
+class RRDError(Exception):
+    pass
+
+
+def _cstr(value):
+    return value.split(b'\0', 1)[0].decode('ascii', 'ignore')
+
+
+class RRDArchive(object):
+
+    def __init__(self, cf, rows, pdp_cnt, xff, step, offset):
+        self.cf = cf
+        self.rows = rows
+        self.pdp_cnt = pdp_cnt
+        self.xff = xff
+        # Seconds per row
+        self.step = step
+        # Offset of the first row in the file
+        self.offset = offset
+
+
+class RRDFile(object):
+    """
+    Memory mapped RRD file.
+
+    The definitions are read once, the live header and archive pointers are
+    read from the mapping on every fetch as rrdtool updates them in place.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.ident = (st.st_dev, st.st_ino, st.st_size)
+            if st.st_size < STAT_HEAD_SIZE:
+                raise RRDError('{}: file too small'.format(path))
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        cookie, version, float_cookie, ds_cnt, rra_cnt, pdp_step = STAT_HEAD.unpack_from(self.map, 0)
+        if cookie != RRD_COOKIE:
+            raise RRDError('{}: not a RRD file'.format(path))
+        version = version.rstrip(b'\0')
+        if version not in RRD_VERSIONS:
+            raise RRDError('{}: unsupported RRD version {}'.format(path, version.decode('ascii', 'ignore')))
+        if float_cookie != RRD_FLOAT_COOKIE:
+            raise RRDError('{}: RRD file from a different architecture'.format(path))
+
+        self.version = version
+        self.step = pdp_step
+
+        offset = STAT_HEAD_SIZE
+        self.datasources = []
+        for i in range(ds_cnt):
+            name, dst = DS_DEF.unpack_from(self.map, offset)
+            self.datasources.append((_cstr(name), _cstr(dst)))
+            offset += DS_DEF_SIZE
+
+        rra_defs = []
+        for i in range(rra_cnt):
+            cf, rows, pdp_cnt, xff = RRA_DEF.unpack_from(self.map, offset)
+            rra_defs.append((_cstr(cf), rows, pdp_cnt, xff))
+            offset += RRA_DEF_SIZE
+
+        self.live_head_offset = offset
+        offset += 8 if version < b'0003' else 16
+        offset += PDP_PREP_SIZE * ds_cnt + CDP_PREP_SIZE * ds_cnt * rra_cnt
+        self.rra_ptr_offset = offset
+        offset += RRA_PTR.size * rra_cnt
+
+        self.archives = []
+        for cf, rows, pdp_cnt, xff in rra_defs:
+            self.archives.append(RRDArchive(cf, rows, pdp_cnt, xff, pdp_step * pdp_cnt, offset))
+            offset += rows * ds_cnt * 8
+
+        if offset > st.st_size:
+            raise RRDError('{}: truncated RRD file'.format(path))
+
+        self.values = memoryview(self.map)[:offset].cast('d')
+
+    @property
+    def last_update(self):
+        return LIVE_HEAD.unpack_from(self.map, self.live_head_offset)[0]
+
+    def info(self):
+        return {
+            'step': self.step,
+            'last_update': self.last_update,
+            'datasets': {name: {'type': dst} for name, dst in self.datasources},
+        }
+
+    def ds_index(self, name):
+        for i, ds in enumerate(self.datasources):
+            if ds[0] == name:
+                return i
+        raise RRDError('{}: no such data source {}'.format(self.path, name))
+
+    def select_archive(self, cf, start, end, step):
+        """
+        Archive used to fetch [start, end] at `step` seconds, chosen as
+        rrdtool fetch does: the one covering the start of the range with the
+        closest step or, failing that, the one covering most of the range.
+        """
+        last_update = self.last_update
+        full = partial = None
+        for i, rra in enumerate(self.archives):
+            if rra.cf != cf:
+                continue
+            cal_end = last_update - last_update % rra.step
+            cal_start = cal_end - rra.step * rra.rows
+            if cal_start <= start:
+                diff = abs(step - rra.step)
+                if full is None or diff < full[0]:
+                    full = (diff, i)
+            else:
+                covered = min(end, cal_end) - max(start, cal_start)
+                if partial is None or covered > partial[0]:
+                    partial = (covered, i)
+        if full is not None:
+            return full[1]
+        if partial is not None:
+            return partial[1]
+        raise RRDError('{}: no {} archive'.format(self.path, cf))
+
+    def fetch(self, name, cf, start, end, step, archive=None):
+        """
+        Values of the data source `name` for the rows ending after `start`
+        up to `end` at the resolution of the best archive, or of the archive
+        at index `archive`.
+
+        Returns:
+            tuple(int, int, list) - aligned start, step and values (NaN for
+                                    unknown rows)
+        """
+        ds = self.ds_index(name)
+        idx = self.select_archive(cf, start, end, step) if archive is None else archive
+        rra = self.archives[idx]
+        # rrdtool may be updating the file, make sure cur_row and last_update
+        # belong to the same update
+        while True:
+            last_update = self.last_update
+            cur_row = RRA_PTR.unpack_from(self.map, self.rra_ptr_offset + RRA_PTR.size * idx)[0]
+            if last_update == self.last_update:
+                break
+
+        start -= start % rra.step
+        if end % rra.step:
+            end += rra.step - end % rra.step
+        count = (end - start) // rra.step
+        cal_end = last_update - last_update % rra.step
+
+        # Rows are numbered backwards from the most recent one, k-th value
+        # being the row ending at start + step * (k + 1)
+        newest = (cal_end - start) // rra.step - 1
+        first = max(0, newest - rra.rows + 1)
+        last = min(count, newest + 1)
+        if first >= last:
+            return start, rra.step, [math.nan] * count
+
+        # ds column of the archive as a strided view of its rows
+        ds_cnt = len(self.datasources)
+        column = self.values[rra.offset // 8 + ds:(rra.offset // 8) + rra.rows * ds_cnt:ds_cnt]
+
+        # Ring buffer position of the first row, the range wraps at most once
+        pos = (cur_row - (newest - first)) % rra.rows
+        length = last - first
+        if pos + length <= rra.rows:
+            values = column[pos:pos + length].tolist()
+        else:
+            values = column[pos:].tolist() + column[:pos + length - rra.rows].tolist()
+
+        return start, rra.step, [math.nan] * first + values + [math.nan] * (count - last)
+
+
+def open_rrd(path):
+    """
+    RRDFile for `path`, shared as long as the file is not replaced and is
+    among the RRD_CACHE_SIZE most recently used.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        with _lock:
+            _files.pop(path, None)
+        raise
+    ident = (st.st_dev, st.st_ino, st.st_size)
+    with _lock:
+        rrd = _files.get(path)
+        if rrd is not None and rrd.ident == ident:
+            _files.move_to_end(path)
+            return rrd
+        _files.pop(path, None)
+        rrd = _files[path] = RRDFile(path)
+        while len(_files) > RRD_CACHE_SIZE:
+            _files.popitem(last=False)
+        return rrd
+
+
+def parse_time(spec, now, start=None, end=None):
+    """
+    Parse the subset of the rrdtool at-style time specifications used in
+    practice: seconds since epoch and `now`, `start` or `end` optionally
+    followed by offsets in seconds, minutes, hours, days or weeks
+    (e.g. `now-1h`, `end-2d+30min`).
+    """
+    spec = str(spec).strip()
+    if spec.isdigit():
+        return int(spec)
+    if spec == 'N':
+        return now
+    reg = RE_TIME.match(spec)
+    if not reg or not spec:
+        raise RRDError('Unsupported time specification: {}'.format(spec))
+    ref = reg.group('ref') or 'now'
+    if ref == 'now':
+        value = now
+    elif ref == 'start' and start is not None:
+        value = start
+    elif ref == 'end' and end is not None:
+        value = end
+    else:
+        raise RRDError('Unsupported time specification: {}'.format(spec))
+    for amount, unit in RE_TIME_OFFSET.findall(reg.group('offsets')):
+        value += int(amount) * TIME_UNITS[unit]
+    return value
+
+
+def parse_range(start, end, now=None):
+    now = int(time.time()) if now is None else now
+    start, end = str(start), str(end)
+    if start.startswith('end'):
+        end = parse_time(end, now)
+        start = parse_time(start, now, end=end)
+    else:
+        start = parse_time(start, now)
+        end = parse_time(end, now, start=start)
+    if start >= end:
+        raise RRDError('Start time must be before end time')
+    return start, end
+
+
+def consolidate(values, factor, cf):
+    """
+    Consolidate every `factor` consecutive values with the consolidation
+    function `cf`, ignoring unknown values.
+    """
+    if factor == 1:
+        return values
+    rv = []
+    for i in range(0, len(values), factor):
+        known = [v for v in values[i:i + factor] if not math.isnan(v)]
+        if not known:
+            rv.append(math.nan)
+        elif cf == 'AVERAGE':
+            rv.append(math.fsum(known) / len(known))
+        elif cf == 'MIN':
+            rv.append(min(known))
+        elif cf == 'MAX':
+            rv.append(max(known))
+        else:
+            rv.append(known[-1])
+    return rv
+
+
+def _lcm(a, b):
+    return a * b // math.gcd(a, b)
+
+
+def xport(series, start, end, step=None):
+    """
+    Equivalent of `rrdtool xport` for `series`, a list of
+    (path, data source, consolidation function, legend) tuples.
+
+    Every series is fetched from its best archive and consolidated to a
+    common step, the least common multiple of the archives steps rounded up
+    to a multiple of `step`. The range is aligned on that step before
+    fetching so every row consolidates a full set of archive rows.
+
+    Returns:
+        dict - same layout as `rrdtool xport --json`, unknown values as None
+    """
+    start, end = parse_range(start, end)
+
+    selected = []
+    out_step = 1
+    for path, name, cf, legend in series:
+        rrd = open_rrd(path)
+        archive = rrd.select_archive(cf, start, end, step or rrd.step)
+        selected.append((rrd, name, cf, archive))
+        out_step = _lcm(out_step, rrd.archives[archive].step)
+
+    if step and step > out_step:
+        out_step *= -(-step // out_step)
+
+    start -= start % out_step
+    if end % out_step:
+        end += out_step - end % out_step
+    count = (end - start) // out_step
+
+    columns = []
+    for rrd, name, cf, archive in selected:
+        fstart, fstep, values = rrd.fetch(name, cf, start, end, step or rrd.step, archive)
+        factor = out_step // fstep
+        values = consolidate(values[:count * factor], factor, cf)
+        values += [math.nan] * (count - len(values))
+        columns.append([None if math.isnan(v) else v for v in values])
+
+    return {
+        'meta': {
+            'start': start,
+            'end': end,
+            'step': out_step,
+            'legend': [s[3] for s in series],
+        },
+        'data': [list(row) for row in zip(*columns)] if columns else [],
+    }
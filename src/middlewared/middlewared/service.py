@@ -266,10 +266,14 @@ class CoreService(Service):
     @filterable
     def get_jobs(self, filters=None, options=None):
         """Get the long running jobs."""
-        jobs = filter_list([
-            i.__encode__() for i in list(self.middleware.jobs.all().values())
-        ], filters, options)
-        return jobs
+        jobs = self.middleware.jobs.all()
+        # Clients poll their job by id, do not encode every other job for that
+        ids = [f[2] for f in filters or [] if len(f) == 3 and f[0] == 'id' and f[1] == '=']
+        if ids:
+            jobs = [jobs[ids[0]]] if ids[0] in jobs else []
+        else:
+            jobs = list(jobs.values())
+        return filter_list([i.__encode__() for i in jobs], filters, options)
 
     @accepts(Int('id'), Dict(
         'job-update',
@@ -1,6 +1,9 @@
 import asyncio
+import operator
+import re
 import sys
 import subprocess
+from collections import defaultdict
 from datetime import datetime, timedelta
 from functools import wraps
 from threading import Lock
@@ -65,53 +68,252 @@ async def run(*args, **kwargs):
     return cp
 
 
-def filter_list(_list, filters=None, options=None):
+RE_LINE_SEPARATOR = re.compile(rb'[\r\n]')
+RE_RSYNC_PROGRESS = re.compile(
+    r'^\s*(?P<transferred>[\d.,]+)(?P<transferred_unit>[KMGTP]?)\s+(?P<percent>\d+)%\s+'
+    r'(?P<rate>[\d.,]+)(?P<rate_unit>[kKMGTP]?)B/s\s+(?P<eta>\d+):(?P<eta_min>\d{2}):(?P<eta_sec>\d{2})'
+)
+_rsync_units = {'': 1, 'k': 1000, 'K': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3, 'T': 1000 ** 4, 'P': 1000 ** 5}
+
 
-    opmap = {
-        '=': lambda x, y: x == y,
-        '!=': lambda x, y: x != y,
+async def read_lines(stream, chunk_size=65536):
+    """
+    Yield the lines read from the asyncio `stream`, split on either `\\r` or
+    `\\n` so progress meters redrawing the same terminal line (rsync, zfs)
+    are seen as they are updated. Empty lines are skipped.
+    """
+    pending = b''
+    while True:
+        chunk = await stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = RE_LINE_SEPARATOR.split(pending + chunk)
+        pending = lines.pop()
+        for line in lines:
+            if line:
+                yield line.decode('utf8', 'ignore')
+    if pending:
+        yield pending.decode('utf8', 'ignore')
+
+
+def parse_rsync_progress(line):
+    """
+    Parse a `rsync --info=progress2` line into a dict with `percent`,
+    `transferred` (bytes), `rate` (bytes per second) and `eta` (seconds).
+    Returns None for any other line (file names, summary).
+    """
+    m = RE_RSYNC_PROGRESS.match(line)
+    if m is None:
+        return None
+    return {
+        'percent': int(m.group('percent')),
+        'transferred': int(
+            float(m.group('transferred').replace(',', '')) * _rsync_units[m.group('transferred_unit')]
+        ),
+        'rate': int(float(m.group('rate').replace(',', '')) * _rsync_units[m.group('rate_unit')]),
+        'eta': int(m.group('eta')) * 3600 + int(m.group('eta_min')) * 60 + int(m.group('eta_sec')),
     }
 
+
+class IndexedList(list):
+    """
+    List of dicts keeping hash indexes on some of their keys.
+
+    `filter_list` uses them to narrow down `=` and `in` filters instead of
+    scanning every row, which pays off for big collections queried many
+    times between changes.
+    """
+
+    def __init__(self, rows=(), keys=()):
+        super().__init__(rows)
+        self.indexes = {}
+        for key in keys:
+            index = self.indexes[key] = defaultdict(list)
+            for pos, row in enumerate(self):
+                value = row.get(key)
+                try:
+                    index[value].append(pos)
+                except TypeError:
+                    # Unhashable values cannot be indexed
+                    del self.indexes[key]
+                    break
+
+    def lookup(self, filters):
+        """
+        Positions of the rows possibly matching `filters`, in list order, or
+        None if no index applies.
+        """
+        positions = None
+        for f in filters:
+            if len(f) != 3 or f[0] not in self.indexes:
+                continue
+            name, op, value = f
+            if op == '=':
+                values = [value]
+            elif op == 'in':
+                values = value
+            else:
+                continue
+            index = self.indexes[name]
+            try:
+                found = set()
+                for v in values:
+                    found.update(index.get(v, ()))
+            except TypeError:
+                continue
+            positions = found if positions is None else positions & found
+        if positions is None:
+            return None
+        return sorted(positions)
+
+
+_filter_opmap = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '>': lambda x, y: x is not None and x > y,
+    '>=': lambda x, y: x is not None and x >= y,
+    '<': lambda x, y: x is not None and x < y,
+    '<=': lambda x, y: x is not None and x <= y,
+    '~': lambda x, y: x is not None and y.search(x) is not None,
+    'in': lambda x, y: x in y,
+    'nin': lambda x, y: x not in y,
+}
+
+
+def _compile_filter(f, getter):
+    """
+    Turn a filter, as accepted by `datastore.query`, into a predicate.
+    `getter` builds the function retrieving an attribute from an item.
+    """
+    if not isinstance(f, (list, tuple)):
+        raise ValueError('Filter must be a list: {0}'.format(f))
+    if len(f) == 3:
+        name, op, value = f
+        if op not in _filter_opmap:
+            raise ValueError('Invalid operation: {}'.format(op))
+        get = getter(name)
+        compare = _filter_opmap[op]
+        if op == '~':
+            value = re.compile(value)
+        elif op in ('in', 'nin'):
+            try:
+                value = frozenset(value)
+            except TypeError:
+                pass
+        return lambda i: compare(get(i), value)
+    elif len(f) == 2:
+        op, value = f
+        if op != 'OR':
+            raise ValueError('Invalid operation: {}'.format(op))
+        predicates = [_compile_filter(i, getter) for i in value]
+        return lambda i: any(p(i) for p in predicates)
+    raise ValueError('Invalid filter {0}'.format(f))
+
+
+def _compile_filters(filters, getter):
+    predicates = [_compile_filter(f, getter) for f in filters]
+    if len(predicates) == 1:
+        return predicates[0]
+
+    def predicate(i):
+        for p in predicates:
+            if not p(i):
+                return False
+        return True
+    return predicate
+
+
+def _order(rv, order_by, getter):
+    """
+    Sort by all `order_by` keys at once. Consecutive keys sorted in the same
+    direction share a single stable sort, least significant keys first.
+    """
+    groups = []
+    for o in order_by:
+        reverse = o.startswith('-')
+        name = o[1:] if reverse else o
+        if groups and groups[-1][0] == reverse:
+            groups[-1][1].append(name)
+        else:
+            groups.append((reverse, [name]))
+
+    rv = list(rv)
+    for reverse, names in reversed(groups):
+        getters = [getter(name) for name in names]
+        # item/attrgetter with several names return a tuple
+        key = getter(*names)
+        try:
+            rv.sort(key=key, reverse=reverse)
+        except TypeError:
+            # None sorts first instead of failing to compare
+            if len(getters) == 1:
+                def key(i, g=getters[0]):
+                    v = g(i)
+                    return (v is not None, v)
+            else:
+                def key(i):
+                    return tuple((v is not None, v) for v in (g(i) for g in getters))
+            rv.sort(key=key, reverse=reverse)
+    return rv
+
+
+def filter_list(_list, filters=None, options=None):
+    """
+    Filter, sort and slice a list of dicts (or objects) the same way
+    `datastore.query` does for the database.
+
+    Supported options are `order_by`, `offset`, `limit`, `count` and `get`.
+    """
+
     if filters is None:
-        filters = {}
+        filters = []
     if options is None:
         options = {}
 
-    rv = []
+    if _list and not isinstance(_list[0], dict):
+        getter = operator.attrgetter
+    else:
+        getter = operator.itemgetter
+
+    candidates = _list
+    if filters and isinstance(_list, IndexedList):
+        positions = _list.lookup(filters)
+        if positions is not None:
+            candidates = [_list[pos] for pos in positions]
+
+    order_by = options.get('order_by')
+    offset = options.get('offset') or 0
+    limit = options.get('limit')
+    # Without sorting we can stop as soon as enough items matched
+    stop = None
+    if not order_by and not options.get('count'):
+        if options.get('get') is True:
+            stop = offset + 1
+        elif limit is not None:
+            stop = offset + limit
+
     if filters:
-        for i in _list:
-            valid = True
-            for f in filters:
-                if len(f) == 3:
-                    name, op, value = f
-                    if op not in opmap:
-                        raise ValueError('Invalid operation: {}'.format(op))
-                    if isinstance(i, dict):
-                        source = i[name]
-                    else:
-                        source = getattr(i, name)
-                    if not opmap[op](source, value):
-                        valid = False
+        predicate = _compile_filters(filters, getter)
+        if stop is None:
+            rv = [i for i in candidates if predicate(i)]
+        else:
+            rv = []
+            for i in candidates:
+                if predicate(i):
+                    rv.append(i)
+                    if len(rv) >= stop:
                         break
-            if not valid:
-                continue
-            rv.append(i)
-            if options.get('get') is True:
-                return i
     else:
-        rv = _list
+        rv = list(candidates) if stop is None else list(candidates[:stop])
 
     if options.get('count') is True:
         return len(rv)
 
-    if options.get('order_by'):
-        for o in options.get('order_by'):
-            if o.startswith('-'):
-                o = o[1:]
-                reverse = True
-            else:
-                reverse = False
-            rv = sorted(rv, key=lambda x: x[o], reverse=reverse)
+    if order_by:
+        rv = _order(rv, order_by, getter)
+
+    if offset or limit is not None:
+        rv = rv[offset:None if limit is None else offset + limit]
 
     if options.get('get') is True:
         return rv[0]